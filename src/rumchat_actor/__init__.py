@@ -9,18 +9,48 @@ Modules exported by this package:
 - `commands`: Chat command base class and derivatives for common commands
 - `misc`: Miscellanious classes and functions for end use
 - `utils`: Utility functions and classes for internal use
+- `metrics`: Latency instrumentation of actions, commands and the outbox
 - `static`: Static variables
+- `benchmark`: Performance benchmarks
+- `replay`: Offline chat replay for load testing
+- `moderation`: Automatic chat moderation engines
+- `audio`: Sound output engines that keep speech and sounds off the message loop
+- `hls`: Fetching of livestream HLS playlists and TS chunks for clipping
+
+The `actions`, `commands`, `misc`, `benchmark`, `replay`, `moderation`, `audio` and `hls` modules are imported on first use,
+and heavy dependencies like MoviePy and PyGame are only imported when a feature needs them.
 
 S.D.G."""
 
+import asyncio
+import concurrent.futures
 from getpass import getpass
+import importlib
+import inspect
 import queue
 import textwrap
 import time
 import threading
 from cocorum import RumbleAPI, servicephp, scraping
 from cocorum.chatapi import ChatAPI
-from . import actions, commands, misc, utils, static
+from . import metrics, utils, static
+
+# Submodules that are imported on first use
+LAZY_SUBMODULES = ("actions", "commands", "misc", "benchmark", "replay", "moderation", "audio", "hls")
+
+
+def __getattr__(name):
+    """Import lazy submodules on first use
+
+    Args:
+        name (str): The name of the attribute being accessed.
+
+    Returns:
+        Module (module): The submodule."""
+
+    if name in LAZY_SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class RumbleChatActor:
@@ -58,7 +88,30 @@ class RumbleChatActor:
         max_outbox_size (int): How many messages can be waiting to send before we start cancelling old ones.
             Defaults to static.Message.max_outbox_size
         max_inbox_age (int | float): How old messages in the chat can be before we start skipping them to catch up.
-            Defaults to static.Message.max_inbox_age"""
+            Paid rants, gifts, raid alerts and staff messages are never skipped.
+            Defaults to static.Message.max_inbox_age
+        cosmetic_lag (int | float): How far behind chat we can fall before skipping cosmetic message actions, in seconds.
+            Defaults to static.Message.cosmetic_lag
+        expensive_lag (int | float): How far behind chat we can fall before also skipping expensive message actions, in seconds.
+            Defaults to static.Message.expensive_lag
+        servicephp (cocorum.servicephp.ServicePHP): An already logged in session to use.
+            Defaults to logging in with username and password.
+        chat (cocorum.chatapi.ChatAPI): An already connected chat API to use, or a stand-in like replay.ReplayChatAPI.
+            Defaults to connecting to the chat of the stream.
+        concurrent_actions (bool): Run fire-and-forget message actions on a worker pool
+            instead of in line with the gating ones.
+            Defaults to False.
+        action_workers (int): How many worker threads to run fire-and-forget message actions with.
+            Defaults to static.Message.action_workers
+        max_pending_actions (int): How many fire-and-forget message actions can be waiting or running
+            before we start skipping them.
+            Defaults to static.Message.max_pending_actions
+        metrics_file (str): Periodically write latency metrics to this file in Prometheus text format.
+            Defaults to None, do not write metrics to a file.
+        metrics_interval (int | float): How often to write the metrics file, in seconds.
+            Defaults to static.Metrics.prometheus_interval
+        moderation_workers (int): How many moderation calls to Rumble may be in progress at once.
+            Defaults to static.Moderation.workers"""
 
         #The info of the person streaming
         self.__streamer_username = kwargs.get("streamer_username")
@@ -107,48 +160,65 @@ class RumbleChatActor:
             self.stream_id = self.api_stream.stream_id
             self.stream_id_b10 = utils.base_36_to_10(self.stream_id)
 
-        # Get the login credentials from arguments, or None if they were not passed
-        self.username = kwargs.get("username")
-        self.password = kwargs.get("password")
-
-        # Username must not be an email
-        if "@" in self.username:
-            print("Username cannot be provided as email.")
-            self.username = None
-
-        # We can get the username from the Rumble Live Stream API
-        if not self.username and self.rum_api:
-            self.username = self.rum_api.username
-            print("Actor username obtained from Live Stream API:", self.username)
-
-        # Sign in to chat
-        first_time = True
-        while first_time or not (self.username and self.password):
-            # Ask user for credentials as needed
-            if not self.username:
-                self.username = input("Actor username: ")
-            if not self.password:
-                self.password = getpass("Actor password: ")
+        # An already logged in session was passed
+        if "servicephp" in kwargs:
+            self.servicephp = kwargs["servicephp"]
+            self.username = self.servicephp.username
+            self.password = None
 
-            try:
-                self.servicephp = servicephp.ServicePHP(self.username)
-                twofa = self.servicephp.login_basic(self.password)
-                if twofa:
-                    self.handle_2fa(twofa)
-            # Login failed
-            except AssertionError as e:
-                print("Error. Login failed with provided credentials:", e)
+        else:
+            # Get the login credentials from arguments, or None if they were not passed
+            self.username = kwargs.get("username")
+            self.password = kwargs.get("password")
+
+            # Username must not be an email
+            if "@" in self.username:
+                print("Username cannot be provided as email.")
                 self.username = None
-                self.password = None
 
-            first_time = False
+            # We can get the username from the Rumble Live Stream API
+            if not self.username and self.rum_api:
+                self.username = self.rum_api.username
+                print("Actor username obtained from Live Stream API:", self.username)
 
-        self.chat = ChatAPI(self.stream_id, self.servicephp)
+            # Sign in to chat
+            first_time = True
+            while first_time or not (self.username and self.password):
+                # Ask user for credentials as needed
+                if not self.username:
+                    self.username = input("Actor username: ")
+                if not self.password:
+                    self.password = getpass("Actor password: ")
+
+                try:
+                    self.servicephp = servicephp.ServicePHP(self.username)
+                    twofa = self.servicephp.login_basic(self.password)
+                    if twofa:
+                        self.handle_2fa(twofa)
+                # Login failed
+                except AssertionError as e:
+                    print("Error. Login failed with provided credentials:", e)
+                    self.username = None
+                    self.password = None
+
+                first_time = False
+
+        # Connect to chat, unless an already connected chat API was passed
+        self.chat = kwargs.get("chat") or ChatAPI(self.stream_id, self.servicephp)
         self.chat.clear_mailbox()
 
         # The maximum age of a message before we will not process it
         self.max_inbox_age = kwargs.get("max_inbox_age", static.Message.max_inbox_age)
 
+        # How far behind chat we can fall before skipping each class of message action
+        self.shedding_lags = {
+            static.Message.Shedding.cosmetic: kwargs.get("cosmetic_lag", static.Message.cosmetic_lag),
+            static.Message.Shedding.expensive: kwargs.get("expensive_lag", static.Message.expensive_lag),
+            }
+
+        # Smoothed age of messages when we get to them, in seconds
+        self.inbox_lag = 0.0
+
         # Scraper for getting some info
         self.scraper = scraping.Scraper(self.servicephp)
 
@@ -181,14 +251,36 @@ class RumbleChatActor:
         # Ignore these users when processing messages
         self.ignore_users = ignore_users
 
-        # History of the bot's messages so they do not get loop processed
-        self.sent_messages = []
-
-        # Thread exit pipe for above
-        self.__sent_messages_queue = queue.Queue()
+        # Recently sent messages of the bot so they do not get loop processed
+        self.sent_messages = utils.EchoTracker()
 
         # Messages waiting to be sent
-        self.outbox = queue.Queue(kwargs.get("max_outbox_size", static.Message.max_outbox_size))
+        self.outbox = utils.Outbox(kwargs.get("max_outbox_size", static.Message.max_outbox_size))
+
+        # Latency instrumentation of actions, commands and the outbox
+        self.metrics = metrics.Metrics()
+        self.metrics.set_gauge("outbox_depth", lambda: self.outbox.depth)
+        self.metrics.set_gauge("outbox_oldest_wait_seconds", lambda: self.outbox.oldest_wait)
+        self.metrics.set_gauge("outbox_expired", lambda: self.outbox.expired_count)
+        self.metrics.set_gauge("outbox_evicted", lambda: self.outbox.evicted_count)
+        self.metrics.set_gauge("outbox_deduplicated", lambda: self.outbox.deduplicated_count)
+        self.metrics.set_gauge("echoes_tracked", lambda: len(self.sent_messages))
+        self.metrics.set_gauge("inbox_lag_seconds", lambda: self.inbox_lag)
+
+        # Moderation calls to Rumble, made in the background
+        self.moderation_queue = utils.ModerationQueue(
+            self.chat,
+            workers = kwargs.get("moderation_workers", static.Moderation.workers),
+            metrics = self.metrics,
+            )
+        self.metrics.set_gauge("moderation_queue_depth", lambda: self.moderation_queue.depth)
+        self.metrics.set_gauge("moderation_coalesced_mutes", lambda: self.moderation_queue.coalesced_count)
+        self.metrics.set_gauge("moderation_failed", lambda: self.moderation_queue.failed_count)
+
+        # Periodically write the metrics for Prometheus
+        self.metrics_file = kwargs.get("metrics_file")
+        if self.metrics_file:
+            self.metrics.start_writer(self.metrics_file, kwargs.get("metrics_interval", static.Metrics.prometheus_interval))
 
         # Messages that we know are actually raid alerts
         self.known_raid_alert_messages = []
@@ -201,7 +293,7 @@ class RumbleChatActor:
         self.keep_running = True
 
         # Send an initialization message to get wether we are moderator or not
-        _, user = self.__send_message(static.Message.bot_prefix + init_message)
+        _, user = self._send_message(static.Message.bot_prefix + init_message)
         assert utils.is_staff(user), \
             "Actor cannot function without being channel staff"
 
@@ -209,16 +301,42 @@ class RumbleChatActor:
         self.last_message_send_time = time.time()
 
         # thread to send messages at timed intervals
-        self.sender_thread = threading.Thread(target = self._sender_loop, daemon = True)
-        self.sender_thread.start()
+        self.sender_thread = None
+        self._start_sender()
 
         # Functions that are to be called on each message,
         # must return False if the message was deleted
         self.message_actions = []
 
-        # Instances of ChatCommand, by name
+        # Message actions that do not need to finish before later actions and commands run
+        self.fire_and_forget_actions = set()
+
+        # Shedding classes of message actions that can be skipped when we fall behind chat
+        self.action_shedding = {}
+
+        # Wether or not to run fire-and-forget message actions on a worker pool
+        self.concurrent_actions = kwargs.get("concurrent_actions", False)
+        assert isinstance(self.concurrent_actions, bool), \
+            f"Argument concurrent_actions must be bool, not {type(self.concurrent_actions)}"
+
+        # Worker pool for fire-and-forget message actions, and a limit on how many can be queued up in it
+        self.__action_pool = None
+        self.__action_pool_slots = None
+        if self.concurrent_actions:
+            self.__action_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=kwargs.get("action_workers", static.Message.action_workers),
+                thread_name_prefix="message_action",
+                )
+            self.__action_pool_slots = threading.BoundedSemaphore(
+                kwargs.get("max_pending_actions", static.Message.max_pending_actions)
+                )
+
+        # Instances of ChatCommand, by lower case name
         self.chat_commands = {}
 
+        # Lower case names of commands, by lower case alias
+        self.command_aliases = {}
+
         # Wether or not to post an error message if an invalid command was called
         self.invalid_command_respond = kwargs.get("invalid_command_respond", False)
         assert isinstance(self.invalid_command_respond, bool), \
@@ -309,38 +427,50 @@ class RumbleChatActor:
         code = input("Enter the 2FA code: ")
         self.servicephp.login_second_factor(twofa, code)
 
-    def send_message(self, text):
+    def send_message(self, text, priority = static.Message.Priority.normal, ttl = None):
         """Send a message in chat (splits across lines if necessary)
 
         Args:
-            text (str): The message to send"""
+            text (str): The message to send
+            priority (int): How important the message is, see static.Message.Priority.
+                Higher priority messages are sent first, and evict lower priority ones if the outbox is full.
+                Defaults to static.Message.Priority.normal
+            ttl (int | float): How long the message may wait in the outbox before it is dropped unsent, in seconds.
+                Defaults to None, never expire."""
 
         text = static.Message.bot_prefix + text
         assert "\n" not in text, "Message cannot contain newlines"
         assert len(text) < static.Message.max_multi_len, "Message is too long"
         for subtext in textwrap.wrap(text, width = static.Message.max_len):
-            is_sent = False
-            while not is_sent:
-                try:
-                    self.outbox.put(subtext, block = False)
-                    # TODO: Print is not quite thread safe... sort of? It won't crash at least
-                    print("💬:", subtext)
-                    is_sent = True
-                except queue.Full:
-                    print("Error: Message send outbox is full, dropped message:\n\t", self.outbox.get())
+            dropped = self.outbox.put(subtext, priority = priority, ttl = ttl)
+            if dropped:
+                print("Error: Message send outbox is full, dropped message:\n\t", dropped)
+            # TODO: Print is not quite thread safe... sort of? It won't crash at least
+            print("💬:", subtext)
+
+    def _start_sender(self):
+        """Start the thread that sends messages from our outbox"""
+        self.sender_thread = threading.Thread(target = self._sender_loop, daemon = True)
+        self.sender_thread.start()
+
+    @property
+    def next_send_time(self):
+        """The earliest time we can send another message, based on the send cooldown"""
+        return self.last_message_send_time + static.Message.send_cooldown
 
     def _sender_loop(self):
-        """Constantly check our outbox and send any messages in it"""
+        """Sleep until we have a message to send and the send cooldown is over, then send it"""
         while self.keep_running:
-            #We have messages to send and it is time to send one
-            if time.time() - self.last_message_send_time > static.Message.send_cooldown:
-                try: #Must be nonblocking so we can shut down
-                    self.__send_message(self.outbox.get_nowait())
-                except queue.Empty:
-                    pass
-            time.sleep(0.1)
-
-    def __send_message(self, text):
+            text = self.outbox.get(ready_time = lambda: self.next_send_time)
+
+            #The outbox was closed for shutdown
+            if text is None:
+                return
+
+            self.metrics.observe("outbox", "wait", self.outbox.last_wait)
+            self._send_message(text)
+
+    def _send_message(self, text):
         """Send a message in chat (no safeties or suffix)
 
         Args:
@@ -349,39 +479,59 @@ class RumbleChatActor:
         assert len(text) < static.Message.max_len, \
             f"Message with prefix cannot be longer than {static.Message.max_len} characters"
 
-        self.__sent_messages_queue.put(text)
+        # Remember the text now, the echo could arrive before we get the ID back
+        self.sent_messages.add_text(text)
 
         self.last_message_send_time = time.time()
-        return self.chat.send_message(text, channel_id=self.channel)
+        with self.metrics.timer("outbox", "send"):
+            result = self.chat.send_message(text, channel_id=self.channel)
+        if result:
+            self.sent_messages.add_id(result[0])
+        return result
+
+    def run_in_background(self, target, *args):
+        """Run a long blocking operation, such as a clip save, without holding up the actor
+
+        Args:
+            target (callable): The operation to run.
+            *args: Arguments to pass to the operation."""
+
+        threading.Thread(target = target, args = args, daemon = True).start()
 
     @property
     def delete_message(self):
-        """Delete a message in the chat (passthrough to cocorum.ChatAPI)"""
-        return self.chat.delete_message
+        """Delete a message in the chat (queued, see utils.ModerationQueue, returns a concurrent.futures.Future)"""
+        return self.moderation_queue.delete_message
 
     @property
     def mute_user(self):
-        """Mute a user in the chat (passthrough to cocorum.ChatAPI)"""
-        return self.chat.mute_user
+        """Mute a user in the chat (queued, see utils.ModerationQueue, returns a concurrent.futures.Future)"""
+        return self.moderation_queue.mute_user
 
     @property
     def unmute_user(self):
-        """Unmute a user (passthrough to cocorum.ChatAPI)"""
-        return self.chat.unmute_user
+        """Unmute a user (queued, see utils.ModerationQueue, returns a concurrent.futures.Future)"""
+        return self.moderation_queue.unmute_user
 
     @property
     def pin_message(self):
-        """Pin a message by ID or li element (passthrough to cocorum.ChatAPI)"""
-        return self.chat.pin_message
+        """Pin a message by ID or li element (queued, see utils.ModerationQueue, returns a concurrent.futures.Future)"""
+        return self.moderation_queue.pin_message
 
     @property
     def unpin_message(self):
-        """Unpin the currently pinned message (passthrough to cocorum.ChatAPI)"""
-        return self.chat.unpin_message
+        """Unpin the currently pinned message (queued, see utils.ModerationQueue, returns a concurrent.futures.Future)"""
+        return self.moderation_queue.unpin_message
 
     def quit(self):
         """Shut down everything"""
         self.keep_running = False
+        self.outbox.close()
+        self.moderation_queue.close()
+        if self.metrics_file:
+            self.metrics.stop_writer()
+        if self.__action_pool:
+            self.__action_pool.shutdown(wait=False, cancel_futures=True)
         self.chat.close()
 
     def __run_if_command(self, message, act_props: dict):
@@ -391,22 +541,71 @@ class RumbleChatActor:
             message (cocorum.ChatAPI.Message): The message in question.
             act_props (dict): Properties of this message as recorded by message actors."""
 
+        command = self._find_command(message, act_props)
+        if command:
+            with self.metrics.timer("command", command.name):
+                command.call(message, act_props)
+
+    def get_command(self, name: str):
+        """Get a registered command by name or alias, case-insensitively
+
+        Args:
+            name (str): The name or alias of the command, without the command prefix.
+
+        Returns:
+            Command (commands.ChatCommand | None): The command, or None if there is no such command."""
+
+        name = name.lower()
+        return self.chat_commands.get(self.command_aliases.get(name, name))
+
+    def _route_command(self, message):
+        """Tokenize a message once if it calls a command, for act_props["command"]
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message in question.
+
+        Returns:
+            Call (commands.CommandCall | None): The tokenized call, or None if the message is not a command."""
+
         #Not a command
-        if not message.text.startswith(static.Message.command_prefix):
-            return
+        if not message.text.startswith(static.Message.command_prefix) or not message.text.strip(static.Message.command_prefix):
+            return None
 
-        #Get command name
-        name = message.text.split()[0].removeprefix(static.Message.command_prefix)
+        from . import commands
+
+        call = commands.CommandCall.from_text(message.text)
+        call.command = self.get_command(call.name)
+        return call
+
+    def _find_command(self, message, act_props: dict):
+        """Get the registered command a message calls, if any
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message in question.
+            act_props (dict): Properties of this message, with the tokenized call from _route_command() if it is one.
+
+        Returns:
+            Command (commands.ChatCommand | None): The called command, or None if the message is not a valid command."""
+
+        call = act_props.get("command")
+
+        #Not a command
+        if not call:
+            return None
 
         #Is not a valid command
-        if name not in self.chat_commands:
+        if not call.command:
             if self.invalid_command_respond:
-                self.send_message(f"@{message.user.username} That is not a registered command.")
-            return
+                self.send_message(
+                    f"@{message.user.username} That is not a registered command.",
+                    priority = static.Message.Priority.low,
+                    ttl = static.Message.notice_ttl,
+                    )
+            return None
 
-        self.chat_commands[name].call(message, act_props)
+        return call.command
 
-    def register_command(self, command, name = None, help_message = None):
+    def register_command(self, command, name = None, help_message = None, aliases = None):
         """Register a command
 
         Args:
@@ -415,37 +614,63 @@ class RumbleChatActor:
                 Defaults to None, use the ChatCommand name.
             help_message (str): Help message for this command.
                 Defaults to None, use the ChatCommand help message (cannot override).
+            aliases (list): Other names the command can be called by, added to the ChatCommand aliases.
+                Defaults to None, only the ChatCommand aliases.
             """
+        from . import commands
+
         #Is a ChatCommand instance
         if isinstance(command, commands.ChatCommand):
             if name and name != command.name:
                 print(f"Overriding command name ''{command.name}' with '{name}'")
                 command.name = name
 
-            self.chat_commands[command.name] = command
-
         #Is a callable
         elif callable(command):
             assert name, "Name cannot be None if command is a callable"
             assert " " not in name, "Name cannot contain spaces"
-            self.chat_commands[name] = commands.ChatCommand(name = name, actor = self, target = command)
+            command = commands.ChatCommand(name = name, actor = self, target = command)
 
         else:
             raise TypeError(f"Command must be of type ChatCommand or a callable, not {type(command)}.")
 
+        for alias in aliases or []:
+            assert " " not in alias, "Alias cannot contain spaces"
+            if alias not in command.aliases:
+                command.aliases.append(alias)
+
+        #Names are case-insensitive
+        self.chat_commands[command.name.lower()] = command
+        for alias in command.aliases:
+            assert alias.lower() not in self.chat_commands, f"Alias '{alias}' is already the name of a command"
+            self.command_aliases[alias.lower()] = command.name.lower()
+
         #A specific help message was provided
         if help_message:
-            assert not self.chat_commands[name].help_message, "ChatCommand has internal help message already set, cannot override"
-            self.chat_commands[name].help_message = help_message
+            assert not command.help_message, "ChatCommand has internal help message already set, cannot override"
+            command.help_message = help_message
 
-    def register_message_action(self, action):
+    def register_message_action(self, action, gating = None, shedding = None):
         """Register an action to be run on every message
 
         Args:
             action (callable | object):
                 - Action must be a callable or have an action() attribute.
                 - On run, action will be passed cocorum.ssechat.SSEChatMessage() and this actor instance.
-                - Action should return a dictionary of action properties (full documentation pending, things like {"deleted" : True})."""
+                - Action should return a dictionary of action properties (full documentation pending, things like {"deleted" : True}).
+            gating (bool): Wether the action must finish before later actions and commands run on the message.
+                Gating actions may delete messages or set action properties that others depend on.
+                Fire-and-forget (non-gating) actions run on the worker pool if concurrent_actions is on,
+                are passed a copy of the action properties, and have their returned properties discarded.
+                Defaults to None, use the action's gating attribute if it has one, otherwise True.
+            shedding (str): Class of the action for skipping it when we fall behind chat, see static.Message.Shedding.
+                Defaults to None, use the action's shedding attribute if it has one, otherwise essential."""
+
+        if gating is None:
+            gating = getattr(action, "gating", True)
+
+        if shedding is None:
+            shedding = getattr(action, "shedding", static.Message.Shedding.essential)
 
         if hasattr(action, "action"):
             action = action.action
@@ -453,6 +678,12 @@ class RumbleChatActor:
         assert callable(action), "Action must be a callable or have an action() attribute"
         self.message_actions.append(action)
 
+        if not gating:
+            self.fire_and_forget_actions.add(action)
+
+        if shedding != static.Message.Shedding.essential:
+            self.action_shedding[action] = shedding
+
     @property
     def raid_action(self):
         """The callable we are supposed to run on raids"""
@@ -475,20 +706,67 @@ class RumbleChatActor:
         Args:
             message (cocorum.ChatAPI.Message): The message to send to actions and check for commands"""
 
-        #Skip messages that are too old
-        if time.time() - message.time > self.max_inbox_age:
-            print(f"Error: Message processing is behind. Skipped message:\n{message.text}\n\t- {message.user.username}")
+        if not self._accept_message(message):
             return
 
+        #Tokenize a command call once, for actions and the command alike
+        call = self._route_command(message)
+        act_props_all = {"command": call} if call else {}
+        deferred_actions = []
+        shed = self._shed_classes(message)
+        for action in self.message_actions:
+            #The message got deleted
+            if message.deleted:
+                return
+
+            #We are behind chat, and this action can be skipped
+            if self.action_shedding.get(action) in shed:
+                self.metrics.count("shed", metrics.callable_name(action))
+                continue
+
+            #Fire-and-forget actions wait until the gating ones have passed the message
+            if self.__action_pool and action in self.fire_and_forget_actions:
+                deferred_actions.append(action)
+                continue
+
+            act_props_all.update(self._run_action(action, message, act_props_all))
+            if act_props_all.get("deleted"):
+                return
+
+        for action in deferred_actions:
+            self.__submit_action(action, message, act_props_all.copy())
+
+        self.__run_if_command(message, act_props_all)
+
+    def _accept_message(self, message):
+        """Check if a message should go on to actions and commands, handling it if it should not
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message in question.
+
+        Returns:
+            Result (bool): Should the message be passed to actions and commands?"""
+
+        #Measure how far behind chat we are
+        lag = time.time() - message.time
+        self.inbox_lag += static.Message.lag_smoothing * (lag - self.inbox_lag)
+        self.metrics.observe("inbox", "lag", max(lag, 0))
+
+        #Skip messages that are too old, unless they are too important
+        if lag > self.max_inbox_age and not self._is_priority_message(message):
+            print(f"Error: Message processing is behind. Skipped message:\n{message.text}\n\t- {message.user.username}")
+            self.metrics.count("shed", "message")
+            return False
+
         #Ignore messages that are from our account and match ones we sent before
-        if message.user.username == self.username and message.text in self.sent_messages:
-            return
+        if message.user.username == self.username and self.sent_messages.consume(message):
+            return False
 
         #the message is actually a raid alert, take raid action on it, nothing more
         if message.raid_notification:
             self.known_raid_alert_messages.append(message)
             self.raid_action(message, self)
-            return
+            return False
 
         #If the message is from the same account as us, consider it in message send cooldown
         if message.user.username == self.username:
@@ -496,45 +774,421 @@ class RumbleChatActor:
 
         #Ignore messages that are in the ignore_users list
         if message.user.username in self.ignore_users:
+            return False
+
+        return True
+
+    @staticmethod
+    def _is_priority_message(message):
+        """Check if a message must be fully processed no matter how far behind chat we are
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message in question.
+
+        Returns:
+            Result (bool): Is the message a paid rant, a gift, a raid alert, or from staff?"""
+
+        return bool(
+            message.is_rant
+            or message.gift_purchase_notification
+            or message.raid_notification
+            or utils.is_staff(message.user)
+            )
+
+    def _shed_classes(self, message):
+        """Get the classes of message actions to skip for a message, based on how far behind chat we are
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message in question.
+
+        Returns:
+            Classes (set): Shedding classes of message actions to skip, see static.Message.Shedding."""
+
+        if self._is_priority_message(message):
+            return set()
+
+        return {shedding for shedding, lag in self.shedding_lags.items() if self.inbox_lag >= lag}
+
+    def _run_action(self, action, message, act_props: dict):
+        """Run a single message action
+
+        Args:
+            action (callable): The message action to run.
+            message (cocorum.ChatAPI.Message): The message to run the action on.
+            act_props (dict): Properties of this message as recorded by previous message actions.
+
+        Returns:
+            act_props (dict): The new action properties from this action."""
+
+        with self.metrics.timer("action", metrics.callable_name(action)):
+            act_props_one = action(message, act_props, self)
+
+        return self._check_act_props(action, act_props_one)
+
+    @staticmethod
+    def _check_act_props(action, act_props_one):
+        """Make sure the return value of a message action is valid action properties
+
+        Args:
+            action (callable): The message action that ran.
+            act_props_one (dict): What the action returned.
+
+        Returns:
+            act_props (dict): The new action properties from this action."""
+
+        #Legacy message action return support
+        if act_props_one is None:
+            return {}
+        if not isinstance(act_props_one, dict):
+            print(f"Warning: message action {action} did not return valid action properties, but rather {act_props_one}. Compensating with blank action properties.")
+            return {}
+
+        return act_props_one
+
+    def __submit_action(self, action, message, act_props: dict):
+        """Run a fire-and-forget message action on the worker pool
+
+        Args:
+            action (callable): The message action to run.
+            message (cocorum.ChatAPI.Message): The message to run the action on.
+            act_props (dict): A copy of the properties of this message as recorded by the gating actions."""
+
+        #The pool is saturated, skip rather than stall the mainloop
+        if not self.__action_pool_slots.acquire(blocking = False):
+            print(f"Error: Message action pool is full. Skipped {action} for message:\n{message.text}\n\t- {message.user.username}")
+            return
+
+        try:
+            future = self.__action_pool.submit(self._run_action, action, message, act_props)
+        except RuntimeError:  # The pool has been shut down
+            self.__action_pool_slots.release()
             return
 
-        act_props_all = {}
+        future.add_done_callback(self.__action_done)
+
+    def __action_done(self, future):
+        """Clean up after a fire-and-forget message action finishes
+
+        Args:
+            future (concurrent.futures.Future): The future of the finished action."""
+
+        self.__action_pool_slots.release()
+        if not future.cancelled() and future.exception():
+            print("Error: Fire-and-forget message action failed:", repr(future.exception()))
+
+    def mainloop(self):
+        """Run the actor forever"""
+        try:
+            while self.keep_running:
+                m = self.chat.get_message()
+                if not m:  # Chat has closed
+                    self.keep_running = False
+                    return
+                with self.metrics.timer("message", "process"):
+                    self.__process_message(m)
+
+        except KeyboardInterrupt:
+            print("KeyboardInterrupt shutdown.")
+            self.quit()
+
+
+class AsyncRumbleChatActor(RumbleChatActor):
+    """Actor that interacts with Rumble chat, running on an asyncio event loop"""
+
+    def __init__(self, *args, **kwargs):
+        """Actor that interacts with Rumble chat, running on an asyncio event loop.
+    Instance this object, register all chat commands, message actions and timers, then call its mainloop() method,
+    or await its run() method from your own event loop.
+
+    Message actions and command targets may be coroutine functions, in which case they are awaited on the loop.
+    Regular callables are run in the loop's default executor, so blocking calls in them do not stall the loop.
+    Fire-and-forget message actions always run concurrently as tasks.
+    Takes the same arguments as RumbleChatActor."""
+
+        # The running event loop, known once run() starts
+        self.__loop = None
+
+        # Set when the outbox may have messages in it
+        self.__outbox_ready = None
+
+        # Messages read from chat, waiting to be processed
+        self.__inbox = None
+
+        # Callables to run on a timed basis, as (callable, interval) pairs
+        self.__timers = []
+
+        # Running tasks, kept so they are not garbage collected
+        self.__tasks = set()
+
+        # How many fire-and-forget action tasks are running
+        self.__running_actions = 0
+
+        super().__init__(*args, **kwargs)
+
+        # Limit on how many fire-and-forget actions can be running at once
+        self.__max_pending_actions = kwargs.get("max_pending_actions", static.Message.max_pending_actions)
+
+    def _start_sender(self):
+        """The outbox is sent from a task on the event loop instead of a thread"""
+
+    def add_timer(self, callback, interval):
+        """Run a callable on a timed basis while the actor is running
+
+        Args:
+            callback (callable): The coroutine function or regular callable to run, passed no arguments.
+                Use this with the tick() methods of TimedMessagesManager, Thanker and ClipUploader
+                (instanced with start_thread = False) to run them on the event loop.
+            interval (int | float): How long to wait between runs, in seconds."""
+
+        assert callable(callback), "Timer callback must be a callable"
+        assert interval > 0, "Timer interval must be greater than zero"
+        self.__timers.append((callback, interval))
+
+        # We are already running, start the timer now
+        if self.__loop:
+            self.__loop.call_soon_threadsafe(self.__spawn, self.__timer_loop(callback, interval))
+
+    def send_message(self, text, priority = static.Message.Priority.normal, ttl = None):
+        """Send a message in chat (splits across lines if necessary)
+
+        Args:
+            text (str): The message to send
+            priority (int): How important the message is, see static.Message.Priority.
+                Defaults to static.Message.Priority.normal
+            ttl (int | float): How long the message may wait in the outbox before it is dropped unsent, in seconds.
+                Defaults to None, never expire."""
+
+        super().send_message(text, priority = priority, ttl = ttl)
+
+        # Wake up the outbox task, from whatever thread we were called on
+        loop = self.__loop
+        if loop and not loop.is_closed():
+            loop.call_soon_threadsafe(self.__outbox_ready.set)
+
+    def run_in_background(self, target, *args):
+        """Run a long blocking operation, such as a clip save, without holding up the actor
+
+        Args:
+            target (callable): The operation to run.
+            *args: Arguments to pass to the operation."""
+
+        # Not running on the loop yet
+        if not self.__loop:
+            super().run_in_background(target, *args)
+            return
+
+        self.__loop.call_soon_threadsafe(self.__spawn, asyncio.to_thread(target, *args))
+
+    def quit(self):
+        """Shut down everything"""
+        loop = self.__loop
+        super().quit()
+
+        # Wake up the tasks so they see that we are done
+        if loop and not loop.is_closed():
+            loop.call_soon_threadsafe(self.__outbox_ready.set)
+            loop.call_soon_threadsafe(self.__inbox.put_nowait, None)
+
+    def __spawn(self, coro):
+        """Start a task and keep a reference to it until it is done
+
+        Args:
+            coro (coroutine): The coroutine to run.
+
+        Returns:
+            Task (asyncio.Task): The started task."""
+
+        task = self.__loop.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__task_done)
+        return task
+
+    def __task_done(self, task):
+        """Clean up after a task finishes
+
+        Args:
+            task (asyncio.Task): The finished task."""
+
+        self.__tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            print("Error: Background task failed:", repr(task.exception()))
+
+    def __action_task_done(self, task):
+        """Count a fire-and-forget action task as finished
+
+        Args:
+            task (asyncio.Task): The finished task."""
+
+        self.__running_actions -= 1
+
+    def __reader_loop(self, loop, inbox):
+        """Read messages from chat and pass them to the event loop.
+    The SSE chat stream only offers blocking reads, so this runs on its own thread.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): The event loop the actor runs on.
+        inbox (asyncio.Queue): The queue to pass messages to."""
+
+        while self.keep_running:
+            m = self.chat.get_message()
+
+            # The actor stopped while we were waiting for a message
+            if not self.keep_running:
+                return
+
+            try:
+                loop.call_soon_threadsafe(inbox.put_nowait, m)
+            except RuntimeError:  # The event loop has closed
+                return
+
+            # Chat has closed
+            if not m:
+                return
+
+    async def __sender_task(self):
+        """Send messages from our outbox as they arrive and the cooldown allows"""
+        while self.keep_running:
+            # Wait out the send cooldown
+            wait = self.next_send_time - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            try:
+                text = self.outbox.get_nowait()
+
+            # Sleep until send_message() wakes us
+            except queue.Empty:
+                self.__outbox_ready.clear()
+                if self.outbox.empty():
+                    await self.__outbox_ready.wait()
+                continue
+
+            self.metrics.observe("outbox", "wait", self.outbox.last_wait)
+            await asyncio.to_thread(self._send_message, text)
+
+    async def __timer_loop(self, callback, interval):
+        """Run a timer callback repeatedly
+
+        Args:
+            callback (callable): The coroutine function or regular callable to run.
+            interval (int | float): How long to wait between runs, in seconds."""
+
+        while self.keep_running:
+            if inspect.iscoroutinefunction(callback):
+                await callback()
+            else:
+                await asyncio.to_thread(callback)
+            await asyncio.sleep(interval)
+
+    async def _run_action_async(self, action, message, act_props: dict):
+        """Run a single message action, without blocking the event loop
+
+        Args:
+            action (callable): The message action to run.
+            message (cocorum.ChatAPI.Message): The message to run the action on.
+            act_props (dict): Properties of this message as recorded by previous message actions.
+
+        Returns:
+            act_props (dict): The new action properties from this action."""
+
+        if inspect.iscoroutinefunction(action):
+            with self.metrics.timer("action", metrics.callable_name(action)):
+                act_props_one = await action(message, act_props, self)
+            return self._check_act_props(action, act_props_one)
+
+        return await asyncio.to_thread(self._run_action, action, message, act_props)
+
+    async def _process_message_async(self, message):
+        """Process a single SSE Chat message
+
+        Args:
+            message (cocorum.ChatAPI.Message): The message to send to actions and check for commands"""
+
+        if not self._accept_message(message):
+            return
+
+        #Tokenize a command call once, for actions and the command alike
+        call = self._route_command(message)
+        act_props_all = {"command": call} if call else {}
+        deferred_actions = []
+        shed = self._shed_classes(message)
         for action in self.message_actions:
             #The message got deleted
             if message.deleted:
                 return
 
-            act_props_one = action(message, act_props_all, self)
+            #We are behind chat, and this action can be skipped
+            if self.action_shedding.get(action) in shed:
+                self.metrics.count("shed", metrics.callable_name(action))
+                continue
 
-            #Legacy message action return support
-            if act_props_one is None:
-                act_props_one = {}
-            elif not isinstance(act_props_one, dict):
-                print(f"Warning: message action {action} did not return valid action properties, but rather {act_props_one}. Compensating with blank action properties.")
-                act_props_one = {}
+            #Fire-and-forget actions wait until the gating ones have passed the message
+            if action in self.fire_and_forget_actions:
+                deferred_actions.append(action)
+                continue
 
-            act_props_all.update(act_props_one)
+            act_props_all.update(await self._run_action_async(action, message, act_props_all))
             if act_props_all.get("deleted"):
                 return
 
-        self.__run_if_command(message, act_props_all)
+        for action in deferred_actions:
+            #Too many actions are still running, skip rather than pile up
+            if self.__running_actions >= self.__max_pending_actions:
+                print(f"Error: Too many message actions running. Skipped {action} for message:\n{message.text}\n\t- {message.user.username}")
+                continue
 
-    def empty_sent_message_queue(self):
-        """Move sent messages from the thread exit pipe to the list"""
-        #WARNING: This is only safe if nobody else gets from this queue!
-        while not self.__sent_messages_queue.empty():
-            self.sent_messages.append(self.__sent_messages_queue.get())
+            self.__running_actions += 1
+            self.__spawn(self._run_action_async(action, message, act_props_all.copy())).add_done_callback(self.__action_task_done)
+
+        command = self._find_command(message, act_props_all)
+        if not command:
+            return
+
+        with self.metrics.timer("command", command.name):
+            #Command checks are quick, but a regular run method may block
+            if inspect.iscoroutinefunction(command.run):
+                result = command.call(message, act_props_all)
+            else:
+                result = await asyncio.to_thread(command.call, message, act_props_all)
+
+            #The command target was a coroutine function
+            if inspect.isawaitable(result):
+                await result
+
+    async def run(self):
+        """Run the actor on the current event loop until it quits or chat closes"""
+        self.__loop = asyncio.get_running_loop()
+        self.__outbox_ready = asyncio.Event()
+        self.__inbox = asyncio.Queue()
+
+        # Messages may have been queued before we started
+        self.__outbox_ready.set()
+
+        threading.Thread(target = self.__reader_loop, args = (self.__loop, self.__inbox), daemon = True).start()
+        self.__spawn(self.__sender_task())
+        for callback, interval in self.__timers:
+            self.__spawn(self.__timer_loop(callback, interval))
 
-    def mainloop(self):
-        """Run the actor forever"""
         try:
             while self.keep_running:
-                self.empty_sent_message_queue()
-                m = self.chat.get_message()
+                m = await self.__inbox.get()
                 if not m:  # Chat has closed
                     self.keep_running = False
-                    return
-                self.__process_message(m)
+                    break
+                with self.metrics.timer("message", "process"):
+                    await self._process_message_async(m)
+
+        finally:
+            self.keep_running = False
+            for task in list(self.__tasks):
+                task.cancel()
+            self.__loop = None
+
+    def mainloop(self):
+        """Run the actor forever on a new event loop"""
+        try:
+            asyncio.run(self.run())
 
         except KeyboardInterrupt:
             print("KeyboardInterrupt shutdown.")
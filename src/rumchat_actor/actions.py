@@ -5,21 +5,21 @@ Actions commonly run on chat messages
 S.D.G"""
 
 # import socket
+import collections
+import importlib.util
 import threading
 import time
-from pygame import mixer
-import talkey
-from . import static
+from . import audio, moderation, utils, static
 
-try:
-    import ollama
-    OLLAMA_IMPORTED = True
-except ModuleNotFoundError:
-    OLLAMA_IMPORTED = False
+# Heavy and optional dependencies, imported on first use
+mixer = utils.lazy_import("pygame.mixer", extra="audio")
+OLLAMA_IMPORTED = importlib.util.find_spec("ollama") is not None
 
 
 def ollama_message_moderate(message, act_props, actor):
-    """Moderate a message with Ollama, deleting if needed
+    """Moderate a message with Ollama, deleting if needed.
+    Messages are batched with others and moderated in the background by a shared moderation.BatchModerator,
+    except that messages calling a command wait for their verdict. Instance your own BatchModerator to change its settings.
 
     Args:
         message (cocorum.chatapi.Message): The chat message to run this action on.
@@ -31,59 +31,207 @@ def ollama_message_moderate(message, act_props, actor):
 
     assert OLLAMA_IMPORTED, "The Ollama library and a working Ollama installation are required for ollama_message_moderate"
 
-    # Message was blank
-    if not message.text.strip():
-        print("Message was blank.")
-        return {}
+    return moderation.default_batch_moderator().action(message, act_props, actor)
 
-    # User has an immunity badge
-    if True in [badge in message.user.badges for badge in static.Moderation.staff_badges]:
-        print(f"{message.user.username} is staff, skipping LLM check.")
-        return {}
+ollama_message_moderate.shedding = static.Message.Shedding.expensive
 
-    # Get the LLM verdict
-    response = ollama.chat(model=static.AutoModerator.llm_model, messages=[
-        {"role": "system", "content": static.AutoModerator.llm_sys_prompt},
-        {"role": "user", "content": message.text},
-        ])
 
-    # Parse the verdict
-    try:
-        verdict = int(response["message"]["content"])
+class FloodGuard:
+    """Delete and escalatingly mute users who flood the chat or repeat themselves"""
 
-    # Verdict was not valid
-    except ValueError:
-        print(f"Bad verdict for {message.text} : {response["message"]["content"]}")
-        return {}
+    # Flood messages must be deleted before commands run
+    gating = True
 
-    # Response was not in expected format
-    except KeyError:
-        print(f"Could not get verdict for {message.text} : Response: {response}")
-        return {}
+    # Cheap, and protection matters most when chat is busy
+    shedding = static.Message.Shedding.essential
 
-    # Returned 1 for SFW
-    if verdict:
-        print("LLM verdicted as clean: " + message.text)
-        return {}
+    class UserRecord:
+        """Recent activity of one user"""
+        __slots__ = ("times", "last_text", "repeats", "last_repeat_time", "offenses", "last_offense_time")
 
-    # Returned 0 for NSFW
-    print("LLM verdicted as dirty: " + message.text)
-    actor.delete_message(message)
-    return {"deleted": True}
+        def __init__(self, max_messages: int):
+            # Ring buffer of the user's latest message times, one more than allowed so the first one over can be seen
+            self.times = collections.deque(maxlen = max_messages + 1)
+
+            # The user's latest normalized message text, and how many times in a row they sent it
+            self.last_text = None
+            self.repeats = 0
+            self.last_repeat_time = 0
+
+            # Offenses in a row, and when the latest one was
+            self.offenses = 0
+            self.last_offense_time = 0
+
+    def __init__(self, **kwargs):
+        """Delete and escalatingly mute users who flood the chat or repeat themselves.
+    Each user's message times are kept in a ring buffer, so checking a message is constant time,
+    and only the most recently active users are tracked, so memory stays bounded in huge chats.
+    Instance this object, then pass it to RumbleChatActor().register_message_action()
+
+    Args:
+        max_messages (int): Most messages a user may send within the window.
+            Defaults to static.FloodGuard.max_messages
+        window (float): The flood window in seconds.
+            Defaults to static.FloodGuard.window
+        max_duplicates (int): Most times a user may send the same message in a row.
+            Defaults to static.FloodGuard.max_duplicates
+        duplicate_window (float): How long a repeated message counts as a duplicate, in seconds.
+            Defaults to static.FloodGuard.duplicate_window
+        escalation (tuple): Mute level for each offense in a row, None to only delete the message.
+            Defaults to static.FloodGuard.escalation
+        offense_memory (float): How long an offense counts towards escalation, in seconds.
+            Defaults to static.FloodGuard.offense_memory
+        max_users (int): Most users to track.
+            Defaults to static.FloodGuard.max_users"""
+
+        self.max_messages = kwargs.get("max_messages", static.FloodGuard.max_messages)
+        self.window = kwargs.get("window", static.FloodGuard.window)
+        self.max_duplicates = kwargs.get("max_duplicates", static.FloodGuard.max_duplicates)
+        self.duplicate_window = kwargs.get("duplicate_window", static.FloodGuard.duplicate_window)
+        self.escalation = kwargs.get("escalation", static.FloodGuard.escalation)
+        self.offense_memory = kwargs.get("offense_memory", static.FloodGuard.offense_memory)
+        self.max_users = kwargs.get("max_users", static.FloodGuard.max_users)
+        assert self.escalation, "Escalation must have at least one level"
+        for level in self.escalation:
+            assert level is None or level in static.Moderation.mute_levels, f"Unknown mute level {level}"
+
+        # User records by username, least recently active first
+        self.users = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_record(self, username: str):
+        """Get the record of a user, creating it and forgetting the least recently active user if needed
+
+    Args:
+        username (str): The user's username.
+
+    Returns:
+        Record (FloodGuard.UserRecord): The user's record."""
+
+        record = self.users.get(username)
+        if record:
+            self.users.move_to_end(username)
+            return record
+
+        record = self.users[username] = self.UserRecord(self.max_messages)
+        if len(self.users) > self.max_users:
+            self.users.popitem(last = False)
+        return record
+
+    def check(self, username: str, text: str, now: float = None):
+        """Record a message and check it for flooding
+
+    Args:
+        username (str): The username of the message's author.
+        text (str): The message text.
+        now (float): The time of the message.
+            Defaults to None, the current time.
+
+    Returns:
+        Reason (str | None): "flood" or "duplicate" if the message breaks a limit, otherwise None."""
+
+        now = time.time() if now is None else now
+        key = moderation.normalize_text(text)
+        with self.__lock:
+            record = self.get_record(username)
+
+            # The ring buffer is full, so this is one message over the limit if its oldest is still within the window
+            record.times.append(now)
+            if len(record.times) > self.max_messages and now - record.times[0] <= self.window:
+                return "flood"
+
+            if key == record.last_text and now - record.last_repeat_time <= self.duplicate_window:
+                record.repeats += 1
+            else:
+                record.last_text = key
+                record.repeats = 1
+            record.last_repeat_time = now
+
+            if record.repeats > self.max_duplicates:
+                return "duplicate"
+
+        return None
+
+    def offend(self, username: str, now: float = None):
+        """Count an offense by a user and get the discipline for it
+
+    Args:
+        username (str): The user's username.
+        now (float): The time of the offense.
+            Defaults to None, the current time.
+
+    Returns:
+        Level (str | None): The mute level to apply, or None to only delete the message."""
+
+        now = time.time() if now is None else now
+        with self.__lock:
+            record = self.get_record(username)
+
+            # Messages already on their way when we disciplined the user do not count as new offenses
+            if record.offenses and now - record.last_offense_time <= self.window:
+                return None
+
+            if now - record.last_offense_time > self.offense_memory:
+                record.offenses = 0
+
+            record.offenses += 1
+            record.last_offense_time = now
+            return self.escalation[min(record.offenses, len(self.escalation)) - 1]
+
+    def action(self, message, act_props, actor):
+        """Check a message for flooding, deleting it and muting the user if needed
+
+    Args:
+        message (cocorum.chatapi.Message): The chat message to run this action on.
+        act_props (dict): Action properties, aka metadata about what other things did with this message
+        actor (RumbleChatActor): The chat actor.
+
+    Returns:
+        act_props (dict): Dictionary of recorded properties from running this action."""
+
+        # User has an immunity badge
+        if utils.is_staff(message.user):
+            return {}
+
+        # Judge by when the message was sent, so a backlog worked through at once is not mistaken for a flood
+        reason = self.check(message.user.username, message.text, now = message.time)
+        if not reason:
+            return {}
+
+        level = self.offend(message.user.username, now = message.time)
+        print(f"{message.user.username} sent a {reason} message: {message.text}")
+        actor.delete_message(message)
+        actor.metrics.count("flood", reason)
+
+        if level:
+            print(f"Muting {message.user.username} at level {level}")
+            actor.mute_user(message.user.username, **static.Moderation.mute_level_args[level])
+            return {"deleted": True, "flood": reason, "muted": level}
+
+        return {"deleted": True, "flood": reason}
 
 
 class RantTTSManager():
     """System to TTS rant messages, with threshhold settings"""
 
-    def __init__(self):
+    def __init__(self, engine = None):
         """System to TTS rant messages, with threshhold settings.
-    Instance this object, then pass it to RumbleChatActor().register_message_action()"""
+    Rants are spoken in the background by a TTS engine, the biggest first.
+    Instance this object, then pass it to RumbleChatActor().register_message_action()
+
+    Args:
+        engine (audio.TTSEngine): The TTS engine to speak with.
+            Defaults to None, the shared audio.default_tts_engine()"""
 
         # The amount a rant must be to be TTS-ed
         self.__tts_amount_threshold = 0
 
-        # The TTS callable to use
-        self.__say = talkey.Talkey().say
+        # The TTS engine, and the callable it should speak rants with
+        self.engine = engine if engine is not None else audio.default_tts_engine()
+        self.__say = None
+
+        # The actor whose metrics the engine reports to
+        self.__reporting_to = None
 
     @property
     def tts_amount_threshold(self):
@@ -120,12 +268,21 @@ class RantTTSManager():
     Returns:
         act_props (dict): Dictionary of additional recorded properties from running this action."""
 
+        # Report the engine's queue and latencies with the actor's metrics
+        if self.__reporting_to is not actor:
+            self.__reporting_to = actor
+            self.engine.report_metrics(actor.metrics)
+
         # Do not overlap sounds
-        if act_props["sound"]:
+        if act_props.get("sound"):
             return {}
 
         if message.is_rant and message.rant_price_cents >= self.__tts_amount_threshold:
-            self.__say(message.text)
+            spoken = self.engine.speak(message.text, self.__say, priority = message.rant_price_cents)
+
+            # Already resolved without speaking means the backlog was full and the rant was dropped
+            if spoken.done() and (spoken.exception() or not spoken.result()):
+                return {}
             return {"sound": True}
         return {}
 
@@ -133,14 +290,17 @@ class RantTTSManager():
 class TimedMessagesManager():
     """System to send messages on a timed basis"""
 
-    def __init__(self, actor, messages: iter, delay=60, in_between=0):
+    def __init__(self, actor, messages: iter, delay=60, in_between=0, start_thread=True):
         """System to send messages on a timed basis. Instance this object, then pass it to RumbleChatActor().register_message_action()
 
     Args:
         actor (RumbleChatActor): The actor, to send the timed messages,
         messages (list): List of str messages to send
         delay (int): Time between messages in seconds
-        in_between (int): Number of messages that must be sent before we send another timed one"""
+        in_between (int): Number of messages that must be sent before we send another timed one
+        start_thread (bool): Start our own sender loop thread.
+            Pass False and give tick() to AsyncRumbleChatActor().add_timer() to run on the event loop instead.
+            Defaults to True."""
 
         self.actor = actor
         assert len(messages) > 0, "List of messages to send cannot be empty"
@@ -161,7 +321,8 @@ class TimedMessagesManager():
         # Start the sender loop thread
         self.running = True
         self.sender_thread = threading.Thread(target=self.sender_loop, daemon=True)
-        self.sender_thread.start()
+        if start_thread:
+            self.sender_thread.start()
 
     def action(self, message, act_props, actor):
         """Count the messages sent
@@ -177,40 +338,53 @@ class TimedMessagesManager():
         self.in_between_counter += 1
         return {}
 
-    def sender_loop(self):
-        """Continuously wait till it is time to send another message"""
-        while self.running:
-            # time to send a message?
-            if self.in_between_counter >= self.in_between and time.time() - self.last_send_time >= self.delay:
-                # Send a message
-                self.actor.send_message(self.messages[self.up_next_index])
+    def tick(self):
+        """Send another message if it is time to"""
+        # time to send a message?
+        if self.in_between_counter >= self.in_between and time.time() - self.last_send_time >= self.delay:
+            # Send a message
+            self.actor.send_message(self.messages[self.up_next_index], priority=static.Message.Priority.low)
 
-                # Up the index of the next message, with wrapping
-                self.up_next_index += 1
-                # self.messages should theoretically never change, so this is thread-safe
-                if self.up_next_index >= len(self.messages):
-                    self.up_next_index = 0
+            # Up the index of the next message, with wrapping
+            self.up_next_index += 1
+            # self.messages should theoretically never change, so this is thread-safe
+            if self.up_next_index >= len(self.messages):
+                self.up_next_index = 0
 
-                # Reset wait counters
-                self.in_between_counter = 0
-                self.last_send_time = time.time()
+            # Reset wait counters
+            self.in_between_counter = 0
+            self.last_send_time = time.time()
 
+    def sender_loop(self):
+        """Continuously wait till it is time to send another message"""
+        while self.running:
+            self.tick()
             time.sleep(1)
 
 
 class ChatBlipper:
     """Blip with chat activity, getting fainter as activity gets more common"""
 
-    def __init__(self, sound_filename: str, rarity_regen_time=60, stay_dead_time=10, rarity_reduce=0.1):
+    # Blips do not affect other actions or commands, so they need not hold up the message
+    gating = False
+
+    # Blips can be skipped when behind chat
+    shedding = static.Message.Shedding.cosmetic
+
+    def __init__(self, sound_filename: str, rarity_regen_time=60, stay_dead_time=10, rarity_reduce=0.1, bus=None):
         """Blip with chat activity, getting fainter as activity gets more common.
+    Blips are played on an audio bus, which coalesces bursts of them into one.
     Instance this object, then pass it to RumbleChatActor().register_message_action()
 
     Args:
         sound_filename (str): The filename of the blip sound to play.
         rarity_regen_time (int): How long before the blip volume regenerates to maximum, in seconds.
         stay_dead_time (int): Effectively more regen time, in seconds, but with the volume staying at zero for the duration.
-        rarity_reduce (float): How much a message reduces the volume in factor, ranging from >0 to 1."""
+        rarity_reduce (float): How much a message reduces the volume in factor, ranging from >0 to 1.
+        bus (audio.AudioBus): The audio bus to play blips on.
+            Defaults to None, the shared audio.default_audio_bus()"""
 
+        self.bus = bus if bus is not None else audio.default_audio_bus()
         self.sound = None
         self.load_sound(sound_filename)
         self.rarity_regen_time = rarity_regen_time
@@ -255,8 +429,7 @@ class ChatBlipper:
     Returns:
         act_props (dict): Dictionary of additional recorded properties from running this action."""
 
-        self.sound.set_volume(self.current_volume)
-        self.sound.play()
+        self.bus.blip(self.sound, self.current_volume)
         self.reduce_rarity()
         return {}
 
@@ -275,7 +448,10 @@ class Thanker(threading.Thread):
         subscriber_message (str): Message to format with the Cocorum Subscriber object.
             Defaults to static.Thank.DefaultMessages.subscriber
         gifted_subs_message (str): Message to format with the Cocorum GiftPurchaseNotification object.
-            Defaults to static.Thank.DefaultMessages.gifted_subs"""
+            Defaults to static.Thank.DefaultMessages.gifted_subs
+        start_thread (bool): Start checking for followers and subscribers on our own thread.
+            Pass False and give tick() to AsyncRumbleChatActor().add_timer() to run on the event loop instead.
+            Defaults to True."""
 
         super().__init__(daemon=True)
         self.actor = actor
@@ -288,7 +464,8 @@ class Thanker(threading.Thread):
         self.gifted_subs_message = kwargs.get("gifted_subs_message", static.Thank.DefaultMessages.gifted_subs)
 
         # Start the thread immediately
-        self.start()
+        if kwargs.get("start_thread", True):
+            self.start()
 
     def action(self, message, act_props, actor):
         """Check for subscription gifts, and thank for them
@@ -307,28 +484,40 @@ class Thanker(threading.Thread):
         if not gift:
             return
 
-        self.actor.send_message(self.gifted_subs_message.format(gift=gift))
+        self.actor.send_message(self.gifted_subs_message.format(gift=gift), priority=static.Message.Priority.high)
 
         return {}
 
+    @property
+    def tick_interval(self):
+        """How long to wait between checks, either the Rumble API refresh rate or the message sending cooldown"""
+        return max((self.rum_api.refresh_rate, static.Message.send_cooldown))
+
+    def tick(self):
+        """Check for new followers and subscribers once"""
+        # Thank all the new followers
+        for follower in self.rum_api.new_followers:
+            self.actor.send_message(self.follower_message.format(follower=follower), priority=static.Message.Priority.high)
+
+        # Thank all the new subscribers
+        for subscriber in self.rum_api.new_subscribers:
+            self.actor.send_message(self.follower_message.format(subscriber=subscriber), priority=static.Message.Priority.high)
+
     def run(self):
         """Continuously check for new followers and subscribers"""
         while self.actor.keep_running:
-            # Thank all the new followers
-            for follower in self.rum_api.new_followers:
-                self.actor.send_message(self.follower_message.format(follower=follower))
+            self.tick()
 
-            # Thank all the new subscribers
-            for subscriber in self.rum_api.new_subscribers:
-                self.actor.send_message(self.follower_message.format(subscriber=subscriber))
-
-            # Wait a bit, either the Rumble API refresh rate or the message sending cooldown
-            time.sleep(max((self.rum_api.refresh_rate, static.Message.send_cooldown)))
+            # Wait a bit
+            time.sleep(self.tick_interval)
 
 
 class UserAnnouncer:
     """Announce new users as they arrive in the chat"""
 
+    # Announcements can be skipped when behind chat
+    shedding = static.Message.Shedding.cosmetic
+
     def __init__(self, announcer: callable = None, known_users=[], special_announcers={}):
         """Announce new users as they arrive in the chat
 
@@ -0,0 +1,690 @@
+#!/usr/bin/env python3
+"""Audio
+
+Sound output engines that keep speech and sounds off the message loop.
+S.D.G."""
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import threading
+import time
+from . import utils, static
+
+# Heavy and optional dependencies, imported on first use
+mixer = utils.lazy_import("pygame.mixer", extra="audio")
+talkey = utils.lazy_import("talkey", extra="audio")
+
+
+class AudioBus:
+    """Scheduler of all sound output on a fixed pool of mixer channels, with priorities, ducking and blip coalescing"""
+
+    def __init__(self, **kwargs):
+        """Scheduler of all sound output on a fixed pool of mixer channels.
+    A sound that finds no free channel takes the one playing the lowest priority sound below it, or is dropped.
+    While speech is playing, lower priority sounds are ducked.
+    Blips within a short window are coalesced into one blip, louder for more blips.
+
+    Args:
+        channels (int): How many mixer channels to play on.
+            Defaults to static.Audio.channels
+        duck_volume (float): Volume factor of lower priority sounds while speech plays, from 0 to 1.
+            Defaults to static.Audio.duck_volume
+        blip_window (float): How long to coalesce blips for, in seconds.
+            Defaults to static.Audio.blip_window"""
+
+        self.duck_volume = kwargs.get("duck_volume", static.Audio.duck_volume)
+        self.blip_window = kwargs.get("blip_window", static.Audio.blip_window)
+
+        # Make sure PyGame mixer is initialized, then preallocate our channels
+        if not mixer.get_init():
+            mixer.init()
+        count = kwargs.get("channels", static.Audio.channels)
+        mixer.set_num_channels(max(count, mixer.get_num_channels()))
+        self.channels = [mixer.Channel(i) for i in range(count)]
+
+        # Priority and unducked volume of what each channel is playing
+        self.__playing = [(None, 1.0)] * count
+
+        # How many speeches want other sounds ducked right now
+        self.__ducking = 0
+
+        # Blips waiting to be coalesced, as sound: [sum of squared volumes, count]
+        self.__blips = {}
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.played_count = 0
+        self.stolen_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+
+        self.running = True
+        self.__thread = threading.Thread(target = self.__blip_loop, daemon = True)
+        self.__thread.start()
+
+    @property
+    def busy_channels(self):
+        """How many channels are playing"""
+        return sum(channel.get_busy() for channel in self.channels)
+
+    def __volume(self, priority, volume):
+        """The volume to play at, ducked if needed. Must hold the lock."""
+        if self.__ducking and priority < static.Audio.Priority.speech:
+            return volume * self.duck_volume
+        return volume
+
+    def __priority(self, index):
+        """The priority of the sound on a channel, -1 if it was not played through us. Must hold the lock."""
+        priority = self.__playing[index][0]
+        return -1 if priority is None else priority
+
+    def play(self, sound, priority: int = static.Audio.Priority.effect, volume: float = 1.0):
+        """Play a sound on a free channel, or on one playing something less important
+
+    Args:
+        sound (pygame.mixer.Sound): The sound to play.
+        priority (int): The priority of the sound, see static.Audio.Priority.
+            Defaults to static.Audio.Priority.effect
+        volume (float): The volume to play at, from 0 to 1.
+            Defaults to 1.0
+
+    Returns:
+        Channel (pygame.mixer.Channel | None): The channel it is playing on, or None if it was dropped."""
+
+        with self.__lock:
+            free = [i for i, channel in enumerate(self.channels) if not channel.get_busy()]
+            if free:
+                index = free[0]
+
+            # Take the channel of the lowest priority sound, if it is below ours
+            else:
+                # Sounds played outside the bus have no priority, so count them as the lowest
+                index = min(range(len(self.channels)), key = self.__priority)
+                if self.__priority(index) >= priority:
+                    self.dropped_count += 1
+                    return None
+                self.stolen_count += 1
+
+            channel = self.channels[index]
+            self.__playing[index] = (priority, volume)
+            channel.set_volume(self.__volume(priority, volume))
+            channel.play(sound)
+            self.played_count += 1
+            return channel
+
+    def blip(self, sound, volume: float = 1.0):
+        """Play a blip, coalesced with others of the same sound in the blip window
+
+    Args:
+        sound (pygame.mixer.Sound): The blip sound.
+        volume (float): The volume of this blip, from 0 to 1.
+            Defaults to 1.0"""
+
+        with self.__lock:
+            if sound in self.__blips:
+                self.coalesced_count += 1
+            pending = self.__blips.setdefault(sound, [0.0, 0])
+            pending[0] += volume ** 2
+            pending[1] += 1
+
+    def __blip_loop(self):
+        """Play coalesced blips at the end of each window until closed"""
+        while self.running:
+            time.sleep(self.blip_window)
+            with self.__lock:
+                blips, self.__blips = self.__blips, {}
+
+            # Blips add up like incoherent sounds, so the volume is the root of the summed squares
+            try:
+                for sound, (squared_volume, _) in blips.items():
+                    self.play(sound, static.Audio.Priority.blip, min(squared_volume ** 0.5, 1.0))
+            except Exception as e:
+                print("Error: Failed to play blips:", e)
+
+    def __apply_ducking(self):
+        """Set the volume of every channel for the current ducking. Must hold the lock."""
+        for channel, (priority, volume) in zip(self.channels, self.__playing):
+            if priority is not None:
+                channel.set_volume(self.__volume(priority, volume))
+
+    @contextlib.contextmanager
+    def ducking(self):
+        """Duck sounds below speech priority for the duration of the enclosed block, like while speaking"""
+        with self.__lock:
+            self.__ducking += 1
+            self.__apply_ducking()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__ducking -= 1
+                self.__apply_ducking()
+
+    def report_metrics(self, metrics):
+        """Report our channel use to a metrics registry
+
+    Args:
+        metrics (metrics.Metrics): The metrics registry to report to."""
+
+        metrics.set_gauge("audio_busy_channels", lambda: self.busy_channels)
+        metrics.set_gauge("audio_stolen", lambda: self.stolen_count)
+        metrics.set_gauge("audio_dropped", lambda: self.dropped_count)
+        metrics.set_gauge("audio_coalesced_blips", lambda: self.coalesced_count)
+
+    def close(self):
+        """Stop playing blips"""
+        self.running = False
+
+
+class TTSCache:
+    """On-disk cache of rendered speech, so repeated phrases play back without running the synthesizer"""
+
+    def __init__(self, directory: str = static.TTS.cache_directory, **kwargs):
+        """On-disk cache of rendered speech, so repeated phrases play back without running the synthesizer.
+    Speech is rendered by Talkey into the cache, keyed by voice and normalized text,
+    and played through the PyGame mixer. The least recently used renders are evicted past the size budget.
+
+    Args:
+        directory (str): Where to keep the rendered speech.
+            Defaults to static.TTS.cache_directory
+        max_bytes (int): Size budget of the cache on disk.
+            Defaults to static.TTS.cache_max_bytes
+        voices (dict): Voice name : talkey.Talkey instance or dict of Talkey() arguments.
+            Defaults to a "default" voice with the default Talkey() settings.
+        loaded_sounds (int): How many rendered sounds to keep loaded in the mixer.
+            Defaults to static.TTS.loaded_sounds
+        bus (AudioBus): The audio bus to play speech on.
+            Defaults to None, play directly on the mixer."""
+
+        self.directory = directory
+        self.max_bytes = kwargs.get("max_bytes", static.TTS.cache_max_bytes)
+        self.voices = dict(kwargs.get("voices", {}))
+        self.voices.setdefault("default", {})
+        self.loaded_sounds = kwargs.get("loaded_sounds", static.TTS.loaded_sounds)
+        self.bus = kwargs.get("bus")
+        os.makedirs(directory, exist_ok = True)
+
+        # Rendered files by key, least recently used first, with their sizes
+        self.__files = collections.OrderedDict()
+        for entry in sorted(os.scandir(directory), key = lambda entry: entry.stat().st_mtime):
+            if entry.is_file():
+                self.__files[os.path.splitext(entry.name)[0]] = (entry.path, entry.stat().st_size)
+        self.size = sum(size for _, size in self.__files.values())
+
+        # Sounds loaded into the mixer by key, least recently used first
+        self.__sounds = collections.OrderedDict()
+
+        # Talkey is not thread safe, and renders must not race each other
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evicted_count = 0
+
+        self.__evict()
+
+    def __len__(self):
+        """How many renders are cached"""
+        return len(self.__files)
+
+    @property
+    def hit_rate(self):
+        """Fraction of requested speech that was already rendered"""
+        total = self.hit_count + self.miss_count
+        return self.hit_count / total if total else 0.0
+
+    @staticmethod
+    def key(text: str, voice: str = "default"):
+        """Get the cache key of a text in a voice
+
+    Args:
+        text (str): The text.
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Key (str): The key, usable as a filename."""
+
+        normalized = " ".join(text.split()).casefold()
+        return hashlib.sha1(f"{voice}\0{normalized}".encode()).hexdigest()
+
+    def get_talkey(self, voice: str):
+        """Get the Talkey instance of a voice, creating it on first use
+
+    Args:
+        voice (str): The voice name.
+
+    Returns:
+        Talkey (talkey.Talkey): The Talkey instance."""
+
+        assert voice in self.voices, f"Unknown voice {voice}"
+        if isinstance(self.voices[voice], dict):
+            self.voices[voice] = talkey.Talkey(**self.voices[voice])
+        return self.voices[voice]
+
+    def __synthesize(self, text: str, voice: str, key: str):
+        """Render speech into the cache with Talkey. Must hold the lock.
+
+    Returns:
+        Filename (str | None): The rendered file, or None if the engine rendered nothing."""
+
+        talker = self.get_talkey(voice)
+        language = talker.classify(text)
+        engine = talker.get_engine_for_lang(language)
+        rendered = []
+
+        def capture(filename, translate = False):
+            """Keep the file that the engine would have played"""
+            destination = os.path.join(self.directory, key + os.path.splitext(filename)[1])
+            shutil.copyfile(filename, destination)
+            rendered.append(destination)
+
+        # Talkey engines render to a temporary file and then play() it, so we catch it there
+        engine.play = capture
+        try:
+            engine.say(text, language = language)
+        finally:
+            del engine.play
+
+        return rendered[0] if rendered else None
+
+    def render(self, text: str, voice: str = "default"):
+        """Get the rendered speech of a text, rendering it if it is not cached
+
+    Args:
+        text (str): The text.
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Filename (str | None): The rendered file, or None if rendering failed."""
+
+        key = self.key(text, voice)
+        with self.__lock:
+            if key in self.__files and os.path.exists(self.__files[key][0]):
+                self.hit_count += 1
+                self.__files.move_to_end(key)
+                filename = self.__files[key][0]
+                os.utime(filename)
+                return filename
+
+            self.miss_count += 1
+            filename = self.__synthesize(text, voice, key)
+            if not filename:
+                return None
+
+            size = os.path.getsize(filename)
+            if key in self.__files:
+                self.size -= self.__files[key][1]
+            self.__files[key] = (filename, size)
+            self.size += size
+            self.__evict()
+            return filename
+
+    def __evict(self):
+        """Delete the least recently used renders until we are within the size budget. Must hold the lock, or be initializing."""
+        while self.size > self.max_bytes and len(self.__files) > 1:
+            key, (filename, size) = self.__files.popitem(last = False)
+            self.__sounds.pop(key, None)
+            self.size -= size
+            self.evicted_count += 1
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print("Error: Could not remove cached speech:", e)
+
+    def prewarm(self, phrases, voice: str = "default"):
+        """Render phrases ahead of time, like timed messages and greetings
+
+    Args:
+        phrases (iterable): The texts to render.
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Rendered (int): How many phrases had to be newly rendered."""
+
+        misses = self.miss_count
+        for phrase in phrases:
+            self.render(phrase, voice)
+        return self.miss_count - misses
+
+    def get_sound(self, text: str, voice: str = "default"):
+        """Get the rendered speech of a text loaded into the mixer
+
+    Args:
+        text (str): The text.
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Sound (pygame.mixer.Sound | None): The loaded sound, or None if rendering failed."""
+
+        filename = self.render(text, voice)
+        if not filename:
+            return None
+
+        key = self.key(text, voice)
+        with self.__lock:
+            if key in self.__sounds:
+                self.__sounds.move_to_end(key)
+                return self.__sounds[key]
+
+            if not mixer.get_init():
+                mixer.init()
+            sound = self.__sounds[key] = mixer.Sound(filename)
+            if len(self.__sounds) > self.loaded_sounds:
+                self.__sounds.popitem(last = False)
+            return sound
+
+    def say(self, text: str, voice: str = "default"):
+        """Speak a text, from the cache if possible, returning when it is done
+
+    Args:
+        text (str): The text.
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Spoken (bool): Was the text spoken? False if it could not be rendered or the bus dropped it."""
+
+        sound = self.get_sound(text, voice)
+        if not sound:
+            return False
+
+        if self.bus:
+            if not self.bus.play(sound, static.Audio.Priority.speech):
+                return False
+        else:
+            sound.play()
+
+        time.sleep(sound.get_length())
+        return True
+
+    def sayer(self, voice: str = "default"):
+        """Get a say(text) callable for a voice, like for TTSEngine or TTSCommand voices
+
+    Args:
+        voice (str): The voice name.
+            Defaults to "default"
+
+    Returns:
+        Say (callable): Speaks its text argument in the voice."""
+
+        assert voice in self.voices, f"Unknown voice {voice}"
+        return lambda text: self.say(text, voice)
+
+
+class TTSEngine:
+    """Text-to-speech worker with a bounded queue, speaking the biggest rants first"""
+
+    def __init__(self, **kwargs):
+        """Text-to-speech worker with a bounded queue, speaking the biggest rants first.
+    Speech is queued by priority (usually the rant amount in cents), then by arrival,
+    and spoken one at a time on a background thread.
+    The queue is bounded by an estimate of how long it will take to speak:
+    speech past the budget is truncated, or dropped if a higher priority one needs the room.
+
+    Args:
+        say (callable): Default say(text) callable to speak with. It may return False if it could not speak.
+            Defaults to None, the cache's default voice if there is a cache, otherwise a talkey.Talkey() instance created on first use.
+        cache (TTSCache): Cache of rendered speech to speak with by default.
+            Defaults to None, no cache.
+        bus (AudioBus): Audio bus to duck while speaking.
+            Defaults to None, no ducking.
+        max_queue (int): Most speeches that can be waiting.
+            Defaults to static.TTS.max_queue
+        time_budget (float): Most estimated speaking time that can be waiting, in seconds.
+            Defaults to static.TTS.time_budget
+        max_speech_duration (float): Longest estimated time to speak one text for, in seconds. Longer texts are truncated.
+            Defaults to static.TTS.max_speech_duration
+        words_per_second (float): Speaking rate to estimate speech duration with.
+            Defaults to static.TTS.words_per_second"""
+
+        self.__say = kwargs.get("say")
+        self.cache = kwargs.get("cache")
+        self.bus = kwargs.get("bus")
+        self.max_queue = kwargs.get("max_queue", static.TTS.max_queue)
+        self.time_budget = kwargs.get("time_budget", static.TTS.time_budget)
+        self.max_speech_duration = kwargs.get("max_speech_duration", static.TTS.max_speech_duration)
+        self.words_per_second = kwargs.get("words_per_second", static.TTS.words_per_second)
+
+        # Waiting speeches as a heap of (negative priority, sequence number, speech),
+        # with each speech being [text, say callable, future, estimated duration, time queued]
+        self.__heap = []
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+        self.running = True
+
+        # The metrics registry we report to
+        self.metrics = None
+
+        # Statistics
+        self.spoken_count = 0
+        self.dropped_count = 0
+        self.truncated_count = 0
+
+        self.__thread = threading.Thread(target = self.__speak_loop, daemon = True)
+        self.__thread.start()
+
+    @property
+    def say(self):
+        """The default say(text) callable"""
+        if not self.__say:
+            self.__say = self.cache.say if self.cache is not None else talkey.Talkey().say
+        return self.__say
+
+    @say.setter
+    def say(self, new):
+        """The default say(text) callable
+
+    Args:
+        new (callable): The function or method to call, passing the text."""
+
+        assert callable(new), "Must be a callable"
+        self.__say = new
+
+    def __len__(self):
+        """How many speeches are waiting"""
+        return len(self.__heap)
+
+    @property
+    def depth(self):
+        """How many speeches are waiting"""
+        return len(self)
+
+    @property
+    def backlog(self):
+        """Estimated time to speak everything waiting, in seconds"""
+        with self.__condition:
+            return sum(entry[2][3] for entry in self.__heap)
+
+    def estimate_duration(self, text: str):
+        """Estimate how long a text takes to speak
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        Duration (float): The estimated duration in seconds."""
+
+        return len(text.split()) / self.words_per_second
+
+    def truncate(self, text: str, duration: float):
+        """Cut a text down to what can be spoken in a duration
+
+    Args:
+        text (str): The text.
+        duration (float): The time available, in seconds.
+
+    Returns:
+        Text (str): The truncated text, or an empty string if not even one word fits."""
+
+        words = text.split()
+        fits = int(duration * self.words_per_second)
+        if fits >= len(words):
+            return text
+        return " ".join(words[:fits])
+
+    def speak(self, text: str, say: callable = None, priority: float = 0):
+        """Queue text to be spoken
+
+    Args:
+        text (str): The text to speak.
+        say (callable): The say(text) callable to speak with.
+            Defaults to None, the engine's default.
+        priority (float): Higher is spoken first, like the rant amount in cents.
+            Defaults to 0.
+
+    Returns:
+        Spoken (concurrent.futures.Future): Resolves to True once the text was spoken,
+            False if it was dropped."""
+
+        future = concurrent.futures.Future()
+        text = self.truncate(text, self.max_speech_duration)
+        if not text.strip() or not self.running:
+            future.set_result(False)
+            return future
+
+        with self.__condition:
+            # Make room in the queue and the time budget, evicting lower priority speech
+            duration = self.estimate_duration(text)
+            while self.__heap and (
+                    len(self.__heap) >= self.max_queue or
+                    sum(entry[2][3] for entry in self.__heap) + duration > self.time_budget
+                    ):
+                lowest = max(self.__heap)
+                if -lowest[0] >= priority:
+                    break
+                self.__heap.remove(lowest)
+                heapq.heapify(self.__heap)
+                self.__drop(lowest[2])
+
+            # Still no room, speak what fits of this one if anything
+            remaining = self.time_budget - sum(entry[2][3] for entry in self.__heap)
+            if len(self.__heap) < self.max_queue and duration > remaining:
+                text = self.truncate(text, remaining)
+                if text:
+                    self.truncated_count += 1
+                    print("TTS backlog is full, truncated speech to:", text)
+                    duration = self.estimate_duration(text)
+
+            if len(self.__heap) >= self.max_queue or not text:
+                self.__drop([text, say, future, duration, time.time()])
+                return future
+
+            speech = [text, say, future, duration, time.time()]
+            heapq.heappush(self.__heap, (-priority, next(self.__sequence), speech))
+            self.__condition.notify()
+
+        return future
+
+    def __drop(self, speech):
+        """Drop a speech without speaking it
+
+    Args:
+        speech (list): The speech."""
+
+        print("TTS backlog is full, dropped speech:", speech[0])
+        self.dropped_count += 1
+        speech[2].set_result(False)
+
+    def __speak_loop(self):
+        """Speak queued text until closed"""
+        while True:
+            with self.__condition:
+                while not self.__heap and self.running:
+                    self.__condition.wait()
+                if not self.running:
+                    return
+                text, say, future, _, queued = heapq.heappop(self.__heap)[2]
+
+            start = time.time()
+            try:
+                with self.bus.ducking() if self.bus else contextlib.nullcontext():
+                    spoken = (say or self.say)(text)
+            except Exception as e:
+                print("Error: TTS failed:", e)
+                future.set_exception(e)
+                continue
+
+            # The say callable reported it could not speak, like TTSCache.say() when the bus drops it
+            if spoken is False:
+                print("TTS could not speak:", text)
+                self.dropped_count += 1
+                future.set_result(False)
+                continue
+
+            self.spoken_count += 1
+            future.set_result(True)
+            if self.metrics:
+                self.metrics.observe("tts", "latency", start - queued)
+                self.metrics.observe("tts", "speech", time.time() - start)
+
+    def report_metrics(self, metrics):
+        """Report our queue and latencies to a metrics registry
+
+    Args:
+        metrics (metrics.Metrics): The metrics registry to report to."""
+
+        self.metrics = metrics
+        metrics.set_gauge("tts_queue_depth", lambda: self.depth)
+        metrics.set_gauge("tts_backlog_seconds", lambda: self.backlog)
+        metrics.set_gauge("tts_dropped", lambda: self.dropped_count)
+        metrics.set_gauge("tts_truncated", lambda: self.truncated_count)
+        if self.bus:
+            self.bus.report_metrics(metrics)
+        if self.cache is not None:
+            metrics.set_gauge("tts_cache_hit_rate", lambda: self.cache.hit_rate)
+            metrics.set_gauge("tts_cache_bytes", lambda: self.cache.size)
+
+    def close(self):
+        """Stop speaking, dropping anything still waiting"""
+        with self.__condition:
+            self.running = False
+            for _, _, speech in self.__heap:
+                speech[2].set_result(False)
+            self.__heap.clear()
+            self.__condition.notify_all()
+
+
+# Bus and engine shared by the sound actions and commands, created on first use
+_default_audio_bus = None
+_default_tts_engine = None
+_default_lock = threading.RLock()
+
+
+def default_audio_bus():
+    """Get the shared AudioBus with the default settings
+
+    Returns:
+        Bus (AudioBus): The shared bus."""
+
+    global _default_audio_bus
+    with _default_lock:
+        if _default_audio_bus is None:
+            _default_audio_bus = AudioBus()
+        return _default_audio_bus
+
+
+def default_tts_engine():
+    """Get the shared TTSEngine with the default settings, speaking through a TTSCache unless static.TTS.cache_directory is None.
+    Pre-warm its cache with default_tts_engine().cache.prewarm(phrases)
+
+    Returns:
+        Engine (TTSEngine): The shared engine."""
+
+    global _default_tts_engine
+    with _default_lock:
+        if _default_tts_engine is None:
+            bus = default_audio_bus()
+            cache = TTSCache(bus = bus) if static.TTS.cache_directory else None
+            _default_tts_engine = TTSEngine(cache = cache, bus = bus)
+        return _default_tts_engine
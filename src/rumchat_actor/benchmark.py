@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""Performance benchmarks
+
+Benchmarks to check the performance of Rumble Chat Actor without going live.
+Run `python -m rumchat_actor.benchmark --help` for the command line interface.
+S.D.G."""
+
+import argparse
+import http.server
+import importlib
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from . import moderation, replay, static
+
+# Script run in a fresh interpreter to time the package import
+IMPORT_TIME_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import rumchat_actor
+duration = time.perf_counter() - start
+print(json.dumps({"duration": duration, "modules": sorted(sys.modules)}))
+"""
+
+
+def import_time(runs: int = static.Benchmark.import_runs):
+    """Time a fresh import of the package, and check which heavy modules it pulled in
+
+    Args:
+        runs (int): How many fresh interpreters to time the import in. The fastest run is reported.
+            Defaults to static.Benchmark.import_runs
+
+    Returns:
+        Duration (float): The fastest import time in seconds.
+        Heavy modules (list): Heavy optional dependencies that were imported eagerly."""
+
+    durations = []
+    heavy = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_TIME_SCRIPT],
+            capture_output=True,
+            check=True,
+            text=True,
+            ).stdout
+        result = json.loads(output.splitlines()[-1])
+        durations.append(result["duration"])
+        heavy.update(
+            module for module in static.Benchmark.heavy_modules
+            if module in result["modules"]
+            )
+
+    return min(durations), sorted(heavy)
+
+
+def check_import_time(budget: float = static.Benchmark.import_time_budget, runs: int = static.Benchmark.import_runs):
+    """Check that importing the package stays within its time budget and pulls in no heavy modules
+
+    Args:
+        budget (float): The maximum acceptable import time in seconds.
+            Defaults to static.Benchmark.import_time_budget
+        runs (int): How many fresh interpreters to time the import in.
+            Defaults to static.Benchmark.import_runs
+
+    Returns:
+        Result (bool): Did the import meet the budget?"""
+
+    duration, heavy = import_time(runs)
+    print(f"Import time: {duration * 1000:.1f} ms (budget {budget * 1000:.0f} ms)")
+    if heavy:
+        print("Heavy modules imported eagerly:", ", ".join(heavy))
+
+    passed = duration <= budget and not heavy
+    print("PASS" if passed else "FAIL")
+    return passed
+
+
+def load_test(records, setup: str = None, speed: float = static.Replay.speed, **kwargs):
+    """Replay chat through an actor end to end and print how it kept up
+
+    Args:
+        records (list): The chat records to replay, see replay.load_recording() for the format.
+        setup (str): A callable to set up the actor with, as "module:function".
+            Defaults to None, a bare actor.
+        speed (float): How many times faster than recorded to replay the chat.
+            Defaults to static.Replay.speed
+        All other keyword arguments are passed to replay.run_load_test().
+
+    Returns:
+        Report (dict): Load test results."""
+
+    if setup:
+        module_name, function_name = setup.split(":")
+        setup = getattr(importlib.import_module(module_name), function_name)
+
+    report = replay.run_load_test(records, setup=setup, speed=speed, **kwargs)
+
+    print(f"Messages: {report['messages']} in {report['elapsed']:.1f} s ({report['throughput']:.1f} msgs/s)")
+    print(f"Dropped by age: {report['dropped_by_age']}, shed actions: {report['shed_actions']}, final inbox lag: {report['inbox_lag']:.2f} s")
+    print(f"Outbox: {report['outbox_sent']} sent, {report['outbox_evicted']} evicted, {report['outbox_expired']} expired, {report['outbox_average_wait']:.2f} s average wait")
+    print(f"Moderation: {report['deleted']} deleted, {report['muted']} muted")
+    print(f"Latency: p50 {report['latency_p50'] * 1000:.1f} ms, p99 {report['latency_p99'] * 1000:.1f} ms, max {report['latency_max'] * 1000:.1f} ms")
+    return report
+
+
+class FakeOllamaServer:
+    """Local stand-in for the Ollama chat endpoint, answering numbered moderation batches after a simulated delay"""
+
+    def __init__(self, **kwargs):
+        """Local stand-in for the Ollama chat endpoint, answering numbered moderation batches after a simulated delay.
+    Whether a message is dirty depends only on its text, so repeated texts get consistent verdicts.
+    Use it as a context manager, and point a moderation.BatchModerator at its url.
+
+    Args:
+        latency_distribution (str): "fixed", "uniform" or "lognormal".
+            Defaults to static.Benchmark.llm_latency_distribution
+        latency (float): Mean delay of a response, in seconds.
+            Defaults to static.Benchmark.llm_latency
+        latency_sigma (float): Spread of the lognormal distribution.
+            Defaults to static.Benchmark.llm_latency_sigma
+        latency_per_message (float): Extra delay per message in a batch, in seconds.
+            Defaults to static.Benchmark.llm_latency_per_message
+        dirty_ratio (float): Fraction of messages to say are dirty.
+            Defaults to static.Benchmark.dirty_ratio
+        malformed_ratio (float): Fraction of messages to leave out of the answer.
+            Defaults to static.Benchmark.malformed_ratio
+        seed (int): Random seed for the delays and malformed answers.
+            Defaults to None, unseeded."""
+
+        self.latency_distribution = kwargs.get("latency_distribution", static.Benchmark.llm_latency_distribution)
+        assert self.latency_distribution in ("fixed", "uniform", "lognormal"), \
+            f"Unknown latency distribution {self.latency_distribution}"
+        self.latency = kwargs.get("latency", static.Benchmark.llm_latency)
+        self.latency_sigma = kwargs.get("latency_sigma", static.Benchmark.llm_latency_sigma)
+        self.latency_per_message = kwargs.get("latency_per_message", static.Benchmark.llm_latency_per_message)
+        self.dirty_ratio = kwargs.get("dirty_ratio", static.Benchmark.dirty_ratio)
+        self.malformed_ratio = kwargs.get("malformed_ratio", static.Benchmark.malformed_ratio)
+        self.random = random.Random(kwargs.get("seed"))
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.request_count = 0
+        self.message_count = 0
+
+        self.server = None
+
+    @property
+    def url(self):
+        """The URL of the server, to use as the Ollama host"""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def delay(self, batch_size: int):
+        """Draw how long to take to answer a batch
+
+    Args:
+        batch_size (int): How many messages are in the batch.
+
+    Returns:
+        Delay (float): The delay in seconds."""
+
+        with self.__lock:
+            if self.latency_distribution == "uniform":
+                delay = self.random.uniform(0, 2 * self.latency)
+            elif self.latency_distribution == "lognormal":
+                delay = self.random.lognormvariate(math.log(self.latency) - self.latency_sigma ** 2 / 2, self.latency_sigma)
+            else:
+                delay = self.latency
+
+        return delay + self.latency_per_message * batch_size
+
+    def is_dirty(self, text: str):
+        """Decide if a message is dirty, the same way every time for the same text
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Dirty (bool): Should the message be verdicted as dirty?"""
+
+        return zlib.crc32(moderation.normalize_text(text).encode()) % 10000 < self.dirty_ratio * 10000
+
+    def count_request(self, batch_size: int):
+        """Count a request in the statistics
+
+    Args:
+        batch_size (int): How many messages were in it."""
+
+        with self.__lock:
+            self.request_count += 1
+            self.message_count += batch_size
+
+    def answer(self, prompt: str):
+        """Answer a numbered moderation batch
+
+    Args:
+        prompt (str): The numbered messages, one per line.
+
+    Returns:
+        Answer (str): A verdict line for each message, except the ones left out as malformed."""
+
+        lines = []
+        for line in prompt.splitlines():
+            number, _, text = line.partition(":")
+            with self.__lock:
+                if self.random.random() < self.malformed_ratio:
+                    continue
+            lines.append(f"{number}: {0 if self.is_dirty(text.strip()) else 1}")
+
+        return "\n".join(lines)
+
+    def start(self):
+        """Start serving in the background"""
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Handle Ollama chat requests"""
+
+            def log_message(self, *args):
+                """Do not log every request"""
+
+            def do_POST(self):
+                """Answer a chat request"""
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prompt = body["messages"][-1]["content"]
+                batch_size = len(prompt.splitlines())
+                fake.count_request(batch_size)
+                time.sleep(fake.delay(batch_size))
+                data = json.dumps({
+                    "model": body.get("model", ""),
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "message": {"role": "assistant", "content": fake.answer(prompt)},
+                    "done": True,
+                    }).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def stop(self):
+        """Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def moderation_test(rate: float, duration: float = static.Benchmark.moderation_duration, server_kwargs: dict = None, **kwargs):
+    """Drive LLM moderation through an actor with synthetic chat against a fake Ollama server
+
+    Args:
+        rate (float): Chat messages per second.
+        duration (float): How long to run the chat, in seconds.
+            Defaults to static.Benchmark.moderation_duration
+        server_kwargs (dict): Settings of the FakeOllamaServer.
+            Defaults to None, the defaults.
+        cache (bool): Use the verdict cache.
+            Defaults to True.
+        prefilter (bool): Use the lexical prefilter.
+            Defaults to True.
+        seed (int): Random seed for the synthetic chat.
+            Defaults to None, unseeded.
+        All other keyword arguments are passed to moderation.BatchModerator().
+
+    Returns:
+        Report (dict): Throughput, verdict latency, backlog, skipped messages and LLM usage."""
+
+    records = replay.generate_traffic(duration, rate, seed = kwargs.pop("seed", None))
+    if not kwargs.pop("cache", True):
+        kwargs["cache"] = None
+    if not kwargs.pop("prefilter", True):
+        kwargs["prefilter"] = None
+
+    with FakeOllamaServer(**(server_kwargs or {})) as server:
+        moderator = moderation.BatchModerator(host = server.url, **kwargs)
+        actors = []
+
+        def setup(actor):
+            """Register the moderator, and keep the actor to read its metrics afterwards"""
+            actors.append(actor)
+            actor.register_message_action(moderator)
+
+        # Sample the backlog in the background
+        backlog = []
+        stop_sampling = threading.Event()
+
+        def sample():
+            """Sample the moderation backlog until stopped"""
+            while not stop_sampling.wait(static.Benchmark.backlog_sample_interval):
+                backlog.append(moderator.backlog)
+
+        def drain(_actor):
+            """Let verdicts still waiting on the LLM finish before the actor quits, so they count and their deletions are made"""
+            stop_sampling.set()
+            sampler.join()
+            drain_end = time.time() + moderator.deadline + moderator.batch_window
+            while moderator.backlog and time.time() < drain_end:
+                time.sleep(static.Benchmark.backlog_sample_interval)
+            moderator.close(wait = True)
+
+        sampler = threading.Thread(target = sample, daemon = True)
+        sampler.start()
+        report = replay.run_load_test(records, setup = setup, drain = drain)
+
+    verdicts = actors[0].metrics.get("moderation", "verdict") or {"calls": 0, "p50": 0, "p99": 0, "max": 0}
+    shed = actors[0].metrics.snapshot()["counters"].get("shed", {})
+    half = len(backlog) // 2
+    return {
+        "rate": rate,
+        "messages": report["messages"],
+        "throughput": report["throughput"],
+        "verdicts": verdicts["calls"],
+        "verdict_p50": verdicts["p50"],
+        "verdict_p99": verdicts["p99"],
+        "verdict_max": verdicts["max"],
+        "backlog_max": max(backlog, default = 0),
+        # Average backlog in the second half of the run less the first half, positive if moderation fell behind
+        "backlog_growth": (sum(backlog[half:]) / (len(backlog) - half) - sum(backlog[:half]) / half) if half else 0,
+        "skipped": report["dropped_by_age"] + shed.get("BatchModerator", 0),
+        "fallbacks": moderator.fallback_count,
+        "llm_requests": server.request_count,
+        "llm_messages": server.message_count,
+        "deleted": report["deleted"],
+        }
+
+
+def moderation_benchmark(rates = static.Benchmark.moderation_rates, report_file: str = None, **kwargs):
+    """Benchmark LLM moderation at several chat rates and print a comparable report
+
+    Args:
+        rates (tuple): Chat rates to test, in messages per second.
+            Defaults to static.Benchmark.moderation_rates
+        report_file (str): Write the reports to this JSON file too.
+            Defaults to None, only print them.
+        All other keyword arguments are passed to moderation_test().
+
+    Returns:
+        Reports (list): The report of each rate, see moderation_test()."""
+
+    reports = []
+    for rate in rates:
+        print(f"Benchmarking moderation at {rate} msgs/s...")
+        reports.append(moderation_test(rate, **kwargs))
+
+    columns = (
+        ("rate", "msgs/s", "{:.0f}"),
+        ("throughput", "done/s", "{:.1f}"),
+        ("verdict_p50", "p50 ms", "{:.0f}"),
+        ("verdict_p99", "p99 ms", "{:.0f}"),
+        ("backlog_max", "backlog", "{}"),
+        ("backlog_growth", "growth", "{:+.1f}"),
+        ("skipped", "skipped", "{}"),
+        ("fallbacks", "fallback", "{}"),
+        ("llm_requests", "LLM calls", "{}"),
+        ("llm_messages", "LLM msgs", "{}"),
+        )
+    print("\t".join(title for _, title, _ in columns))
+    for report in reports:
+        print("\t".join(
+            form.format(report[key] * 1000 if key.startswith("verdict_") else report[key])
+            for key, _, form in columns
+            ))
+
+    if report_file:
+        with open(report_file, "w", encoding = "utf-8") as f:
+            json.dump(reports, f, indent = 4)
+
+    return reports
+
+
+def main(argv=None):
+    """Run benchmarks from the command line
+
+    Args:
+        argv (list): Command line arguments.
+            Defaults to None, use sys.argv
+
+    Returns:
+        Exit code (int): 0 if the benchmark passed, 1 if it did not."""
+
+    parser = argparse.ArgumentParser(prog="python -m rumchat_actor.benchmark", description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    imports_parser = subparsers.add_parser("imports", help="Check the package import time against its budget")
+    imports_parser.add_argument("--budget", type=float, default=static.Benchmark.import_time_budget, help="Import time budget in seconds")
+    imports_parser.add_argument("--runs", type=int, default=static.Benchmark.import_runs, help="Number of fresh imports to time")
+
+    load_parser = subparsers.add_parser("load", help="Replay recorded or synthetic chat through an actor and report how it kept up")
+    load_parser.add_argument("--recording", help="JSON lines chat recording to replay, instead of synthetic traffic")
+    load_parser.add_argument("--setup", help="Callable to register actions and commands on the actor, as module:function")
+    load_parser.add_argument("--speed", type=float, default=static.Replay.speed, help="Replay speed factor, e.g. 1 to 100")
+    load_parser.add_argument("--duration", type=float, default=60, help="Synthetic chat duration in seconds")
+    load_parser.add_argument("--rate", type=float, default=5, help="Synthetic chat messages per second")
+    load_parser.add_argument("--raids", type=int, default=0, help="Number of synthetic raids")
+    load_parser.add_argument("--rant-bursts", type=int, default=0, help="Number of synthetic rant bursts")
+    load_parser.add_argument("--spam-floods", type=int, default=0, help="Number of synthetic spam floods")
+    load_parser.add_argument("--gifts", type=int, default=0, help="Number of synthetic subscription gifts")
+    load_parser.add_argument("--seed", type=int, help="Random seed for synthetic traffic")
+    load_parser.add_argument("--send-latency", type=float, default=0, help="Simulated time to send a message, in seconds")
+    load_parser.add_argument("--max-inbox-age", type=float, default=static.Message.max_inbox_age, help="Maximum age of chat messages before the actor skips them")
+
+    moderation_parser = subparsers.add_parser("moderation", help="Drive LLM moderation with synthetic chat against a fake Ollama server")
+    moderation_parser.add_argument("--rates", type=float, nargs="+", default=static.Benchmark.moderation_rates, help="Chat rates to test, in messages per second")
+    moderation_parser.add_argument("--duration", type=float, default=static.Benchmark.moderation_duration, help="Synthetic chat duration at each rate, in seconds")
+    moderation_parser.add_argument("--latency-distribution", choices=("fixed", "uniform", "lognormal"), default=static.Benchmark.llm_latency_distribution, help="Latency distribution of the fake Ollama server")
+    moderation_parser.add_argument("--latency", type=float, default=static.Benchmark.llm_latency, help="Mean latency of the fake Ollama server, in seconds")
+    moderation_parser.add_argument("--latency-per-message", type=float, default=static.Benchmark.llm_latency_per_message, help="Extra latency per message in a batch, in seconds")
+    moderation_parser.add_argument("--dirty-ratio", type=float, default=static.Benchmark.dirty_ratio, help="Fraction of messages the fake Ollama server says are dirty")
+    moderation_parser.add_argument("--malformed-ratio", type=float, default=static.Benchmark.malformed_ratio, help="Fraction of messages the fake Ollama server leaves out of its answer")
+    moderation_parser.add_argument("--no-cache", action="store_true", help="Moderate without the verdict cache")
+    moderation_parser.add_argument("--no-prefilter", action="store_true", help="Moderate without the lexical prefilter")
+    moderation_parser.add_argument("--seed", type=int, help="Random seed for synthetic chat and the fake server")
+    moderation_parser.add_argument("--report", help="Also write the reports to this JSON file")
+
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "imports":
+        return 0 if check_import_time(args.budget, args.runs) else 1
+
+    if args.benchmark == "load":
+        if args.recording:
+            records = replay.load_recording(args.recording)
+        else:
+            records = replay.generate_traffic(
+                args.duration,
+                args.rate,
+                raids=args.raids,
+                rant_bursts=args.rant_bursts,
+                spam_floods=args.spam_floods,
+                gifts=args.gifts,
+                seed=args.seed,
+                )
+
+        report = load_test(
+            records,
+            setup=args.setup,
+            speed=args.speed,
+            send_latency=args.send_latency,
+            max_inbox_age=args.max_inbox_age,
+            )
+        return 0 if not report["dropped_by_age"] else 1
+
+    if args.benchmark == "moderation":
+        moderation_benchmark(
+            args.rates,
+            report_file=args.report,
+            duration=args.duration,
+            server_kwargs={
+                "latency_distribution": args.latency_distribution,
+                "latency": args.latency,
+                "latency_per_message": args.latency_per_message,
+                "dirty_ratio": args.dirty_ratio,
+                "malformed_ratio": args.malformed_ratio,
+                "seed": args.seed,
+                },
+            cache=not args.no_cache,
+            prefilter=not args.no_prefilter,
+            seed=args.seed,
+            )
+        return 0
+
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
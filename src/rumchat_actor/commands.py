@@ -12,13 +12,148 @@ import sys
 import tempfile
 import time
 import threading
-from tkinter import filedialog, Tk
-from moviepy import VideoFileClip, concatenate_videoclips
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
-import obsws_python as obs
 import requests
-import talkey
-from . import utils, static
+from . import audio, hls, utils, static
+
+# Heavy and optional dependencies, imported on first use
+tkinter = utils.lazy_import("tkinter")
+filedialog = utils.lazy_import("tkinter.filedialog")
+moviepy = utils.lazy_import("moviepy", extra="clips")
+ffmpeg_tools = utils.lazy_import("moviepy.video.io.ffmpeg_tools", extra="clips")
+moviepy_config = utils.lazy_import("moviepy.config", extra="clips")
+obs = utils.lazy_import("obsws_python", extra="obs")
+
+
+class ArgumentError(ValueError):
+    """The arguments of a chat command call were not valid"""
+
+
+class Arg:
+    """One positional argument in the argument schema of a chat command"""
+
+    def __init__(self, name: str, kind: type = str, **kwargs):
+        """One positional argument in the argument schema of a chat command.
+
+    Args:
+        name (str): The name of the argument in the parsed arguments.
+        kind (type): The type to convert the argument to, str, int or float.
+            Defaults to str.
+        required (bool): Is the argument required? Optional arguments that do not match
+            the word in their position are skipped, leaving it for the next argument.
+            Defaults to False.
+        default (Any): The value of the argument when it is not given.
+            Defaults to None.
+        choices (list | callable): The allowed values, or a callable returning them. Matched case-insensitively.
+            Defaults to None, any value.
+        minimum (int | float): The lowest allowed value of a number.
+            Defaults to None, no minimum.
+        maximum (int | float): The highest allowed value of a number.
+            Defaults to None, no maximum.
+        rest (bool): Take all the remaining words as one space-separated string.
+            Defaults to False.
+        transform (callable): Applied to the converted value, e.g. to strip an @ from a username.
+            Defaults to None."""
+
+        assert kind in (str, int, float), f"Argument kind must be str, int or float, not {kind}"
+        self.name = name
+        self.kind = kind
+        self.required = kwargs.get("required", False)
+        self.default = kwargs.get("default")
+        self.__choices = kwargs.get("choices")
+        self.minimum = kwargs.get("minimum")
+        self.maximum = kwargs.get("maximum")
+        self.rest = kwargs.get("rest", False)
+        self.transform = kwargs.get("transform")
+
+    @property
+    def choices(self):
+        """The allowed values of the argument, or None for any value"""
+        if callable(self.__choices):
+            return list(self.__choices())
+        return self.__choices
+
+    def matches(self, word: str):
+        """Check if a word has the right form to be this argument
+
+    Args:
+        word (str): The word in this argument's position.
+
+    Returns:
+        Result (bool): Is the word the right type, and one of the choices if there are any?"""
+
+        if self.kind is not str:
+            try:
+                self.kind(word)
+            except ValueError:
+                return False
+
+        choices = self.choices
+        return choices is None or word.lower() in (str(choice).lower() for choice in choices)
+
+    def convert(self, word: str):
+        """Convert a matching word to the argument's value, checking its bounds
+
+    Args:
+        word (str): The word in this argument's position.
+
+    Returns:
+        Value (Any): The converted value.
+
+    Raises:
+        ArgumentError: The value is out of bounds."""
+
+        value = self.kind(word)
+
+        # Use the choice as spelled in the choices
+        if (choices := self.choices) is not None:
+            value = next(choice for choice in choices if str(choice).lower() == word.lower())
+
+        if self.minimum is not None and value < self.minimum:
+            raise ArgumentError(f"{self.name} must be at least {self.minimum}")
+
+        if self.maximum is not None and value > self.maximum:
+            raise ArgumentError(f"{self.name} must be at most {self.maximum}")
+
+        return self.transform(value) if self.transform else value
+
+
+class CommandCall:
+    """A chat message calling a command, tokenized once by the actor and passed to everything in act_props["command"]"""
+
+    def __init__(self, command, name: str, words: list):
+        """A chat message calling a command
+
+    Args:
+        command (ChatCommand | None): The called command, or None if no command by that name is registered.
+        name (str): The name or alias the command was called by, in lower case.
+        words (list): The words after the command name."""
+
+        self.command = command
+        self.name = name
+        self.words = words
+
+        # Parsed arguments by name, set when the command validates them
+        self.args = None
+
+    @property
+    def text(self):
+        """The words after the command name, as one string"""
+        return " ".join(self.words)
+
+    @classmethod
+    def from_text(cls, text: str, command = None):
+        """Tokenize a chat message that calls a command
+
+    Args:
+        text (str): The message text, starting with the command prefix.
+        command (ChatCommand): The called command.
+            Defaults to None.
+
+    Returns:
+        Call (CommandCall): The tokenized call."""
+
+        words = text.split()
+        return cls(command, words[0].removeprefix(static.Message.command_prefix).lower(), words[1:])
 
 
 class ChatCommand():
@@ -44,11 +179,20 @@ class ChatCommand():
             "admin" is added internally.
             Defaults to ["moderator"]
         target (callable): The command function(message, act_props, actor) to call.
-            Defaults to self.run"""
+            Defaults to self.run
+        aliases (list): Other names the command can be called by.
+            Defaults to no aliases.
+        args (list): Argument schema of Arg objects, validated before the command runs.
+            The parsed arguments are in act_props["command"].args
+            Defaults to None, do not validate arguments."""
 
         assert " " not in name, "Name cannot contain spaces"
         self.name = name
         self.actor = actor
+        self.aliases = list(kwargs.get("aliases", []))
+        self.args = kwargs.get("args")
+        assert self.args is None or not any(arg.rest for arg in self.args[:-1]), \
+            "Only the last argument can take the rest of the words"
 
         #Don't let the cooldown be shorter than we can send messages
         self.cooldown = kwargs.get("cooldown", static.Message.send_cooldown)
@@ -93,14 +237,19 @@ class ChatCommand():
 
     Args:
         message (cocorum.ChatAPI.Message): The chat message that called us.
-        act_props (dict): Message action recorded properties."""
+        act_props (dict): Message action recorded properties.
+
+    Returns:
+        Result (None | awaitable): What the run method returned."""
 
         #this command is exclusive, and the user does not have the required badge
         if self.exclusive and \
             not (True in [badge.slug in self.allowed_badges for badge in message.user.badges]):
 
             self.actor.send_message(f"@{message.user.username} That command is exclusive to: " +
-                                    ", ".join(self.allowed_badges)
+                                    ", ".join(self.allowed_badges),
+                                    priority = static.Message.Priority.low,
+                                    ttl = static.Message.notice_ttl,
                                     )
 
             return
@@ -109,7 +258,10 @@ class ChatCommand():
         if (curtime := time.time()) - self.last_use_time < self.cooldown:
             self.actor.send_message(
                 f"@{message.user.username} That command is still on cooldown. " +
-                f"Try again in {int(self.last_use_time + self.cooldown - curtime + 0.5)} seconds."
+                f"Try again in {int(self.last_use_time + self.cooldown - curtime + 0.5)} seconds.",
+                priority = static.Message.Priority.low,
+                # The notice is stale once the cooldown is over
+                ttl = min(self.last_use_time + self.cooldown - curtime, static.Message.notice_ttl),
                 )
 
             return
@@ -119,16 +271,85 @@ class ChatCommand():
             not (True in [badge.slug in self.free_badges for badge in message.user.badges]):
 
             self.actor.send_message("@" + message.user.username +
-                                    f" That command costs ${self.amount_cents/100:.2f}."
+                                    f" That command costs ${self.amount_cents/100:.2f}.",
+                                    priority = static.Message.Priority.low,
+                                    ttl = static.Message.notice_ttl,
                                     )
             return
 
+        #Validate the arguments, tokenizing the message if the actor did not already
+        call = act_props.get("command")
+        if not call or call.command is not self:
+            call = act_props["command"] = CommandCall.from_text(message.text, self)
+        if call.args is None:
+            try:
+                call.args = self.parse_args(call.words)
+            except ArgumentError as e:
+                self.argument_error(message, e)
+                return
+
         #the command was called successfully
-        self.run(message, act_props)
+        result = self.run(message, act_props)
 
         #Mark the last use time for cooldown
         self.last_use_time = time.time()
 
+        #Pass on the awaitable of a coroutine target, for AsyncRumbleChatActor
+        return result
+
+    def parse_args(self, words: list):
+        """Parse and validate the words after the command name against our argument schema
+
+    Args:
+        words (list): The words after the command name.
+
+    Returns:
+        Args (dict): The argument values by name.
+
+    Raises:
+        ArgumentError: The words do not fit the schema."""
+
+        #No schema, leave the words to the run method
+        if self.args is None:
+            return {}
+
+        values = {}
+        i = 0
+        for arg in self.args:
+            if arg.rest:
+                values[arg.name] = " ".join(words[i:]) or arg.default
+                if arg.required and i >= len(words):
+                    raise ArgumentError(f"Missing {arg.name}")
+                i = len(words)
+
+            elif i < len(words) and arg.matches(words[i]):
+                values[arg.name] = arg.convert(words[i])
+                i += 1
+
+            elif arg.required:
+                raise ArgumentError(f"Invalid {arg.name}: {words[i]}" if i < len(words) else f"Missing {arg.name}")
+
+            else:
+                values[arg.name] = arg.default
+
+        if i < len(words):
+            raise ArgumentError("Too many arguments")
+
+        return values
+
+    def argument_error(self, message, error: ArgumentError):
+        """The command was called with invalid arguments, tell the user
+
+    Args:
+        message (cocorum.ChatAPI.Message): The chat message that called us.
+        error (ArgumentError): What was wrong with the arguments."""
+
+        self.actor.send_message(
+            f"@{message.user.username} {error}. Try {static.Message.command_prefix}help {self.name}",
+            priority = static.Message.Priority.low,
+            ttl = static.Message.notice_ttl,
+            )
+
     def run(self, message, act_props: dict):
         """Dummy run method, for when calling the command was successful.
 
@@ -137,8 +358,7 @@ class ChatCommand():
         act_props (dict): Message action recorded properties."""
 
         if self.target:
-            self.target(message, act_props, self.actor)
-            return
+            return self.target(message, act_props, self.actor)
 
         #Run method was never defined
         self.actor.send_message("@" + message.user.username +
@@ -147,8 +367,9 @@ class ChatCommand():
 
 class TTSCommand(ChatCommand):
     """Text-to-speech command"""
-    def __init__(self, *args, name = "tts", no_double_sound = True, voices = {}, **kwargs):
+    def __init__(self, *args, name = "tts", no_double_sound = True, voices = {}, engine = None, **kwargs):
         """Text-to-speech command.
+    Speech is queued on a TTS engine and spoken in the background, paid messages first.
     Instance this object, then pass it to RumbleChatActor().register_command().
 
     Args:
@@ -158,6 +379,8 @@ class TTSCommand(ChatCommand):
         no_double_sound (bool): Do not play if act_props["sound"] is True.
             Defaults to True
         voices (dict): Dict of voice_name : say(text) callable.
+        engine (audio.TTSEngine): The TTS engine to speak with.
+            Defaults to None, the shared audio.default_tts_engine()
         cooldown (int | float): How long to wait before allowing the command to be run again.
             Defaults to static.Message.send_cooldown
         amount_cents (int): The minimum cost of the command.
@@ -172,14 +395,21 @@ class TTSCommand(ChatCommand):
             Defaults to ["moderator"]
     """
 
-        super().__init__(*args, name = name, **kwargs)
+        super().__init__(
+            *args,
+            name = name,
+            args = [Arg("voice", choices = lambda: self.voices), Arg("text", rest = True, default = "")],
+            **kwargs,
+            )
 
         self.no_double_sound = no_double_sound
         self.voices = voices
+        self.engine = engine if engine is not None else audio.default_tts_engine()
+        self.engine.report_metrics(self.actor.metrics)
 
         #Make sure we have a default voice
         if "default" not in self.voices:
-            self.voices["default"] = talkey.Talkey().say
+            self.voices["default"] = self.engine.say
 
     @property
     def help_message(self):
@@ -192,22 +422,27 @@ class TTSCommand(ChatCommand):
         """The default TTS voice as a say(text) callable"""
         return self.voices["default"]
 
-    def speak(self, text, voice = None):
-        """Speak text with voice
+    def speak(self, text, voice = None, priority = 0):
+        """Queue text to speak with voice
 
     Args:
+        text (str): The text to speak.
         voice (str): The key of the voice in our voices dict.
-            Defaults to None"""
+            Defaults to None
+        priority (int | float): Higher is spoken first, like the amount paid in cents.
+            Defaults to 0
+
+    Returns:
+        Spoken (concurrent.futures.Future): Resolves to True once the text was spoken, False if it was dropped."""
 
         if not voice:
-            self.default_voice(text)
+            return self.engine.speak(text, self.default_voice, priority)
 
         #Voice was not actually in our list of voices
-        elif voice not in self.voices:
-            self.default_voice(voice + " " + text)
+        if voice not in self.voices:
+            return self.engine.speak(voice + " " + text, self.default_voice, priority)
 
-        else:
-            self.voices[voice](text)
+        return self.engine.speak(text, self.voices[voice], priority)
 
     def run(self, message, act_props: dict):
         """Run the TTS
@@ -220,24 +455,16 @@ class TTSCommand(ChatCommand):
         if self.no_double_sound and act_props.get("sound"):
             return
 
-        segs = message.text.split()
-
-        #No args for the tts command
-        if len(segs) < 2:
-            return
-
-        #Only one word for tts
-        if len(segs) == 2:
-            self.speak(segs[1])
-            return
+        args = act_props["command"].args
+        priority = message.rant_price_cents if message.is_rant else 0
 
-        #A voice was selected
-        if segs[1] in self.voices:
-            self.speak(" ".join(segs[2:]), segs[1])
-            return
+        #Only a voice name, speak it as the text
+        if args["voice"] and not args["text"]:
+            self.speak(args["voice"], priority = priority)
 
-        #No voice was selected
-        self.speak(" ".join(segs[1:]))
+        #There is text to speak, with or without a voice
+        elif args["text"]:
+            self.speak(args["text"], args["voice"], priority)
 
 class MessageCommand(ChatCommand):
     """Post a single message in chat"""
@@ -276,7 +503,7 @@ class HelpCommand(ChatCommand):
         actor (RumbleChatActor): The Rumble chat actor host.
         name (str): The command name."""
 
-        super().__init__(name = name, actor = actor)
+        super().__init__(name = name, actor = actor, args = [Arg("command_name")])
 
     @property
     def help_message(self):
@@ -292,31 +519,31 @@ class HelpCommand(ChatCommand):
         message (cocorum.ChatAPI.Message): The chat message that called us.
         act_props (dict): Message action recorded properties."""
 
-        segs = message.text.split()
+        name = act_props["command"].args["command_name"]
 
         #Command was run without arguments
-        if len(segs) == 1:
+        if not name:
             self.actor.send_message(
                 "The following commands are registered: " + \
                 ", ".join(self.actor.chat_commands)
             )
+            return
 
-        #Command had one argument
-        elif len(segs) == 2:
-            #Argument is a valid command
-            if segs[-1] in self.actor.chat_commands:
-                hm = self.actor.chat_commands[segs[-1]].help_message
-                if not hm:
-                    hm = "No specific help for this command."
-                self.actor.send_message(segs[-1] + " command: " + hm)
+        name = name.removeprefix(static.Message.command_prefix)
+        command = self.actor.get_command(name)
 
-            #Argument is something else
-            else:
-                self.actor.send_message(f"Cannot provide help for '{segs[-1]}' as it is not a registered command.")
+        #Argument is a valid command name or alias
+        if command:
+            hm = command.help_message
+            if not hm:
+                hm = "No specific help for this command."
+            if command.aliases:
+                hm += " Aliases: " + ", ".join(command.aliases)
+            self.actor.send_message(command.name + " command: " + hm)
 
-        #Command has more than one argument
+        #Argument is something else
         else:
-            self.actor.send_message("Invalid number of arguments for help command.")
+            self.actor.send_message(f"Cannot provide help for '{name}' as it is not a registered command.")
 
 class KillswitchCommand(ChatCommand):
     """A killswitch for Rumchat Actor, in case moderators or admin need to shut it down from the chat"""
@@ -346,17 +573,138 @@ class KillswitchCommand(ChatCommand):
         act_props (dict): Message action recorded properties."""
 
         try:
-            self.actor.send_message("Shutting down.")
+            self.actor.send_message("Shutting down.", priority = static.Message.Priority.high)
             self.actor.quit()
         finally:
             print("Killswitch thrown.")
             sys.exit()
 
-class ClipDownloadingCommand(ChatCommand):
+class MetricsCommand(ChatCommand):
+    """Report the slowest message actions, commands and outbox stages in chat, for staff to see what is holding the actor up"""
+    def __init__(self, actor, name = "metrics", allowed_badges = ["moderator"]):
+        """Report the slowest message actions, commands and outbox stages in chat.
+    Instance this object, then pass it to RumbleChatActor().register_command().
+    Run with "reset" after the command name to clear the recorded latencies.
+
+    Args:
+        actor (RumbleChatActor): The RumleChatActor host object.
+        name (str): The !name of the command.
+        allowed_badges (list): Badges that are allowed to run this command.
+            "admin" is added internally.
+            Defaults to ["moderator"]"""
+
+        super().__init__(
+            name = name,
+            actor = actor,
+            exclusive = True,
+            allowed_badges = allowed_badges,
+            args = [Arg("operation", choices = ["reset"])],
+            )
+
+    @property
+    def help_message(self):
+        """The help message for this command"""
+        return "Report the slowest parts of RumChat Actor. Add 'reset' to clear the metrics."
+
+    def run(self, message, act_props: dict):
+        """Report the slowest things by 99th percentile latency
+
+    Args:
+        message (cocorum.ChatAPI.Message): The chat message that called us.
+        act_props (dict): Message action recorded properties."""
+
+        if act_props["command"].args["operation"] == "reset":
+            self.actor.metrics.reset()
+            self.actor.send_message(f"@{message.user.username} Metrics reset.")
+            return
+
+        slowest = self.actor.metrics.slowest()
+        if not slowest:
+            self.actor.send_message(f"@{message.user.username} No metrics recorded yet.")
+            return
+
+        report = "; ".join(
+            f"{kind} {name}: p99 {summary['p99'] * 1000:.0f}ms, {summary['calls']} calls" +
+            (f", {summary['exceptions']} errors" if summary["exceptions"] else "")
+            for kind, name, summary in slowest
+            )
+        self.actor.send_message(f"Slowest: {report}. Outbox depth {self.actor.outbox.depth}.")
+
+class ClipCommand(ChatCommand):
+    """Base class of clip commands, which take an optional duration and an optional clip name"""
+
+    def __init__(self, actor, name = "clip", default_duration = None, max_duration = None, **kwargs):
+        """Base class of clip commands, which take an optional duration and an optional clip name.
+    Subclasses define save_clip(duration, filename), or save_clip(filename) if they take no duration.
+
+    Args:
+        actor (RumbleChatActor): The Rumchat Actor.
+        name (str): The name of the command.
+            Defaults to "clip"
+        default_duration (int): How long the clip will last in seconds if no duration is specified on run.
+            Defaults to None, the command does not take a duration.
+        max_duration (int): How long the clip can be set to be in seconds on run.
+            Defaults to None, no maximum.
+        All other keyword arguments are passed to ChatCommand."""
+
+        args = [Arg("filename", rest = True)]
+        if default_duration:
+            args.insert(0, Arg("duration", int, default = default_duration, minimum = 1, maximum = max_duration))
+
+        super().__init__(name = name, actor = actor, args = args, **kwargs)
+        self.default_duration = default_duration
+        self.max_duration = max_duration
+
+    def ready_to_save(self, message):
+        """Check if we can save a clip right now, telling the user if not
+
+    Args:
+        message (cocorum.ChatAPI.Message): The chat message that called us.
+
+    Returns:
+        Result (bool): Can we save a clip?"""
+
+        return True
+
+    def save_clip(self, duration = None, filename = None):
+        """Start saving a clip, must be overridden.
+    Subclasses with a default duration take the duration first, the others only take the filename.
+
+    Args:
+        duration (int): How long the clip should be, in seconds.
+        filename (str): What to name the saved clip file.
+            Defaults to None, auto-generate a filename.
+
+    Raises:
+        NotImplementedError: The subclass does not save clips."""
+
+        raise NotImplementedError("Clip commands must define save_clip()")
+
+    def run(self, message, act_props: dict):
+        """Make a clip
+
+    Args:
+        message (cocorum.ChatAPI.Message): The chat message that called us.
+        act_props (dict): Message action recorded properties."""
+
+        if not self.ready_to_save(message):
+            return
+
+        args = act_props["command"].args
+        filename = "_".join(args["filename"].split()) if args["filename"] else None
+
+        if self.default_duration:
+            self.save_clip(args["duration"], filename)
+        else:
+            self.save_clip(filename = filename)
+
+
+class ClipDownloadingCommand(ClipCommand):
     """Save clips of the livestream by downloading stream chunks from Rumble, works remotely"""
 
-    def __init__(self, actor, name = "clip", default_duration = 60, max_duration = 120, clip_save_path = "." + os.sep):
+    def __init__(self, actor, name = "clip", default_duration = 60, max_duration = 120, clip_save_path = "." + os.sep, fetcher = None, max_bytes = static.HLS.segment_budget):
         """Save clips of the livestream by downloading stream chunks from Rumble, works remotely.
+    Chunks are downloaded in parallel over pooled connections, and kept in an in-memory ring buffer with a byte budget.
     Instance this object, optionally pass it to the init method of a ClipUploader, then pass it to RumbleChatActor().register_command().
 
     Args:
@@ -369,13 +717,16 @@ class ClipDownloadingCommand(ChatCommand):
             Defaults to 120
         clip_save_path (str): Where to save clips to when they are made.
             Defaults to "."
+        fetcher (hls.Fetcher): The HTTP fetch layer to download playlists and chunks with.
+            Defaults to None, the shared hls.default_fetcher()
+        max_bytes (int): Most bytes of stream chunks to keep in memory for clips.
+            Defaults to static.HLS.segment_budget
         """
 
-        super().__init__(name=name, actor=actor, cooldown=default_duration)
-        self.default_duration = default_duration
-        self.max_duration = max_duration
+        super().__init__(actor, name, default_duration, max_duration, cooldown=default_duration)
         self.clip_save_path = clip_save_path.removesuffix(os.sep) + os.sep #Where to save the completed clips
         self.ready_to_clip = False
+        self.fetcher = fetcher if fetcher is not None else hls.default_fetcher()
 
         # WARNING: These variables are used within threads without mutex. DO NOT REFERENCE EXTERNALLY!
         self.unavailable_qualities = []  # Stream qualities that are not available (cause a 404)
@@ -384,10 +735,8 @@ class ClipDownloadingCommand(ChatCommand):
         # WARNING: These variables are used within threads with mutex.
         self.ts_durations = {}  # The duration of a TS chunk of a given stream quality
         self.ts_durations_mutex = threading.Lock()
-        self.saved_ts = {}  # TS filenames : Tempfile objects containing TS chunks
-        self.saved_ts_mutex = threading.Lock()
-        self.discarded_ts = []  # TS names that were saved then deleted
-        self.discarded_ts_mutex = threading.Lock()
+        self.segments = hls.SegmentStore(max_bytes = max_bytes, max_duration = max_duration)  # Ring buffer of TS chunks, with its own mutex
+        self.playlist = hls.PlaylistTracker()  # Picks the new chunks out of each playlist download
         self.running_clipsaves = 0  # How many clip save operations are running
         self.running_clipsaves_mutex = threading.Lock()
 
@@ -408,19 +757,28 @@ class ClipDownloadingCommand(ChatCommand):
             f"Default duration is {self.default_duration}, max duration is {self.max_duration}."
 
     def get_ts_list(self, quality):
-        """Download an m3u8 playlist and parse it for TS filenames
+        """Download an m3u8 playlist and parse it for TS chunks
+
+    Args:
+        quality (str): The quality specifier used in the TS URL.
+
+    Returns:
+        Segments (list): The hls.PlaylistSegment of each chunk in the playlist."""
+
+        return hls.parse_playlist(self.get_m3u8(quality))
+
+    def get_m3u8(self, quality):
+        """Download an m3u8 playlist
 
     Args:
         quality (str): The quality specifier used in the TS URL.
 
     Returns:
-        Files (list): Lines of the TS playlist that do not start with #"""
+        Playlist (str): The playlist text."""
 
         assert self.ts_url_start and self.m3u8_filename, \
             "Must have the TS URL start and the m3u8 filename before this runs"
-        m3u8 = requests.get(self.ts_url_start.format(quality = quality) + \
-            self.m3u8_filename, timeout = static.REQUEST_TIMEOUT).text
-        return [line for line in m3u8.splitlines() if not line.startswith("#")]
+        return self.fetcher.fetch_text(self.ts_url_start.format(quality = quality) + self.m3u8_filename)
 
     def record_loop(self):
         """Start and run the recorder system"""
@@ -428,7 +786,7 @@ class ClipDownloadingCommand(ChatCommand):
         #Get the base URL for the wualities listing
         m3u8_qualities_url = static.URI.m3u8_qualities_list.format(stream_id_b36 = self.actor.stream_id_b36)
 
-        m3u8_qualities_raw = requests.get(m3u8_qualities_url, timeout = static.REQUEST_TIMEOUT).text
+        m3u8_qualities_raw = self.fetcher.fetch_text(m3u8_qualities_url)
 
         m3u8_quality_urls_all = [line for line in m3u8_qualities_raw.splitlines() if not line.startswith("#")]
         ts_url_default = m3u8_quality_urls_all[-1]
@@ -438,7 +796,7 @@ class ClipDownloadingCommand(ChatCommand):
 
         self.ts_url_start = ts_url_default[:ts_url_default.rfind("/")] + "_{quality}/"
 
-        self.m3u8_filename = ts_url_default[ts_url_default.rfind("/") + 1 ]
+        self.m3u8_filename = ts_url_default[ts_url_default.rfind("/") + 1:]
 
         self.get_quality_info()
 
@@ -467,45 +825,30 @@ class ClipDownloadingCommand(ChatCommand):
         self.ready_to_clip = True
         print("Starting ring buffer TS cache...")
         while self.run_recorder:
-            # Get the list of TS chunks, filtering out TS chunks that we already have / had
+            # Get the TS chunks that were added to the playlist since we last checked
             try:
-                with self.saved_ts_mutex:
-                    with self.discarded_ts_mutex:
-                        new_ts_list = [ts for ts in self.get_ts_list(self.use_quality) if ts not in self.saved_ts.values() and ts not in self.discarded_ts]
-            except (AttributeError, requests.exceptions.ReadTimeout):
+                new_segments = self.playlist.update(self.get_m3u8(self.use_quality))
+            except requests.exceptions.RequestException:
                 print("Failed to get m3u8 playlist")
+                time.sleep(1)
                 continue
 
             # We just started recording, only download the latest TS
-            with self.saved_ts_mutex:
-                with self.discarded_ts_mutex:
-                    if not self.saved_ts:
-                        self.discarded_ts = new_ts_list[:-1]
-                        new_ts_list = new_ts_list[-1:]
-
-            # Save the unsaved TS chunks to temporary files
-            for ts_name in new_ts_list:
-                try:
-                    data = requests.get(self.ts_url_start.format(quality=self.use_quality) + ts_name, timeout=static.REQUEST_TIMEOUT).content
-                except (AttributeError, requests.exceptions.ReadTimeout):  # The request failed or has no content
-                    print("Failed to save ", ts_name)
+            if not len(self.segments):
+                new_segments = new_segments[-1:]
+
+            # The stream restarted, so the held chunks cannot be joined to the new ones, and their names may be reused
+            elif self.playlist.restarted:
+                self.segments.clear()
+
+            # Download the new TS chunks in parallel, and add them to the ring buffer in order.
+            # It evicts the oldest chunks once we have more than enough to fill the max duration
+            ts_url_start = self.ts_url_start.format(quality=self.use_quality)
+            for segment, data in zip(new_segments, self.fetcher.fetch_many(ts_url_start + segment.name for segment in new_segments)):
+                if not data:  # The download failed or has no content
+                    print("Failed to save ", segment.name)
                     continue
-                f = tempfile.NamedTemporaryFile()
-                f.write(data)
-                f.file.close()
-                with self.saved_ts_mutex:
-                    self.saved_ts[ts_name] = f
-
-            # We should be deleting old clips, and we have more than enough to fill the max duration
-            with self.ts_durations_mutex:
-                with self.saved_ts_mutex:
-                    with self.running_clipsaves_mutex:
-                        while not self.running_clipsaves and (len(self.saved_ts) - 1) * self.ts_durations[self.use_quality] > self.max_duration:
-                            oldest_ts = list(self.saved_ts.keys())[0]
-                            self.saved_ts[oldest_ts].close()  # close the tempfile
-                            del self.saved_ts[oldest_ts]
-                            with self.discarded_ts_mutex:
-                                self.discarded_ts.append(oldest_ts)
+                self.segments.append(segment.name, data, segment.duration, segment.discontinuity)
 
             # Wait a moment before the next m3u8 download
             time.sleep(1)
@@ -517,94 +860,61 @@ class ClipDownloadingCommand(ChatCommand):
         assert self.ts_url_start, "Must have start of TS URL before this runs"
         for quality in static.Clip.Download.stream_qualities:
             download_times = []
-            chunk_content = None  # The content of a successful chunk download. used for duration checking
-            for _ in range(static.Clip.Download.speed_test_iter):
+            chunk_content = None  # The content of a successful chunk download
+
+            # Get the playlist once, the chunk downloads are what we time
+            try:
+                r1 = self.fetcher.get(self.ts_url_start.format(quality=quality) + self.m3u8_filename)
+            except requests.exceptions.RequestException:
+                print("Failed to download m3u8 playlist for", quality)
                 r1 = None
-                try:
-                    r1 = requests.get(self.ts_url_start.format(quality=quality) + self.m3u8_filename, timeout=static.REQUEST_TIMEOUT)
-                except requests.exceptions.ReadTimeout:
-                    print("Timeout for m3u8 playlist download")
-                    download_times.append(static.REQUEST_TIMEOUT + 1)
-                    continue
 
-                if r1.status_code == 404:
-                    print("404 for", self.ts_url_start.format(quality=quality) + self.m3u8_filename, "so assuming", quality, "quality is not available.")
-                    self.unavailable_qualities.append(quality)
-                    break
+            if r1 is not None and r1.status_code == 404:
+                print("404 for", self.ts_url_start.format(quality=quality) + self.m3u8_filename, "so assuming", quality, "quality is not available.")
+                self.unavailable_qualities.append(quality)
+                continue
 
-                #Download a chunk and time it
-                ts_chunk_names = [l for l in r1.text if not l.startswith("#")]
+            ts_chunks = hls.parse_playlist(r1.text) if r1 is not None else []
+            for _ in range(static.Clip.Download.speed_test_iter if ts_chunks else 0):
+                #Download a chunk and time it, over the pooled connection like real downloads
                 start_time = time.time()
-                r2 = None
                 try:
-                    r2 = requests.get(self.ts_url_start.format(quality = quality) + ts_chunk_names[-1], timeout = static.REQUEST_TIMEOUT)
-                except requests.exceptions.ReadTimeout:
-                    print("Timeout for TS chunk download")
+                    chunk_content = self.fetcher.fetch(self.ts_url_start.format(quality = quality) + ts_chunks[-1].name)
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    print("TS chunk download unsuccessful:", e)
                     download_times.append(static.REQUEST_TIMEOUT + 1)
                     continue
-                if r2.status_code != 200 or not r2.content:
-                    print("TS chunk download unsuccessful:", r2.status_code)
-                    continue
                 download_times.append(time.time() - start_time)
-                chunk_content = r2.content
 
-            if not download_times and quality not in self.unavailable_qualities:
+            if chunk_content is None:
                 print("No successful chunk downloads for", quality, "so setting it as unavailable")
                 self.unavailable_qualities.append(quality)
                 continue
 
-            #Get chunk duration
-            ts = tempfile.NamedTemporaryFile()
-            ts.write(chunk_content)
-            ts.file.close()
+            #Get chunk duration from the playlist
             with self.ts_durations_mutex:
-                self.ts_durations[quality] = VideoFileClip(ts.name).duration
-            ts.close()
+                self.ts_durations[quality] = sum(chunk.duration for chunk in ts_chunks) / len(ts_chunks)
 
             #Calculate average download time
             self.avg_ts_download_times[quality] = sum(download_times) / len(download_times)
 
-    def run(self, message, act_props: dict):
-        """Make a clip
+    def ready_to_save(self, message):
+        """Check if we have stream chunks to save a clip from, telling the user if not
 
     Args:
         message (cocorum.ChatAPI.Message): The chat message that called us.
-        act_props (dict): Message action recorded properties."""
 
-        # We are not ready for clipping
-        with self.saved_ts_mutex:
-            if not self.ready_to_clip or not (self.is_dvr or self.saved_ts):
-                self.actor.send_message(f"@{message.user.username} Not ready for clip saving yet.")
-                return
+    Returns:
+        Result (bool): Can we save a clip?"""
 
-        segs = message.text.split()
-        #Only called clip, no arguments
-        if len(segs) == 1:
-            self.save_clip(self.default_duration)
+        if not self.ready_to_clip or not (self.is_dvr or len(self.segments)):
+            self.actor.send_message(f"@{message.user.username} Not ready for clip saving yet.")
+            return False
 
-        #Arguments were passed
-        else:
-            #The first argument is a number
-            if segs[1].isnumeric():
-                #Invalid length passed
-                if not 0 < int(segs[1]) <= self.max_duration:
-                    self.actor.send_message(f"@{message.user.username} Invalid clip length.")
-                    return
-
-                #Only length was specified
-                if len(segs) == 2:
-                    self.save_clip(int(segs[1]))
-
-                #A name was also specified
-                else:
-                    self.save_clip(int(segs[1]), "_".join(segs[2:]))
-
-            #The first argument is not a number, treat it as a filename
-            else:
-                self.save_clip(self.default_duration, "_".join(segs[1:]))
+        return True
 
     def save_clip(self, duration, filename=None):
-        """Start a clip saver thread with the given parameters
+        """Start a background clip save with the given parameters
 
     Args:
         duration (int): How long the clip should be.
@@ -619,79 +929,76 @@ class ClipDownloadingCommand(ChatCommand):
         if self.is_dvr:
             available_chunks = self.get_ts_list(self.use_quality)
 
-        # this is a passthrough stream
+        # This is a passthrough stream. Hold the cached chunks now, so they stay valid if the ring buffer evicts them during the save
         else:
-            with self.saved_ts_mutex:
-                available_chunks = list(self.saved_ts.keys())
+            available_chunks = self.segments.snapshot()
 
-        # Not enough TS for the full clip duration
-        with self.ts_durations_mutex:
-            if len(available_chunks) * self.ts_durations[self.use_quality] < duration:
-                print("Not enough TS to fulfil full duration")
-                use_ts = available_chunks
-
-            # We have enough TS
-            else:
-                use_ts = available_chunks[- int(duration / self.ts_durations[self.use_quality] + 0.5):]
+        use_chunks = hls.select_latest(available_chunks, duration)
+        clip_duration = sum(chunk.duration for chunk in use_chunks)
+        if clip_duration < duration:
+            print("Not enough TS to fulfil full duration")
 
-            # No filename specified, construct from time values
-            if not filename:
-                t = time.time()
-                filename = f"{round(t - self.ts_durations[self.use_quality] * len(use_ts))}-{round(t)}"
+        # No filename specified, construct from time values
+        if not filename:
+            t = time.time()
+            filename = f"{round(t - clip_duration)}-{round(t)}"
 
         #Avoid overwriting other clips
         safe_filename = utils.get_safe_filename(self.clip_save_path, filename)
 
-        with self.ts_durations_mutex:
-            self.actor.send_message(f"Saving clip {safe_filename}, duration of {round(self.ts_durations[self.use_quality] * len(use_ts))} seconds.")
+        self.actor.send_message(f"Saving clip {safe_filename}, duration of {round(clip_duration)} seconds.")
 
-        saveclip_thread = threading.Thread(target = self.form_ts_into_clip, args = (safe_filename, use_ts), daemon = True)
-        saveclip_thread.start()
+        use_ts = [chunk.name for chunk in use_chunks]
+        segments = None if self.is_dvr else use_chunks
 
-    def form_ts_into_clip(self, filename, use_ts):
+        self.actor.run_in_background(self.form_ts_into_clip, safe_filename, use_ts, segments)
+
+    def form_ts_into_clip(self, filename, use_ts, segments = None):
         """Do the actual TS [down]loading and processing, and save the video clip.
     This method should be a thread target.
 
     Args:
         filename (str): The base name to save the clip file with, with no extension or path.
-        use_ts (list): The list of TS file names to use for this clip."""
+        use_ts (list): The list of TS file names to use for this clip.
+        segments (list): The hls.Segment chunks to use, held from the ring buffer.
+            Defaults to None, download use_ts for a DVR stream."""
 
         #Download the TS chunks if this is a DVR stream
-        if self.is_dvr:
+        if segments is None:
             print("Downloading TS for clip")
-            tempfiles = []
-            for ts_name in use_ts:
-                try:
-                    data = requests.get(self.ts_url_start.format(quality=self.use_quality) + ts_name, timeout=static.REQUEST_TIMEOUT).content
-                    if not data:
-                        raise ValueError
-                except (ValueError, requests.exceptions.ReadTimeout):  # The request failed or has no content
+            chunks = []
+            ts_url_start = self.ts_url_start.format(quality=self.use_quality)
+            for ts_name, data in zip(use_ts, self.fetcher.fetch_many(ts_url_start + ts_name for ts_name in use_ts)):
+                if not data:  # The request failed or has no content
                     print("Failed to get", ts_name)
                     continue
-                tf = tempfile.NamedTemporaryFile()
-                tf.write(data)
-                tf.file.close()
-                tempfiles.append(tf)
+                chunks.append(data)
 
-        # Select the tempfiles from the TS cache
+        # Use the chunks held from the ring buffer, without copying them
         else:
-            with self.saved_ts_mutex:
-                tempfiles = [self.saved_ts[ts_name] for ts_name in use_ts]
-
-        #Load the TS chunks
-        chunks = [VideoFileClip(tf.name) for tf in tempfiles]
+            chunks = [segment.view() for segment in segments]
 
-        #Concatenate the chunks into a clip
-        clip = concatenate_videoclips(chunks)
+        # TS chunks of one stream can be joined end to end, so write them into one file and load that as the clip
+        tf = tempfile.NamedTemporaryFile(suffix = ".ts")
+        for chunk in chunks:
+            tf.write(chunk)
+        tf.file.close()
+        del chunks, segments
 
         #Save
         print("Saving clip")
         complete_filepath = os.path.join(self.clip_save_path, filename + "." + static.Clip.save_extension)
-        clip.write_videofile(
-            complete_filepath,
-            bitrate = static.Clip.Download.stream_qualities[self.use_quality],
-            logger = None
-        )
+
+        # The chunks are already encoded, so try copying the streams into the new container first
+        if not (static.Clip.Download.stream_copy and hls.remux(tf.name, complete_filepath, moviepy_config.FFMPEG_BINARY)):
+            print("Re-encoding clip")
+            clip = moviepy.VideoFileClip(tf.name)
+            clip.write_videofile(
+                complete_filepath,
+                bitrate = static.Clip.Download.stream_qualities[self.use_quality],
+                logger = None
+            )
+            clip.close()
 
         with self.running_clipsaves_mutex:
             self.running_clipsaves -= 1
@@ -699,10 +1006,7 @@ class ClipDownloadingCommand(ChatCommand):
                 print("ERROR: Running clipsaves is now negative. Resetting it to zero, but this should not happen.")
                 self.running_clipsaves = 0
 
-        #We are responsible for DVR tempfile closing
-        if self.is_dvr:
-            for tf in tempfiles:
-                tf.close()
+        tf.close()
 
         #Upload the clip
         if self.clip_uploader:
@@ -711,7 +1015,7 @@ class ClipDownloadingCommand(ChatCommand):
         print("Complete")
 
 
-class ClipRecordingCommand(ChatCommand):
+class ClipRecordingCommand(ClipCommand):
 
     """Save clips of the livestream by duplicating then trimming an in-progress recording by OBS"""
 
@@ -733,9 +1037,7 @@ class ClipRecordingCommand(ChatCommand):
             Defaults to "."
         """
 
-        super().__init__(name=name, actor=actor, cooldown=default_duration)
-        self.default_duration = default_duration
-        self.max_duration = max_duration
+        super().__init__(actor, name, default_duration, max_duration, cooldown=default_duration)
         self.recording_load_path = recording_load_path.removesuffix(os.sep)  # Where to first look for the OBS recording
         self.clip_save_path = clip_save_path.removesuffix(os.sep) + os.sep  # Where to save the completed clips
         self.running_clipsaves = 0  # How many clip save operations are running, WARNING: Used within thread without mutex!
@@ -755,7 +1057,7 @@ class ClipRecordingCommand(ChatCommand):
         # We do not know the filename yet
         while not self.__recording_filename:
             # Make and hide a background Tk window to allow filedialogs to appear
-            root = Tk()
+            root = tkinter.Tk()
             root.withdraw()
 
             # Ask for the OBS recording in progress
@@ -780,41 +1082,8 @@ class ClipRecordingCommand(ChatCommand):
         """The filename of the temporary recording copy"""
         return static.Clip.Record.temp_copy_fn + "." + self.recording_container
 
-    def run(self, message, act_props: dict):
-        """Make a clip. TODO mostly identical to ClipDownloadingCommand().run()
-
-    Args:
-        message (cocorum.ChatAPI.Message): The chat message that called us.
-        act_props (dict): Message action recorded properties."""
-
-        segs = message.text.split()
-        # Only called clip, no arguments
-        if len(segs) == 1:
-            self.save_clip(self.default_duration)
-
-        # Arguments were passed
-        else:
-            # The first argument is a number
-            if segs[1].isnumeric():
-                # Invalid length passed
-                if not 0 < int(segs[1]) <= self.max_duration:
-                    self.actor.send_message(f"@{message.user.username} Invalid clip length.")
-                    return
-
-                # Only length was specified
-                if len(segs) == 2:
-                    self.save_clip(int(segs[1]))
-
-                # A name was also specified
-                else:
-                    self.save_clip(int(segs[1]), "_".join(segs[2:]))
-
-            # The first argument is not a number, treat it as a filename
-            else:
-                self.save_clip(self.default_duration, "_".join(segs[1:]))
-
     def save_clip(self, duration, filename: str = None):
-        """Start a clip saver thread with the given parameters
+        """Start a background clip save with the given parameters
 
     Args:
         duration (int): The length of the clip in seconds.
@@ -832,9 +1101,8 @@ class ClipRecordingCommand(ChatCommand):
         # Report clip save
         self.actor.send_message(f"Saving clip {safe_filename}, duration of {duration} seconds.")
 
-        # Run the clip save in a thread
-        saveclip_thread = threading.Thread(target=self.form_recording_into_clip, args=(duration, safe_filename), daemon=True)
-        saveclip_thread.start()
+        # Run the clip save in the background
+        self.actor.run_in_background(self.form_recording_into_clip, duration, safe_filename)
 
     def form_recording_into_clip(self, duration, filename):
         """Do the actual file operations to save a clip.
@@ -850,10 +1118,10 @@ class ClipRecordingCommand(ChatCommand):
         print("Making frozen copy of recording")
         shutil.copy(self.recording_filename, self.recording_copy_fn)
         print("Loading copy")
-        recording = VideoFileClip(self.recording_copy_fn)
+        recording = moviepy.VideoFileClip(self.recording_copy_fn)
         print("Saving trimmed clip")
         complete_path = os.path.join(self.clip_save_path, filename + "." + static.Clip.save_extension)
-        ffmpeg_extract_subclip(self.recording_copy_fn, max((recording.duration - duration, 0)), recording.duration, targetname = complete_path)
+        ffmpeg_tools.ffmpeg_extract_subclip(self.recording_copy_fn, max((recording.duration - duration, 0)), recording.duration, targetname = complete_path)
         print("Closing and deleting frozen copy")
         recording.close()
         os.system("rm " + self.recording_copy_fn)
@@ -869,7 +1137,7 @@ class ClipRecordingCommand(ChatCommand):
             self.clip_uploader.upload_clip(filename, complete_path)
 
 
-class ClipReplayBufferCommand(ChatCommand):
+class ClipReplayBufferCommand(ClipCommand):
     """Save clips of the livestream by triggering OBS to save its replay buffer"""
 
     def __init__(self, actor, name="clip", cooldown=120, addr="localhost", port=4455, password="", save_format=static.Clip.save_extension):
@@ -936,24 +1204,8 @@ class ClipReplayBufferCommand(ChatCommand):
             return
         self.__running_clipsaves = new
 
-    def run(self, message, act_props: dict):
-        """Make a clip. TODO mostly identical to ClipDownloadingCommand().run()
-
-    Args:
-        message (cocorum.ChatAPI.Message): The chat message that called us.
-        act_props (dict): Message action recorded properties."""
-
-        segs = message.text.split()
-        # Only called clip, no arguments
-        if len(segs) == 1:
-            self.save_clip()
-
-        # A name was passed
-        else:
-            self.save_clip("_".join(segs[1:]))
-
     def save_clip(self, filename=None):
-        """Start a clip saver thread with the given parameters
+        """Start a background clip save with the given parameters
 
     Args:
         filename (str): The base filename of the clip, with no path or extension.
@@ -972,9 +1224,8 @@ class ClipReplayBufferCommand(ChatCommand):
             # Report clip save
             self.actor.send_message("Saving clip with default filename.")
 
-        # Run the clip save in a thread
-        saveclip_thread = threading.Thread(target=self.save_buffer_as_clip, args=[filename], daemon=True)
-        saveclip_thread.start()
+        # Run the clip save in the background
+        self.actor.run_in_background(self.save_buffer_as_clip, filename)
 
     def save_buffer_as_clip(self, desired_filename):
         """Do the actual file operations to save a clip.
@@ -1053,7 +1304,14 @@ class RaffleCommand(ChatCommand):
             Defaults to "raffle"
 """
 
-        super().__init__(name=name, actor=actor)
+        super().__init__(
+            name=name,
+            actor=actor,
+            args=[
+                Arg("operation", required=True, choices=lambda: self.operations),
+                Arg("username", transform=lambda username: username.removeprefix("@")),
+                ],
+            )
 
         # Username entries in the raffle
         self.entries = []
@@ -1100,26 +1358,23 @@ class RaffleCommand(ChatCommand):
         message (cocorum.ChatAPI.Message): The chat message that called us.
         act_props (dict): Message action recorded properties."""
 
-        segs = message.text.split()
-        # Only called command, no arguments
-        if len(segs) == 1:
-            # self.actor.send_message(self.help_message)
-            print(f"{message.user.username} called the raffle command but without an argument. No action taken.")
-            return
+        self.operations[act_props["command"].args["operation"]](message, act_props)
 
-        # Valid argument
-        if segs[1] in self.operations:
-            self.operations[segs[1]](message)
+    def argument_error(self, message, error: ArgumentError):
+        """The raffle command was called with invalid arguments, which we do not reply to in chat
 
-        # Invalid argument
-        else:
-            print(f"{message.user.username} called the raffle command but with invalid argument(s): {", ".join(segs[1:])}. No action taken.")
+    Args:
+        message (cocorum.ChatAPI.Message): The chat message that called us.
+        error (ArgumentError): What was wrong with the arguments."""
+
+        print(f"{message.user.username} called the raffle command but with invalid argument(s): {error}. No action taken.")
 
-    def make_entry(self, message):
+    def make_entry(self, message, act_props: dict):
         """Make an entry
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the user who wishes to enter."""
+        message (cocorum.ChatAPI.Message): The message of the user who wishes to enter.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
         if message.user.username in self.entries:
             print(f"{message.user.username} is already in the raffle.")
@@ -1128,18 +1383,15 @@ class RaffleCommand(ChatCommand):
         self.entries.append(message.user.username)
         print(f"{message.user.username} has entered the raffle.")
 
-    def remove_entry(self, message):
+    def remove_entry(self, message, act_props: dict):
         """Remove an entry
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the removal request."""
+        message (cocorum.ChatAPI.Message): The message of the removal request.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
-        segs = message.text.split()
         # No username argument, the user wishes to remove themselves
-        if len(segs) == 2:
-            removal = message.user.username
-        else:
-            removal = segs[2].removesuffix("@")
+        removal = act_props["command"].args["username"] or message.user.username
 
         # Non-staff is trying to remove someone besides themselves
         if not utils.is_staff(message.user) and removal != message.user.username:
@@ -1154,22 +1406,24 @@ class RaffleCommand(ChatCommand):
         self.entries.remove(removal)
         self.actor.send_message(f"@{message.user.username} The user {removal} was removed from the raffle.")
 
-    def count_entries(self, message):
+    def count_entries(self, message, act_props: dict):
         """Report the number of entries made so far
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the count request."""
+        message (cocorum.ChatAPI.Message): The message of the count request.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
         count = len(self.entries)
 
         # Some formatting here to make the grammar of the message always correct
         self.actor.send_message(f"@{message.user.username} There {("are", "is")[count == 1]} currently {("no", count)[count != 0]} {("entries", "entry")[count == 1]} in the raffle.")
 
-    def draw_entry(self, message):
+    def draw_entry(self, message, act_props: dict):
         """Draw a winner (does not delete their name from the hat)
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the winner draw request."""
+        message (cocorum.ChatAPI.Message): The message of the winner draw request.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
         if not utils.is_staff(message.user):
             print(f"{message.user.username} tried to draw a raffle winner without the authority to do so.")
@@ -1180,13 +1434,14 @@ class RaffleCommand(ChatCommand):
             return
 
         self.winner = random.choice(self.entries)
-        self.report_winner(message)
+        self.report_winner(message, act_props)
 
-    def report_winner(self, message):
+    def report_winner(self, message, act_props: dict):
         """Report the current winner
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the winner display request."""
+        message (cocorum.ChatAPI.Message): The message of the winner display request.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
         if not self.winner:
             self.actor.send_message(f"@{message.user.username} There is no current winner.")
@@ -1194,11 +1449,12 @@ class RaffleCommand(ChatCommand):
 
         self.actor.send_message(f"@{message.user.username} The winner of the raffle is @{self.winner}")
 
-    def reset(self, message):
+    def reset(self, message, act_props: dict):
         """Reset the raffle
 
     Args:
-        message (cocorum.ChatAPI.Message): The message of the reset request."""
+        message (cocorum.ChatAPI.Message): The message of the reset request.
+        act_props (dict): Message action recorded properties, with the parsed raffle arguments."""
 
         if not utils.is_staff(message.user):
             print(f"{message.user.username} tried to reset the raffle without the authority to do so.")
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""HLS
+
+Fetching and buffering of livestream HLS playlists and TS chunks for clipping.
+S.D.G."""
+
+import collections
+import concurrent.futures
+import random
+import subprocess
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from . import static
+
+
+class Fetcher:
+    """Shared HTTP fetch layer with keep-alive connection pooling and a bounded parallel download pool"""
+
+    def __init__(self, **kwargs):
+        """Shared HTTP fetch layer with keep-alive connection pooling and a bounded parallel download pool.
+    Requests reuse pooled connections instead of opening a new one each time,
+    failed requests are retried with backoff, and batches of chunks are downloaded in parallel
+    but handed back in their original order.
+
+    Args:
+        workers (int): How many downloads may run at once.
+            Defaults to static.HLS.fetch_workers
+        retries (int): How many times to retry a failed request.
+            Defaults to static.HLS.retries
+        retry_backoff (float): Delay before the first retry, doubling after that, in seconds.
+            Defaults to static.HLS.retry_backoff
+        timeout (float): Timeout of each request, in seconds.
+            Defaults to static.REQUEST_TIMEOUT"""
+
+        self.workers = kwargs.get("workers", static.HLS.fetch_workers)
+        self.retries = kwargs.get("retries", static.HLS.retries)
+        self.retry_backoff = kwargs.get("retry_backoff", static.HLS.retry_backoff)
+        self.timeout = kwargs.get("timeout", static.REQUEST_TIMEOUT)
+
+        # One pooled session, with enough connections per host for every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = static.HLS.pool_hosts, pool_maxsize = self.workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix = "hls-fetch")
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.request_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.bytes_fetched = 0
+
+    def get(self, url: str):
+        """Make a GET request, retrying with backoff on connection errors, timeouts and server errors
+
+    Args:
+        url (str): The URL to get.
+
+    Returns:
+        Response (requests.Response): The response. Client errors like 404 are returned, not retried.
+
+    Raises:
+        requests.exceptions.RequestException: The request kept failing."""
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self.__lock:
+                    self.retry_count += 1
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            with self.__lock:
+                self.request_count += 1
+            try:
+                response = self.session.get(url, timeout = self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.retries:
+                    with self.__lock:
+                        self.failed_count += 1
+                    raise
+                print(f"Retrying {url} after error: {e}")
+                continue
+
+            if response.status_code >= 500 and attempt < self.retries:
+                print(f"Retrying {url} after status {response.status_code}")
+                continue
+
+            with self.__lock:
+                self.bytes_fetched += len(response.content)
+            return response
+
+    def fetch(self, url: str):
+        """Download the content at a URL
+
+    Args:
+        url (str): The URL to download.
+
+    Returns:
+        Content (bytes): The downloaded content.
+
+    Raises:
+        requests.exceptions.RequestException: The download failed.
+        ValueError: The download had no content."""
+
+        response = self.get(url)
+        response.raise_for_status()
+        if not response.content:
+            raise ValueError(f"No content at {url}")
+        return response.content
+
+    def fetch_text(self, url: str):
+        """Download the text at a URL, like an m3u8 playlist
+
+    Args:
+        url (str): The URL to download.
+
+    Returns:
+        Text (str): The downloaded text.
+
+    Raises:
+        requests.exceptions.RequestException: The download failed."""
+
+        response = self.get(url)
+        response.raise_for_status()
+        return response.text
+
+    def submit(self, url: str):
+        """Download the content at a URL in the background
+
+    Args:
+        url (str): The URL to download.
+
+    Returns:
+        Content (concurrent.futures.Future): The downloaded content."""
+
+        return self.pool.submit(self.fetch, url)
+
+    def fetch_many(self, urls):
+        """Download several URLs in parallel, returning the results in the order of the URLs
+
+    Args:
+        urls (iterable): The URLs to download.
+
+    Returns:
+        Contents (list): The downloaded content of each URL, or None where the download failed."""
+
+        urls = list(urls)
+        futures = [self.submit(url) for url in urls]
+        contents = []
+        for url, future in zip(urls, futures):
+            try:
+                contents.append(future.result())
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Failed to download {url}: {e}")
+                contents.append(None)
+
+        return contents
+
+    def close(self):
+        """Stop the download pool and close the pooled connections"""
+        self.pool.shutdown(wait = False, cancel_futures = True)
+        self.session.close()
+
+
+class PlaylistSegment:
+    """One TS chunk listed in an m3u8 playlist"""
+
+    __slots__ = ("name", "sequence", "duration", "discontinuity")
+
+    def __init__(self, name: str, sequence: int, duration: float, discontinuity: bool = False):
+        """One TS chunk listed in an m3u8 playlist
+
+    Args:
+        name (str): The URI of the chunk, relative to the playlist.
+        sequence (int): The media sequence number of the chunk.
+        duration (float): How long the chunk plays for according to its EXTINF tag, in seconds.
+        discontinuity (bool): Does the stream encoding change or restart at this chunk?
+            Defaults to False"""
+
+        self.name = name
+        self.sequence = sequence
+        self.duration = duration
+        self.discontinuity = discontinuity
+
+    def __repr__(self):
+        """The playlist chunk in string form"""
+        return f"PlaylistSegment({self.name!r}, {self.sequence}, {self.duration})"
+
+
+def parse_playlist(text: str):
+    """Parse an m3u8 media playlist for its TS chunks
+
+    Args:
+        text (str): The playlist text.
+
+    Returns:
+        Segments (list): The PlaylistSegment of each chunk, in playlist order."""
+
+    segments = []
+    sequence = 0  # The first chunk is 0 if the playlist does not say
+    duration = 0.0
+    discontinuity = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            try:
+                sequence = int(line.split(":", 1)[1])
+            except ValueError:
+                print("Error: Bad media sequence tag in playlist:", line)
+
+        elif line.startswith("#EXTINF:"):
+            try:
+                duration = float(line.split(":", 1)[1].split(",", 1)[0])
+            except ValueError:
+                print("Error: Bad EXTINF tag in playlist:", line)
+                duration = 0.0
+
+        elif line == "#EXT-X-DISCONTINUITY":
+            discontinuity = True
+
+        # Any other tag or comment
+        elif line.startswith("#"):
+            continue
+
+        # The URI of a chunk, which the tags before it describe
+        else:
+            segments.append(PlaylistSegment(line, sequence, duration, discontinuity))
+            sequence += 1
+            duration = 0.0
+            discontinuity = False
+
+    return segments
+
+
+class PlaylistTracker:
+    """Follows a live m3u8 playlist as it is downloaded again and again, picking out the new chunks"""
+
+    def __init__(self, **kwargs):
+        """Follows a live m3u8 playlist as it is downloaded again and again, picking out the new chunks.
+    Chunks are told apart by media sequence number, which only goes up,
+    so only the newest number seen is kept to pick out new chunks no matter how long the stream runs.
+    The names of recent chunks are remembered too, in bounded memory,
+    to follow playlists with no media sequence and to tell a stream restart from a stale playlist copy.
+
+    Args:
+        restart_gap (int): How many chunks the sequence must go back by to count as a stream restart
+            even if the chunk names were seen before.
+            Smaller steps back to seen chunks are stale playlist copies, like from a lagging CDN edge, and are ignored.
+            Defaults to static.HLS.restart_gap
+        remembered (int): How many recent chunk names to remember.
+            Defaults to static.HLS.remembered_segments"""
+
+        self.restart_gap = kwargs.get("restart_gap", static.HLS.restart_gap)
+        self.last_sequence = None
+
+        # Names of recently returned chunks, bounded
+        self.__names = collections.deque(maxlen = kwargs.get("remembered", static.HLS.remembered_segments))
+        self.__name_set = set()
+
+        # Did the last update start over because the stream restarted?
+        self.restarted = False
+
+    def seen(self, name: str):
+        """Was a chunk returned recently?
+
+    Args:
+        name (str): The chunk name.
+
+    Returns:
+        Result (bool): Is the name among the recently returned chunks?"""
+
+        return name in self.__name_set
+
+    def __remember(self, segments):
+        """Remember the names of returned chunks"""
+        for segment in segments:
+            if len(self.__names) == self.__names.maxlen:
+                self.__name_set.discard(self.__names[0])
+            self.__names.append(segment.name)
+            self.__name_set.add(segment.name)
+
+    def update(self, text: str):
+        """Parse a fresh download of the playlist
+
+    Args:
+        text (str): The playlist text.
+
+    Returns:
+        Segments (list): The PlaylistSegment of each chunk not returned before, in playlist order."""
+
+        self.restarted = False
+        segments = parse_playlist(text)
+        if not segments:
+            return []
+
+        # Without a media sequence every download numbers its chunks from 0, so go by name
+        if "#EXT-X-MEDIA-SEQUENCE:" not in text:
+            segments = [segment for segment in segments if not self.seen(segment.name)]
+
+        elif self.last_sequence is not None and segments[-1].sequence <= self.last_sequence:
+            # The sequence went far backwards, or back to chunks we have never seen,
+            # so the stream restarted and the chunks cannot be joined to the earlier ones
+            if segments[-1].sequence + self.restart_gap < self.last_sequence \
+                    or not any(self.seen(segment.name) for segment in segments):
+                print("Playlist media sequence went backwards, starting over")
+                self.restarted = True
+                self.__names.clear()
+                self.__name_set.clear()
+                segments[0].discontinuity = True
+
+            # A stale playlist copy has nothing new
+            else:
+                return []
+
+        # Only keep chunks newer than the last ones returned
+        elif self.last_sequence is not None:
+            segments = [segment for segment in segments if segment.sequence > self.last_sequence]
+
+        if segments:
+            self.last_sequence = segments[-1].sequence
+        self.__remember(segments)
+        return segments
+
+    def reset(self):
+        """Forget the chunks returned so far"""
+        self.last_sequence = None
+        self.__names.clear()
+        self.__name_set.clear()
+        self.restarted = False
+
+
+class Segment:
+    """One downloaded TS chunk"""
+
+    __slots__ = ("name", "data", "duration", "discontinuity")
+
+    def __init__(self, name: str, data: bytes, duration: float, discontinuity: bool = False):
+        """One downloaded TS chunk
+
+    Args:
+        name (str): The name of the chunk in the playlist.
+        data (bytes): The TS content of the chunk.
+        duration (float): How long the chunk plays for, in seconds.
+        discontinuity (bool): Does the stream encoding change or restart at this chunk?
+            Defaults to False"""
+
+        self.name = name
+        self.data = data
+        self.duration = duration
+        self.discontinuity = discontinuity
+
+    def __len__(self):
+        """The size of the chunk in bytes"""
+        return len(self.data)
+
+    def view(self):
+        """Get a zero-copy view of the chunk content
+
+    Returns:
+        View (memoryview): The chunk content."""
+
+        return memoryview(self.data)
+
+
+class SegmentStore:
+    """In-memory ring buffer of TS chunks with a byte budget"""
+
+    def __init__(self, **kwargs):
+        """In-memory ring buffer of TS chunks with a byte budget.
+    Appending and evicting a chunk are O(1), and evicting never waits for clip saves:
+    a snapshot holds references to its chunks, which keeps them alive until the save drops it,
+    without copying them or pausing the buffer.
+
+    Args:
+        max_bytes (int): Most bytes of chunks to keep.
+            Defaults to static.HLS.segment_budget
+        max_duration (float): Evict chunks no longer needed to cover this many seconds.
+            Defaults to None, only evict by bytes."""
+
+        self.max_bytes = kwargs.get("max_bytes", static.HLS.segment_budget)
+        self.max_duration = kwargs.get("max_duration")
+
+        self.__segments = collections.deque()
+        self.__by_name = {}
+        self.__lock = threading.Lock()
+
+        # Running totals of the held chunks
+        self.__bytes = 0
+        self.__duration = 0.0
+
+        # Statistics
+        self.evicted_count = 0
+
+    def __len__(self):
+        """The number of chunks held"""
+        return len(self.__segments)
+
+    def __contains__(self, name):
+        """Is a chunk held?"""
+        return name in self.__by_name
+
+    @property
+    def size(self):
+        """The total bytes of chunks held"""
+        return self.__bytes
+
+    @property
+    def duration(self):
+        """The total duration of chunks held, in seconds"""
+        return self.__duration
+
+    def append(self, name: str, data: bytes, duration: float = 0.0, discontinuity: bool = False):
+        """Add a chunk as the newest, evicting the oldest chunks that are over budget
+
+    Args:
+        name (str): The name of the chunk in the playlist.
+        data (bytes): The TS content of the chunk.
+        duration (float): How long the chunk plays for, in seconds.
+            Defaults to 0.0
+        discontinuity (bool): Does the stream encoding change or restart at this chunk?
+            Defaults to False
+
+    Returns:
+        Evicted (int): How many chunks were evicted."""
+
+        segment = Segment(name, bytes(data), duration, discontinuity)
+        evicted = 0
+        with self.__lock:
+            if name in self.__by_name:
+                print("Already holding a TS chunk named", name, "so not adding it again")
+                return 0
+
+            self.__segments.append(segment)
+            self.__by_name[name] = segment
+            self.__bytes += len(segment)
+            self.__duration += duration
+
+            # Always keep the newest chunk
+            while len(self.__segments) > 1 and self.__over_budget():
+                oldest = self.__segments.popleft()
+                del self.__by_name[oldest.name]
+                self.__bytes -= len(oldest)
+                self.__duration -= oldest.duration
+                evicted += 1
+
+            self.evicted_count += evicted
+
+        return evicted
+
+    def __over_budget(self):
+        """Should the oldest chunk be evicted? (lock must be held)"""
+        if self.__bytes > self.max_bytes:
+            return True
+
+        # The rest still covers the max duration without the oldest chunk
+        return self.max_duration is not None and self.__duration - self.__segments[0].duration >= self.max_duration
+
+    def names(self):
+        """Get the names of the held chunks
+
+    Returns:
+        Names (list): The chunk names, oldest first."""
+
+        with self.__lock:
+            return [segment.name for segment in self.__segments]
+
+    def snapshot(self, names = None):
+        """Get held chunks to save, which stay valid after they are evicted
+
+    Args:
+        names (iterable): The names of the chunks to get, skipping any no longer held.
+            Defaults to None, get all held chunks.
+
+    Returns:
+        Segments (list): The Segment objects, in the order asked for."""
+
+        with self.__lock:
+            if names is None:
+                return list(self.__segments)
+            return [self.__by_name[name] for name in names if name in self.__by_name]
+
+    def clear(self):
+        """Drop all held chunks"""
+        with self.__lock:
+            self.__segments.clear()
+            self.__by_name.clear()
+            self.__bytes = 0
+            self.__duration = 0.0
+
+
+def select_latest(segments, duration: float):
+    """Pick the newest chunks that cover a duration and can be joined end to end
+
+    Args:
+        segments (list): PlaylistSegment or Segment chunks, oldest first.
+        duration (float): How many seconds to cover.
+
+    Returns:
+        Segments (list): The picked chunks, oldest first. Less than the duration if there are not enough,
+            or if the stream had a discontinuity, since chunks on both sides of one cannot be joined."""
+
+    picked = []
+    covered = 0.0
+    for segment in reversed(segments):
+        if covered >= duration:
+            break
+        picked.append(segment)
+        covered += segment.duration
+        if segment.discontinuity:
+            break
+
+    picked.reverse()
+    return picked
+
+
+def remux(ts_path: str, output_path: str, ffmpeg: str = "ffmpeg", **kwargs):
+    """Remux a TS file into another container with stream copy, without decoding or re-encoding
+
+    Args:
+        ts_path (str): The TS file, such as chunks of one stream joined end to end.
+        output_path (str): The file to write, with its container chosen by extension.
+        ffmpeg (str): The FFMPEG binary to run.
+            Defaults to "ffmpeg", from the PATH.
+        args (iterable): FFMPEG arguments between the input and the output.
+            Defaults to static.Clip.Download.remux_args
+        timeout (float): How long the remux may take, in seconds.
+            Defaults to static.Clip.Download.remux_timeout
+
+    Returns:
+        Success (bool): Was the file remuxed?"""
+
+    command = [
+        ffmpeg, "-y", "-hide_banner", "-loglevel", "error",
+        "-i", ts_path,
+        *kwargs.get("args", static.Clip.Download.remux_args),
+        output_path,
+        ]
+    try:
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            timeout=kwargs.get("timeout", static.Clip.Download.remux_timeout),
+            )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("Error: Could not run FFMPEG to remux:", e)
+        return False
+
+    if result.returncode:
+        print("Error: FFMPEG remux failed:", result.stderr.strip())
+        return False
+
+    return True
+
+
+# Fetcher shared by the clip commands, created on first use
+_default_fetcher = None
+_default_lock = threading.Lock()
+
+
+def default_fetcher():
+    """Get the shared Fetcher with the default settings
+
+    Returns:
+        Fetcher (Fetcher): The shared fetcher."""
+
+    global _default_fetcher
+    with _default_lock:
+        if not _default_fetcher:
+            _default_fetcher = Fetcher()
+        return _default_fetcher
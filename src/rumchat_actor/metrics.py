@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""Metrics
+
+Latency histograms, call counts and exception counts for message actions, commands
+and outbox stages, queryable from Python or written out in Prometheus text format.
+S.D.G."""
+
+import bisect
+import contextlib
+import inspect
+import os
+import threading
+import time
+from . import static
+
+
+def callable_name(target):
+    """Get a readable name for a message action or other callable
+
+    Args:
+        target (callable): The callable to name.
+
+    Returns:
+        Name (str): The class name of a bound method's object, otherwise the qualified name of the callable."""
+
+    # Bound action() method of an action object
+    if inspect.ismethod(target):
+        return type(target.__self__).__name__
+
+    return getattr(target, "__qualname__", None) or type(target).__name__
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, plus call and exception counts"""
+
+    def __init__(self, buckets = static.Metrics.latency_buckets):
+        """Latency histogram with fixed buckets, plus call and exception counts
+
+    Args:
+        buckets (tuple): Upper bounds of the buckets in seconds, in increasing order.
+            Defaults to static.Metrics.latency_buckets"""
+
+        self.buckets = tuple(buckets)
+        # Counts per bucket, the last one is for values above all the bounds
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.exceptions = 0
+
+    def observe(self, value: float, failed: bool = False):
+        """Record one call
+
+    Args:
+        value (float): How long the call took, in seconds.
+        failed (bool): Did the call raise an exception?
+            Defaults to False."""
+
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if failed:
+            self.exceptions += 1
+
+    @property
+    def mean(self):
+        """Average latency in seconds"""
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, fraction: float):
+        """Estimate a latency quantile as the upper bound of the bucket it falls in
+
+    Args:
+        fraction (float): Which quantile, from 0 to 1.
+
+    Returns:
+        Latency (float): The estimated quantile in seconds, capped at the highest latency seen."""
+
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def summary(self):
+        """Summarize the histogram
+
+    Returns:
+        Summary (dict): Calls, exceptions, and mean, p50, p99 and max latency in seconds."""
+
+        return {
+            "calls": self.count,
+            "exceptions": self.exceptions,
+            "mean": self.mean,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            }
+
+
+class Metrics:
+    """Thread-safe registry of latency histograms, counters and gauges"""
+
+    def __init__(self, buckets = static.Metrics.latency_buckets):
+        """Thread-safe registry of latency histograms, counters and gauges.
+    Latencies and counters are keyed by a kind, like "action", "command" or "outbox", and a name.
+
+    Args:
+        buckets (tuple): Upper bounds of the latency buckets in seconds.
+            Defaults to static.Metrics.latency_buckets"""
+
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__histograms = {}
+        self.__counters = {}
+        self.__gauges = {}
+
+        # Writer of the Prometheus text file, and the event to stop it
+        self.__writer_thread = None
+        self.__writer_stop = threading.Event()
+
+    def observe(self, kind: str, name: str, seconds: float, failed: bool = False):
+        """Record the latency of one call
+
+    Args:
+        kind (str): What kind of thing was called, like "action", "command" or "outbox".
+        name (str): The name of the thing that was called.
+        seconds (float): How long the call took.
+        failed (bool): Did the call raise an exception?
+            Defaults to False."""
+
+        with self.__lock:
+            histogram = self.__histograms.get((kind, name))
+            if not histogram:
+                histogram = self.__histograms[(kind, name)] = Histogram(self.buckets)
+            histogram.observe(seconds, failed)
+
+    @contextlib.contextmanager
+    def timer(self, kind: str, name: str):
+        """Time the enclosed block, recording an exception if it raises one
+
+    Args:
+        kind (str): What kind of thing is being called, like "action", "command" or "outbox".
+        name (str): The name of the thing being called."""
+
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, failed)
+
+    def count(self, kind: str, name: str, amount: int = 1):
+        """Increase a counter
+
+    Args:
+        kind (str): What kind of event is being counted.
+        name (str): The name of the event.
+        amount (int): How much to count.
+            Defaults to 1."""
+
+        with self.__lock:
+            self.__counters[(kind, name)] = self.__counters.get((kind, name), 0) + amount
+
+    def set_gauge(self, name: str, value):
+        """Set a gauge
+
+    Args:
+        name (str): The name of the gauge.
+        value (int | float | callable): The value, or a callable that returns the current value when read."""
+
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def get(self, kind: str, name: str):
+        """Get the latency summary of one thing
+
+    Args:
+        kind (str): What kind of thing it is.
+        name (str): The name of the thing.
+
+    Returns:
+        Summary (dict | None): See Histogram.summary(), or None if it was never called."""
+
+        with self.__lock:
+            histogram = self.__histograms.get((kind, name))
+            return histogram.summary() if histogram else None
+
+    def gauges(self):
+        """Read all the gauges
+
+    Returns:
+        Gauges (dict): Current gauge values by name."""
+
+        with self.__lock:
+            gauges = dict(self.__gauges)
+
+        return {name: value() if callable(value) else value for name, value in gauges.items()}
+
+    def snapshot(self):
+        """Get a summary of all the metrics
+
+    Returns:
+        Snapshot (dict): Latency summaries as {kind: {name: summary}}, counters as {kind: {name: count}}, and gauges."""
+
+        latencies = {}
+        counters = {}
+        with self.__lock:
+            for (kind, name), histogram in self.__histograms.items():
+                latencies.setdefault(kind, {})[name] = histogram.summary()
+            for (kind, name), value in self.__counters.items():
+                counters.setdefault(kind, {})[name] = value
+
+        return {"latencies": latencies, "counters": counters, "gauges": self.gauges()}
+
+    def slowest(self, count: int = static.Metrics.summary_length, key: str = "p99"):
+        """Get the slowest things by a latency statistic
+
+    Args:
+        count (int): How many to get.
+            Defaults to static.Metrics.summary_length
+        key (str): The summary statistic to sort by.
+            Defaults to "p99"
+
+    Returns:
+        Slowest (list): (kind, name, summary) tuples, slowest first."""
+
+        with self.__lock:
+            entries = [(kind, name, histogram.summary()) for (kind, name), histogram in self.__histograms.items()]
+
+        entries.sort(key=lambda entry: entry[2][key], reverse=True)
+        return entries[:count]
+
+    def reset(self):
+        """Forget all latencies and counters, but keep the gauges"""
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+
+    @staticmethod
+    def __labels(**labels):
+        """Format Prometheus labels, escaping the values"""
+        return ",".join(f'{key}="{Metrics.__escape(value)}"' for key, value in labels.items())
+
+    @staticmethod
+    def __escape(value):
+        """Escape a Prometheus label value"""
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def to_prometheus(self, prefix: str = static.Metrics.prometheus_prefix):
+        """Render all the metrics in Prometheus text format
+
+    Args:
+        prefix (str): Prefix of the metric names.
+            Defaults to static.Metrics.prometheus_prefix
+
+    Returns:
+        Text (str): The metrics in Prometheus text exposition format."""
+
+        with self.__lock:
+            histograms = [
+                (kind, name, tuple(histogram.bucket_counts), histogram.total, histogram.count, histogram.exceptions)
+                for (kind, name), histogram in sorted(self.__histograms.items())
+                ]
+            counters = sorted(self.__counters.items())
+
+        lines = [
+            f"# HELP {prefix}_latency_seconds Latency of message actions, commands and outbox stages.",
+            f"# TYPE {prefix}_latency_seconds histogram",
+            ]
+        for kind, name, bucket_counts, total, count, _ in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{prefix}_latency_seconds_bucket{{{self.__labels(kind=kind, name=name, le=bound)}}} {cumulative}")
+            lines.append(f"{prefix}_latency_seconds_sum{{{self.__labels(kind=kind, name=name)}}} {total}")
+            lines.append(f"{prefix}_latency_seconds_count{{{self.__labels(kind=kind, name=name)}}} {count}")
+
+        lines.append(f"# HELP {prefix}_exceptions_total Exceptions raised by message actions, commands and outbox stages.")
+        lines.append(f"# TYPE {prefix}_exceptions_total counter")
+        for kind, name, _, _, _, exceptions in histograms:
+            lines.append(f"{prefix}_exceptions_total{{{self.__labels(kind=kind, name=name)}}} {exceptions}")
+
+        lines.append(f"# HELP {prefix}_events_total Counted events.")
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for (kind, name), value in counters:
+            lines.append(f"{prefix}_events_total{{{self.__labels(kind=kind, name=name)}}} {value}")
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename: str, prefix: str = static.Metrics.prometheus_prefix):
+        """Write all the metrics to a Prometheus text file, replacing it atomically so scrapers never see half a file
+
+    Args:
+        filename (str): The file to write, e.g. in the node exporter's textfile collector directory.
+        prefix (str): Prefix of the metric names.
+            Defaults to static.Metrics.prometheus_prefix"""
+
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(temp_filename, filename)
+
+    def start_writer(self, filename: str, interval: float = static.Metrics.prometheus_interval):
+        """Start periodically writing the metrics to a Prometheus text file in the background
+
+    Args:
+        filename (str): The file to write.
+        interval (float): How often to write it, in seconds.
+            Defaults to static.Metrics.prometheus_interval"""
+
+        assert not self.__writer_thread, "Prometheus writer is already running"
+        self.__writer_stop.clear()
+        self.__writer_thread = threading.Thread(target = self.__writer_loop, args = (filename, interval), daemon = True)
+        self.__writer_thread.start()
+
+    def stop_writer(self):
+        """Stop writing the Prometheus text file"""
+        self.__writer_stop.set()
+        self.__writer_thread = None
+
+    def __writer_loop(self, filename, interval):
+        """Write the Prometheus text file until stopped, and once more on the way out"""
+        while not self.__writer_stop.wait(interval):
+            try:
+                self.write_prometheus(filename)
+            except OSError as e:
+                print("Error: Could not write metrics file:", e)
+
+        try:
+            self.write_prometheus(filename)
+        except OSError as e:
+            print("Error: Could not write metrics file:", e)
@@ -20,7 +20,10 @@ class ClipUploader():
     Args:
         actor (RumbleChatActor): The RumbleChatActor() instance
         clip_command (ChatCommand): The clip command instance
-        channel_id (str | int): The name or int ID of the channel to upload to, defaults to no channel (user page)"""
+        channel_id (str | int): The name or int ID of the channel to upload to, defaults to no channel (user page)
+        start_thread (bool): Start uploading clips on our own thread.
+            Pass False and give tick() to AsyncRumbleChatActor().add_timer() to run on the event loop instead.
+            Defaults to True."""
 
         # Save actor
         self.actor = actor
@@ -43,7 +46,8 @@ class ClipUploader():
 
         # Thread to keep uploading clips as they arrive
         self.clip_uploader_thread = threading.Thread(target=self.clip_upload_loop, daemon=True)
-        self.clip_uploader_thread.start()
+        if kwargs.get("start_thread", True):
+            self.clip_uploader_thread.start()
 
     def upload_clip(self, name, complete_path):
         """Add the clip filename to the queue
@@ -75,12 +79,15 @@ class ClipUploader():
 
         print(f"Clip {name} published.")
 
+    def tick(self):
+        """Upload the next clip, if there is one"""
+        try:
+            self.__upload_clip(*self.clips_to_upload.get_nowait())
+        except queue.Empty:
+            pass
+
     def clip_upload_loop(self):
         """Keep uploading clips while actor is alive"""
         while self.actor.keep_running:
-            try:
-                self.__upload_clip(*self.clips_to_upload.get_nowait())
-            except queue.Empty:
-                pass
-
+            self.tick()
             time.sleep(1)
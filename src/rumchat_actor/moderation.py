@@ -0,0 +1,1215 @@
+#!/usr/bin/env python3
+"""Moderation
+
+Automatic chat moderation engines, ready to register as message actions.
+S.D.G."""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from . import utils, static
+
+# Optional dependencies, imported on first use
+ollama = utils.lazy_import("ollama", extra="moderation")
+numpy = utils.lazy_import("numpy", extra="moderation")
+
+# A verdict line in an LLM batch response, like "3: 1"
+VERDICT_LINE = re.compile(r"^\W*(\d+)\s*[:.)\-]\s*([01])\b", re.MULTILINE)
+
+# An emote, like :smile:, and a run of the same emote
+EMOTE_RUN = re.compile(r"(:[\w-]+:)(?:\W*\1)+")
+
+# A character repeated three or more times, collapsed to two so "hellllo" still reads "hello"
+CHARACTER_RUN = re.compile(r"(.)\1{2,}")
+
+# A character repeated at all
+REPEATED_CHARACTER = re.compile(r"(.)\1+")
+
+# Anything that is not a word character, emote colon or space
+NOT_WORDS = re.compile(r"[^\w\s:]+")
+
+# Width of a SimHash in bits
+SIMHASH_BITS = 64
+
+
+def normalize_text(text: str):
+    """Normalize a message text so trivial variations of it match
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Text (str): The text case folded, Unicode normalized without accents,
+            with runs of repeated characters and emotes collapsed, and without punctuation."""
+
+    text = unicodedata.normalize("NFKD", text).casefold()
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = EMOTE_RUN.sub(r"\1", text)
+    text = CHARACTER_RUN.sub(r"\1\1", text)
+    text = NOT_WORDS.sub("", text)
+    return " ".join(text.split())
+
+
+def simhash(text: str):
+    """Get a SimHash of a text, which differs in few bits for similar texts
+
+    Args:
+        text (str): The (normalized) text.
+
+    Returns:
+        Hash (int): The 64 bit SimHash of the character trigrams of the text."""
+
+    padded = f" {text} "
+    shingles = [
+        format(int.from_bytes(hashlib.blake2b(padded[i:i + 3].encode(), digest_size = 8).digest(), "big"), f"0{SIMHASH_BITS}b")
+        for i in range(max(len(padded) - 2, 1))
+        ]
+
+    # Each bit is set if it is set in most of the shingle hashes, counting the bit columns of the binary strings
+    majority = len(shingles) / 2
+    return int("".join("1" if column.count("1") > majority else "0" for column in zip(*shingles)), 2)
+
+
+def trie_regex(words):
+    """Make a regular expression that matches any of many words, structured as a trie so it stays fast for tens of thousands of them
+
+    Args:
+        words (iterable): The words or phrases to match, literally.
+
+    Returns:
+        Pattern (str): The regular expression, without anchors."""
+
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True  # A word ends here
+
+    def build(node):
+        """Build the expression for a trie node"""
+        ends_here = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+
+        if len(branches) == 1 and not ends_here:
+            return branches[0]
+
+        group = "(?:" + "|".join(branches) + ")"
+        return group + "?" if ends_here else group
+
+    return build(trie)
+
+
+class LexicalFilter:
+    """Instant moderation of obviously clean and obviously dirty messages, leaving the rest for a slower tier"""
+
+    def __init__(self, blocklist = static.AutoModerator.blocklist, allowlist = static.AutoModerator.allowlist):
+        """Instant moderation of obviously clean and obviously dirty messages, leaving the rest for a slower tier.
+    Texts and list entries are compared after normalize_text().
+
+    Args:
+        blocklist (iterable): Words and phrases that make a message dirty wherever they appear.
+            Defaults to static.AutoModerator.blocklist
+        allowlist (iterable): Words and emotes that make a message clean if it has nothing else.
+            Defaults to static.AutoModerator.allowlist"""
+
+        self.blocklist = {normalize_text(term) for term in blocklist} - {""}
+        self.allowlist = {normalize_text(term) for term in allowlist} - {""}
+
+        # The allowlist with all repeated characters collapsed, so "loool" matches "lol"
+        self.__allow_collapsed = {REPEATED_CHARACTER.sub(r"\1", term) for term in self.allowlist}
+
+        # All blocked terms in one compiled expression, matching whole words only
+        self.__block_pattern = re.compile(r"(?<!\w)(?:" + trie_regex(self.blocklist) + r")(?!\w)") if self.blocklist else None
+
+        # Statistics
+        self.allowed_count = 0
+        self.blocked_count = 0
+        self.escalated_count = 0
+
+    @classmethod
+    def from_files(cls, blocklist_filename: str = None, allowlist_filename: str = None):
+        """Load a lexical filter from files with one word or phrase per line
+
+    Args:
+        blocklist_filename (str): The blocklist file.
+            Defaults to None, use static.AutoModerator.blocklist
+        allowlist_filename (str): The allowlist file.
+            Defaults to None, use static.AutoModerator.allowlist
+
+    Returns:
+        Filter (LexicalFilter): The loaded filter."""
+
+        def load(filename, default):
+            """Load the lines of a file, or use the default list"""
+            if not filename:
+                return default
+            with open(filename, encoding = "utf-8") as f:
+                return [line.strip() for line in f if line.strip()]
+
+        return cls(load(blocklist_filename, static.AutoModerator.blocklist), load(allowlist_filename, static.AutoModerator.allowlist))
+
+    @property
+    def escalation_rate(self):
+        """Fraction of messages that could not be decided and went to the next tier"""
+        total = self.allowed_count + self.blocked_count + self.escalated_count
+        return self.escalated_count / total if total else 0.0
+
+    def classify(self, text: str):
+        """Decide a message instantly if it is obvious
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Verdict (bool | None): True if clean, False if dirty, or None if the next tier must decide."""
+
+        normalized = normalize_text(text)
+
+        if self.__block_pattern and self.__block_pattern.search(normalized):
+            self.blocked_count += 1
+            return False
+
+        if normalized and all(
+            word in self.allowlist or REPEATED_CHARACTER.sub(r"\1", word) in self.__allow_collapsed
+            for word in normalized.split()
+            ):
+            self.allowed_count += 1
+            return True
+
+        self.escalated_count += 1
+        return None
+
+    def stats(self):
+        """Get the filter statistics
+
+    Returns:
+        Stats (dict): Counts of allowed, blocked and escalated messages, and the escalation rate."""
+
+        return {
+            "allowed": self.allowed_count,
+            "blocked": self.blocked_count,
+            "escalated": self.escalated_count,
+            "escalation_rate": self.escalation_rate,
+            }
+
+
+def hashed_features(text: str, dims: int = static.AutoModerator.classifier_dims):
+    """Get the hashed n-gram features of a message text
+
+    Args:
+        text (str): The message text.
+        dims (int): How many feature buckets to hash into.
+            Defaults to static.AutoModerator.classifier_dims
+
+    Returns:
+        Features (list): Sorted unique feature indices of the words, word pairs and character trigrams of the normalized text."""
+
+    normalized = normalize_text(text)
+    words = normalized.split()
+    padded = f" {normalized} "
+    grams = [f"w {word}" for word in words]
+    grams += [f"b {first} {second}" for first, second in zip(words, words[1:])]
+    grams += [f"c {padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    return sorted({zlib.crc32(gram.encode()) % dims for gram in grams})
+
+
+class VerdictLog:
+    """Append-only log of LLM verdicts, to train a DistilledClassifier from"""
+
+    def __init__(self, filename: str):
+        """Append-only log of LLM verdicts, to train a DistilledClassifier from
+
+    Args:
+        filename (str): The JSON lines file to append verdicts to."""
+
+        self.filename = filename
+        self.__lock = threading.Lock()
+
+    def add(self, text: str, verdict: bool):
+        """Log a verdict
+
+    Args:
+        text (str): The message text.
+        verdict (bool): Is the text clean?"""
+
+        line = json.dumps({"time": time.time(), "text": text, "verdict": verdict}) + "\n"
+        with self.__lock:
+            with open(self.filename, "a", encoding = "utf-8") as f:
+                f.write(line)
+
+    @staticmethod
+    def load(filename: str):
+        """Load logged verdicts, the latest verdict winning for repeated texts
+
+    Args:
+        filename (str): The JSON lines file.
+
+    Returns:
+        Texts (list): The message texts.
+        Verdicts (list): Is each text clean?"""
+
+        verdicts = {}
+        with open(filename, encoding = "utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    verdicts[record["text"]] = bool(record["verdict"])
+
+        return list(verdicts), list(verdicts.values())
+
+
+class DistilledClassifier:
+    """Small linear model on hashed n-grams, trained from logged LLM verdicts, that decides confident messages in microseconds"""
+
+    def __init__(self, dims: int = static.AutoModerator.classifier_dims, confidence: float = static.AutoModerator.classifier_confidence):
+        """Small linear model on hashed n-grams, trained from logged LLM verdicts.
+    Train it with train() or load it with load(), then pass it to a BatchModerator.
+
+    Args:
+        dims (int): How many hashed features to use.
+            Defaults to static.AutoModerator.classifier_dims
+        confidence (float): Probability the model must reach to decide a message, from 0.5 to 1.
+            Defaults to static.AutoModerator.classifier_confidence"""
+
+        assert 0.5 <= confidence <= 1, "Confidence must be from 0.5 to 1"
+        self.dims = dims
+        self.confidence = confidence
+        self.weights = numpy.zeros(dims)
+        self.bias = 0.0
+
+        # Statistics
+        self.decided_count = 0
+        self.escalated_count = 0
+
+    @classmethod
+    def load(cls, filename: str, confidence: float = static.AutoModerator.classifier_confidence):
+        """Load a trained model
+
+    Args:
+        filename (str): The .npz model file, as written by save().
+        confidence (float): Probability the model must reach to decide a message.
+            Defaults to static.AutoModerator.classifier_confidence
+
+    Returns:
+        Classifier (DistilledClassifier): The loaded model."""
+
+        with numpy.load(filename) as data:
+            classifier = cls(int(data["dims"]), confidence)
+            classifier.weights = data["weights"]
+            classifier.bias = float(data["bias"])
+
+        return classifier
+
+    def save(self, filename: str):
+        """Save the model
+
+    Args:
+        filename (str): The .npz file to save to."""
+
+        numpy.savez_compressed(filename, weights = self.weights, bias = self.bias, dims = self.dims)
+
+    def probability(self, text: str):
+        """Score a message
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Probability (float): How likely the message is to be clean, from 0 to 1."""
+
+        features = hashed_features(text, self.dims)
+        if not features:
+            return 1 / (1 + numpy.exp(-self.bias))
+
+        z = self.bias + self.weights[features].sum() / len(features) ** 0.5
+        return float(1 / (1 + numpy.exp(-z)))
+
+    def classify(self, text: str):
+        """Decide a message if the model is confident
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Verdict (bool | None): True if clean, False if dirty, or None if the next tier must decide."""
+
+        p = self.probability(text)
+        if p >= self.confidence:
+            self.decided_count += 1
+            return True
+
+        if p <= 1 - self.confidence:
+            self.decided_count += 1
+            return False
+
+        self.escalated_count += 1
+        return None
+
+    @property
+    def escalation_rate(self):
+        """Fraction of messages that the model was not confident about"""
+        total = self.decided_count + self.escalated_count
+        return self.escalated_count / total if total else 0.0
+
+    def train(self, texts, verdicts, **kwargs):
+        """Train the model by full-batch logistic regression with AdaGrad steps
+
+    Args:
+        texts (list): Message texts.
+        verdicts (list): Is each text clean?
+        epochs (int): Training passes over the data.
+            Defaults to static.AutoModerator.classifier_epochs
+        learning_rate (float): AdaGrad step size.
+            Defaults to static.AutoModerator.classifier_learning_rate
+        l2 (float): L2 regularization strength.
+            Defaults to static.AutoModerator.classifier_l2
+        balanced (bool): Weight the classes equally, since dirty messages are rare.
+            Defaults to True."""
+
+        epochs = kwargs.get("epochs", static.AutoModerator.classifier_epochs)
+        learning_rate = kwargs.get("learning_rate", static.AutoModerator.classifier_learning_rate)
+        l2 = kwargs.get("l2", static.AutoModerator.classifier_l2)
+
+        # Sparse rows of the feature matrix, as flat index, row and value arrays
+        rows, indices, values = [], [], []
+        for row, text in enumerate(texts):
+            features = hashed_features(text, self.dims)
+            rows += [row] * len(features)
+            indices += features
+            values += [1 / len(features) ** 0.5] * len(features)
+        rows, indices, values = numpy.array(rows, dtype = int), numpy.array(indices, dtype = int), numpy.array(values)
+
+        labels = numpy.array(verdicts, dtype = float)
+        count = len(labels)
+        assert count, "No verdicts to train on"
+
+        # Per-example weights, so each class counts equally
+        sample_weights = numpy.ones(count)
+        if kwargs.get("balanced", True) and 0 < labels.sum() < count:
+            clean = labels.sum()
+            sample_weights = numpy.where(labels == 1, count / (2 * clean), count / (2 * (count - clean)))
+
+        squared_gradients = numpy.zeros(self.dims)
+        squared_bias_gradient = 0.0
+        for _ in range(epochs):
+            z = self.bias + numpy.bincount(rows, weights = self.weights[indices] * values, minlength = count)
+            errors = (1 / (1 + numpy.exp(-z)) - labels) * sample_weights
+
+            gradient = numpy.bincount(indices, weights = errors[rows] * values, minlength = self.dims) / count + l2 * self.weights
+            bias_gradient = errors.mean()
+
+            squared_gradients += gradient ** 2
+            squared_bias_gradient += bias_gradient ** 2
+            self.weights -= learning_rate * gradient / (numpy.sqrt(squared_gradients) + 1e-8)
+            self.bias -= learning_rate * bias_gradient / (squared_bias_gradient ** 0.5 + 1e-8)
+
+    def evaluate(self, texts, verdicts):
+        """Evaluate the model against known verdicts
+
+    Args:
+        texts (list): Message texts.
+        verdicts (list): Is each text clean?
+
+    Returns:
+        Results (dict): Overall accuracy, dirty precision and recall, the fraction of messages decided confidently,
+            and the accuracy of those confident decisions."""
+
+        correct = confident = confident_correct = 0
+        true_dirty = predicted_dirty = actual_dirty = 0
+        for text, verdict in zip(texts, verdicts):
+            p = self.probability(text)
+            predicted = p >= 0.5
+            correct += predicted == verdict
+            predicted_dirty += not predicted
+            actual_dirty += not verdict
+            true_dirty += not predicted and not verdict
+            if p >= self.confidence or p <= 1 - self.confidence:
+                confident += 1
+                confident_correct += predicted == verdict
+
+        count = len(verdicts)
+        return {
+            "count": count,
+            "accuracy": correct / count if count else 0.0,
+            "dirty_precision": true_dirty / predicted_dirty if predicted_dirty else 0.0,
+            "dirty_recall": true_dirty / actual_dirty if actual_dirty else 0.0,
+            "coverage": confident / count if count else 0.0,
+            "confident_accuracy": confident_correct / confident if confident else 0.0,
+            }
+
+
+class VerdictCache:
+    """Thread-safe LRU and TTL cache of moderation verdicts, which also finds near-duplicate texts"""
+
+    def __init__(self, **kwargs):
+        """Thread-safe LRU and TTL cache of moderation verdicts, which also finds near-duplicate texts.
+    Texts are normalized first, then near-duplicates are found through a banded SimHash index.
+
+    Args:
+        maxsize (int): Most verdicts to remember.
+            Defaults to static.AutoModerator.cache_size
+        ttl (float): How long to remember a verdict, in seconds.
+            Defaults to static.AutoModerator.cache_ttl
+        distance (int): Most differing SimHash bits for a near-duplicate, 0 to only match exactly.
+            Defaults to static.AutoModerator.near_duplicate_distance
+        bands (int): How many bands to split the SimHash into for the index, must be more than the distance.
+            Defaults to static.AutoModerator.simhash_bands"""
+
+        self.maxsize = kwargs.get("maxsize", static.AutoModerator.cache_size)
+        self.ttl = kwargs.get("ttl", static.AutoModerator.cache_ttl)
+        self.distance = kwargs.get("distance", static.AutoModerator.near_duplicate_distance)
+        self.bands = kwargs.get("bands", static.AutoModerator.simhash_bands)
+        assert self.bands > self.distance, "Need more SimHash bands than the near-duplicate distance to find all near-duplicates"
+        assert SIMHASH_BITS % self.bands == 0, f"SimHash bands must divide {SIMHASH_BITS} bits evenly"
+        self.__band_bits = SIMHASH_BITS // self.bands
+
+        # Normalized text: [verdict, expiry time, simhash], least recently used first
+        self.__entries = collections.OrderedDict()
+
+        # (band number, band value): normalized texts with that band value
+        self.__index = {}
+
+        self.__lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """The number of verdicts remembered"""
+        return len(self.__entries)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups that found a verdict, exact or near-duplicate"""
+        lookups = self.hits + self.near_hits + self.misses
+        return (self.hits + self.near_hits) / lookups if lookups else 0.0
+
+    @property
+    def memory_usage(self):
+        """Approximate memory used by the cache, in bytes"""
+        with self.__lock:
+            return (
+                sys.getsizeof(self.__entries)
+                + sum(sys.getsizeof(key) + sys.getsizeof(entry) for key, entry in self.__entries.items())
+                + sys.getsizeof(self.__index)
+                + sum(sys.getsizeof(keys) for keys in self.__index.values())
+                )
+
+    def stats(self):
+        """Get the cache statistics
+
+    Returns:
+        Stats (dict): Size, hits, near-duplicate hits, misses, hit rate and approximate memory use in bytes."""
+
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "memory": self.memory_usage,
+            }
+
+    def __bands(self, simhash_value):
+        """Split a SimHash into its index bands"""
+        mask = (1 << self.__band_bits) - 1
+        return [(band, simhash_value >> (band * self.__band_bits) & mask) for band in range(self.bands)]
+
+    def __remove(self, key):
+        """Forget a verdict. Must be called with the lock held"""
+        _, _, simhash_value = self.__entries.pop(key)
+        for band in self.__bands(simhash_value):
+            keys = self.__index[band]
+            keys.discard(key)
+            if not keys:
+                del self.__index[band]
+
+    def __near_duplicate(self, simhash_value, now):
+        """Find a live near-duplicate of a SimHash. Must be called with the lock held
+
+    Returns:
+        Key (str | None): The normalized text of the near-duplicate, or None if there is none."""
+
+        for band in self.__bands(simhash_value):
+            for key in self.__index.get(band, ()):
+                _, expiry, other = self.__entries[key]
+                if expiry > now and (simhash_value ^ other).bit_count() <= self.distance:
+                    return key
+
+        return None
+
+    def get(self, text: str):
+        """Look up the verdict of a text or a near-duplicate of it
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Verdict (bool | None): The cached verdict, or None if there is none."""
+
+        key = normalize_text(text)
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry and entry[1] > now:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry:
+                self.__remove(key)
+
+            if self.distance and key:
+                near_key = self.__near_duplicate(simhash(key), now)
+                if near_key is not None:
+                    self.__entries.move_to_end(near_key)
+                    self.near_hits += 1
+                    return self.__entries[near_key][0]
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, verdict: bool):
+        """Remember the verdict of a text
+
+    Args:
+        text (str): The message text.
+        verdict (bool): Is the text clean?"""
+
+        key = normalize_text(text)
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+
+            simhash_value = simhash(key)
+            self.__entries[key] = [verdict, time.time() + self.ttl, simhash_value]
+            for band in self.__bands(simhash_value):
+                self.__index.setdefault(band, set()).add(key)
+
+            # Evict the least recently used verdicts
+            while len(self.__entries) > self.maxsize:
+                self.__remove(next(iter(self.__entries)))
+
+
+class ReputationStore:
+    """Persistent per-user counts of clean and dirty verdicts, to moderate trusted users only by sampling"""
+
+    def __init__(self, filename: str = static.AutoModerator.reputation_filename, **kwargs):
+        """Persistent per-user counts of clean and dirty verdicts.
+    Counts are read from memory and written behind in batches by a background thread,
+    to an SQLite database in WAL mode.
+
+    Args:
+        filename (str): The SQLite database file.
+            Defaults to static.AutoModerator.reputation_filename
+        trust_clean_count (int): Clean messages a user needs to be trusted.
+            Defaults to static.AutoModerator.trust_clean_count
+        trust_max_dirty_ratio (float): Largest share of dirty messages a trusted user may have.
+            Defaults to static.AutoModerator.trust_max_dirty_ratio
+        sample_rate (float): Fraction of trusted users' messages to still moderate.
+            Defaults to static.AutoModerator.trusted_sample_rate
+        flush_interval (float): How often to write changes to the database, in seconds.
+            Defaults to static.AutoModerator.reputation_flush_interval
+        flush_size (int): How many changed users to write early at.
+            Defaults to static.AutoModerator.reputation_flush_size"""
+
+        self.filename = filename
+        self.trust_clean_count = kwargs.get("trust_clean_count", static.AutoModerator.trust_clean_count)
+        self.trust_max_dirty_ratio = kwargs.get("trust_max_dirty_ratio", static.AutoModerator.trust_max_dirty_ratio)
+        self.sample_rate = kwargs.get("sample_rate", static.AutoModerator.trusted_sample_rate)
+        self.flush_interval = kwargs.get("flush_interval", static.AutoModerator.reputation_flush_interval)
+        self.flush_size = kwargs.get("flush_size", static.AutoModerator.reputation_flush_size)
+
+        # The connection belongs to the writer thread once it starts
+        self.__connection = sqlite3.connect(filename, check_same_thread = False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS reputation (username TEXT PRIMARY KEY, clean INTEGER NOT NULL, dirty INTEGER NOT NULL, last_seen REAL NOT NULL)"
+            )
+        self.__connection.commit()
+
+        # Counts of every user as username: [clean, dirty, last seen], and the users changed since the last write
+        self.__counts = {row[0]: list(row[1:]) for row in self.__connection.execute("SELECT username, clean, dirty, last_seen FROM reputation")}
+        self.__dirty_users = set()
+        self.__lock = threading.Lock()
+
+        self.__flush_now = threading.Event()
+        self.running = True
+        self.__thread = threading.Thread(target = self.__writer_loop, daemon = True)
+        self.__thread.start()
+
+        # Statistics
+        self.sampled_count = 0
+        self.skipped_count = 0
+
+    def __len__(self):
+        """Number of users with a reputation"""
+        return len(self.__counts)
+
+    def get(self, username: str):
+        """Get the reputation of a user
+
+    Args:
+        username (str): The user's username.
+
+    Returns:
+        Clean (int): How many of their messages were clean.
+        Dirty (int): How many of their messages were dirty."""
+
+        clean, dirty, _ = self.__counts.get(username, (0, 0, 0))
+        return clean, dirty
+
+    def is_trusted(self, username: str):
+        """Check if a user has earned trust
+
+    Args:
+        username (str): The user's username.
+
+    Returns:
+        Trusted (bool): Does the user have enough clean messages, and few enough dirty ones?"""
+
+        clean, dirty = self.get(username)
+        return clean >= self.trust_clean_count and dirty <= (clean + dirty) * self.trust_max_dirty_ratio
+
+    def should_moderate(self, username: str):
+        """Decide whether to moderate a message, sampling trusted users' messages
+
+    Args:
+        username (str): The username of the message's author.
+
+    Returns:
+        Moderate (bool): Should the message be moderated?"""
+
+        if not self.is_trusted(username):
+            return True
+
+        if random.random() < self.sample_rate:
+            self.sampled_count += 1
+            return True
+
+        self.skipped_count += 1
+        return False
+
+    @property
+    def skip_rate(self):
+        """Fraction of trusted users' messages that were not moderated"""
+        total = self.sampled_count + self.skipped_count
+        return self.skipped_count / total if total else 0.0
+
+    def record(self, username: str, clean: bool):
+        """Record a verdict on a user's message
+
+    Args:
+        username (str): The user's username.
+        clean (bool): Was the message clean?"""
+
+        with self.__lock:
+            counts = self.__counts.setdefault(username, [0, 0, 0])
+            counts[0 if clean else 1] += 1
+            counts[2] = time.time()
+            self.__dirty_users.add(username)
+            if len(self.__dirty_users) >= self.flush_size:
+                self.__flush_now.set()
+
+    def flush(self):
+        """Write changed reputations to the database"""
+        with self.__lock:
+            rows = [(username, *self.__counts[username]) for username in self.__dirty_users]
+            self.__dirty_users.clear()
+
+        if not rows:
+            return
+
+        try:
+            with self.__connection:
+                self.__connection.executemany(
+                    "INSERT INTO reputation (username, clean, dirty, last_seen) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(username) DO UPDATE SET clean = excluded.clean, dirty = excluded.dirty, last_seen = excluded.last_seen",
+                    rows,
+                    )
+        except sqlite3.Error as e:
+            print("Error: Could not write reputations:", e)
+
+            # Try them again next time
+            with self.__lock:
+                self.__dirty_users.update(row[0] for row in rows)
+
+    def close(self):
+        """Write any remaining changes and stop the writer"""
+        self.running = False
+        self.__flush_now.set()
+        self.__thread.join()
+        self.__connection.close()
+
+    def __writer_loop(self):
+        """Write changes behind in batches until closed, and once more on the way out"""
+        while self.running:
+            self.__flush_now.wait(self.flush_interval)
+            self.__flush_now.clear()
+            self.flush()
+
+        self.flush()
+
+
+def parse_verdicts(content: str, count: int):
+    """Parse the per-message verdicts of an LLM batch response
+
+    Args:
+        content (str): The LLM response text.
+        count (int): How many messages were in the batch.
+
+    Returns:
+        Verdicts (dict): Is the message clean, by zero-based index in the batch.
+            Messages the LLM gave no valid verdict for are left out."""
+
+    verdicts = {}
+    for number, verdict in VERDICT_LINE.findall(content):
+        index = int(number) - 1
+        if 0 <= index < count and index not in verdicts:
+            verdicts[index] = verdict == "1"
+
+    return verdicts
+
+
+class BatchModerator:
+    """Moderate messages with an LLM in micro-batches, so throughput scales with chat rate instead of model latency"""
+
+    # Moderation must be able to delete messages before commands run
+    gating = True
+
+    # LLM calls are slow, skip them when far behind chat
+    shedding = static.Message.Shedding.expensive
+
+    def __init__(self, **kwargs):
+        """Moderate messages with an LLM in micro-batches.
+    Messages are collected for a short window and sent as one numbered prompt.
+    Plain chat is not held up: its verdict arrives later and deletes the message if needed.
+    Messages that call a command wait for their verdict, so a dirty message cannot run a command.
+    Instance this object, then pass it to RumbleChatActor().register_message_action()
+
+    Args:
+        model (str): The Ollama model to use.
+            Defaults to static.AutoModerator.llm_model
+        host (str): The Ollama server to use.
+            Defaults to None, the Ollama library default (or the OLLAMA_HOST environment variable).
+        batch_window (float): How long to collect messages into a batch, in seconds.
+            Defaults to static.AutoModerator.batch_window
+        max_batch (int): Most messages to send in one batch.
+            Defaults to static.AutoModerator.max_batch
+        deadline (float): How long to wait for a verdict, in seconds.
+            Defaults to static.AutoModerator.deadline
+        fallback_verdict (bool): Verdict to use if the LLM does not give one in time. True is clean.
+            Defaults to static.AutoModerator.fallback_verdict
+        cache (VerdictCache): Cache of verdicts, so repeated and near-duplicate texts skip the LLM.
+            Defaults to a new VerdictCache, pass None to not cache.
+        prefilter (LexicalFilter): First tier that decides obvious messages instantly, so only ambiguous ones go to the LLM.
+            Defaults to a new LexicalFilter, pass None to send everything on.
+        classifier (DistilledClassifier): Tier after the cache that decides messages it is confident about.
+            Defaults to None, no classifier.
+        verdict_log (str | VerdictLog): Where to log LLM verdicts, for training a DistilledClassifier.
+            Defaults to None, do not log verdicts.
+        reputation (ReputationStore): Store of user reputations, so trusted users are only moderated by sampling.
+            Defaults to None, moderate every user."""
+
+        self.model = kwargs.get("model", static.AutoModerator.llm_model)
+        self.host = kwargs.get("host")
+        self.batch_window = kwargs.get("batch_window", static.AutoModerator.batch_window)
+        self.max_batch = kwargs.get("max_batch", static.AutoModerator.max_batch)
+        assert self.max_batch > 0, "Batches must hold at least one message"
+        self.deadline = kwargs.get("deadline", static.AutoModerator.deadline)
+        self.fallback_verdict = kwargs.get("fallback_verdict", static.AutoModerator.fallback_verdict)
+
+        self.cache = kwargs.get("cache", VerdictCache())
+        self.prefilter = kwargs.get("prefilter", LexicalFilter())
+        self.classifier = kwargs.get("classifier")
+        self.verdict_log = kwargs.get("verdict_log")
+        if isinstance(self.verdict_log, str):
+            self.verdict_log = VerdictLog(self.verdict_log)
+        self.reputation = kwargs.get("reputation")
+
+        # Messages waiting to be moderated, as (text, future) pairs
+        self.__queue = queue.Queue()
+
+        # Verdicts waiting on the LLM by normalized text, so copies of a text share one
+        self.__in_flight = {}
+
+        # The actor whose metrics we have registered our gauges with
+        self.__reporting_to = None
+
+        # The Ollama client and the batching thread, started on first use
+        self.__client = None
+        self.__thread = None
+        self.__lock = threading.Lock()
+        self.running = True
+
+        # Statistics
+        self.batch_count = 0
+        self.verdict_count = 0
+        self.fallback_count = 0
+        self.last_batch_size = 0
+        self.last_batch_time = 0
+
+    @property
+    def backlog(self):
+        """How many distinct texts are waiting on the LLM"""
+        return len(self.__in_flight)
+
+    @property
+    def client(self):
+        """The Ollama client, with the deadline as its timeout"""
+        if not self.__client:
+            self.__client = ollama.Client(host = self.host, timeout = self.deadline)
+        return self.__client
+
+    def submit(self, text: str):
+        """Queue a message text for moderation
+
+    Args:
+        text (str): The message text.
+
+    Returns:
+        Verdict (concurrent.futures.Future): Resolves to True if the message is clean, False if not."""
+
+        future = concurrent.futures.Future()
+        if not self.running:
+            future.fallback = True
+            future.set_result(self.fallback_verdict)
+            return future
+
+        # The message is obviously clean or dirty
+        if self.prefilter and (verdict := self.prefilter.classify(text)) is not None:
+            future.set_result(verdict)
+            return future
+
+        # We already know the verdict of this text or one like it
+        if self.cache is not None and (verdict := self.cache.get(text)) is not None:
+            future.set_result(verdict)
+            return future
+
+        # The distilled classifier is confident about this message
+        if self.classifier and (verdict := self.classifier.classify(text)) is not None:
+            future.set_result(verdict)
+            return future
+
+        key = normalize_text(text)
+        with self.__lock:
+            # A copy of this text is already waiting on the LLM
+            if key in self.__in_flight:
+                return self.__in_flight[key]
+
+            self.__in_flight[key] = future
+            if not self.__thread:
+                self.__thread = threading.Thread(target = self.__batch_loop, daemon = True)
+                self.__thread.start()
+
+        self.__queue.put((text, future))
+        return future
+
+    def __resolve(self, text: str, future, verdict: bool, fallback: bool = False):
+        """Resolve a verdict that was waiting on the LLM
+
+    Args:
+        text (str): The message text.
+        future (concurrent.futures.Future): The verdict to resolve.
+        verdict (bool): Is the text clean?
+        fallback (bool): Is this the fallback verdict? Marks the future so it is not counted towards reputation.
+            Defaults to False."""
+
+        with self.__lock:
+            self.__in_flight.pop(normalize_text(text), None)
+        future.fallback = fallback
+        future.set_result(verdict)
+
+    def close(self, wait: bool = False):
+        """Stop moderating, resolving anything still queued with the fallback verdict
+
+    Args:
+        wait (bool): Wait for the batch in progress to finish and the rest to be resolved.
+            Defaults to False."""
+
+        self.running = False
+        self.__queue.put(None)
+        if wait and self.__thread:
+            self.__thread.join()
+
+    def __batch_loop(self):
+        """Collect messages into batches and moderate them until closed"""
+        while self.running:
+            first = self.__queue.get()
+            if first is None:
+                break
+
+            # Collect more messages until the window closes or the batch is full
+            batch = [first]
+            window_end = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.__queue.get(timeout = max(window_end - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.running = False
+                    break
+                batch.append(item)
+
+            self.moderate_batch(batch)
+
+        # Resolve anything left over
+        while True:
+            try:
+                item = self.__queue.get_nowait()
+            except queue.Empty:
+                return
+            if item:
+                self.__resolve(*item, self.fallback_verdict, fallback = True)
+                self.fallback_count += 1
+
+    def moderate_batch(self, batch):
+        """Moderate a batch of messages with one LLM call, resolving their verdicts
+
+    Args:
+        batch (list): (text, future) pairs to moderate."""
+
+        start = time.time()
+
+        # Number the messages, one per line
+        prompt = "\n".join(f"{i}: {' '.join(text.split())}" for i, (text, _) in enumerate(batch, start = 1))
+
+        try:
+            response = self.client.chat(model = self.model, messages = [
+                {"role": "system", "content": static.AutoModerator.llm_batch_sys_prompt},
+                {"role": "user", "content": prompt},
+                ])
+            verdicts = parse_verdicts(response["message"]["content"], len(batch))
+
+        # The call failed or timed out, fall back for the whole batch
+        except Exception as e:
+            print("Error: LLM moderation batch failed:", repr(e))
+            verdicts = {}
+
+        for i, (text, future) in enumerate(batch):
+            if i in verdicts:
+                self.verdict_count += 1
+                if self.cache is not None:
+                    self.cache.put(text, verdicts[i])
+                if self.verdict_log:
+                    self.verdict_log.add(text, verdicts[i])
+            else:
+                print(f"No LLM verdict for {text}, using fallback verdict.")
+                self.fallback_count += 1
+            self.__resolve(text, future, verdicts.get(i, self.fallback_verdict), fallback = i not in verdicts)
+
+        self.batch_count += 1
+        self.last_batch_size = len(batch)
+        self.last_batch_time = time.time() - start
+
+    def action(self, message, act_props, actor):
+        """Moderate a message, deleting it if needed
+
+    Args:
+        message (cocorum.chatapi.Message): The chat message to run this action on.
+        act_props (dict): Action properties, aka metadata about what other things did with this message
+        actor (RumbleChatActor): The chat actor.
+
+    Returns:
+        act_props (dict): Dictionary of recorded properties from running this action."""
+
+        # Report our statistics with the actor's metrics
+        if self.__reporting_to is not actor:
+            self.__reporting_to = actor
+            self.report_metrics(actor.metrics)
+
+        # Message was blank
+        if not message.text.strip():
+            return {}
+
+        # User has an immunity badge
+        if utils.is_staff(message.user):
+            return {}
+
+        # User is trusted, and this message was not sampled
+        if self.reputation is not None and not self.reputation.should_moderate(message.user.username):
+            return {}
+
+        start = time.perf_counter()
+        future = self.submit(message.text)
+        future.add_done_callback(lambda f: actor.metrics.observe("moderation", "verdict", time.perf_counter() - start))
+
+        # Plain chat is not held up, the verdict deletes it later if needed
+        if not act_props.get("command"):
+            future.add_done_callback(lambda f: self.__on_verdict(f, message, actor))
+            return {}
+
+        # A command must not run until the message is cleared
+        try:
+            clean = self.__on_verdict(future, message, actor, timeout = self.deadline + self.batch_window)
+        except concurrent.futures.TimeoutError:
+            print(f"LLM verdict for {message.text} timed out, using fallback verdict.")
+            clean = self.__apply_verdict(self.fallback_verdict, message, actor)
+
+        if clean:
+            return {}
+        return {"deleted": True}
+
+    def __on_verdict(self, future, message, actor, timeout = None):
+        """Record a verdict in the user's reputation and apply it
+
+    Args:
+        future (concurrent.futures.Future): The verdict.
+        message (cocorum.chatapi.Message): The chat message.
+        actor (RumbleChatActor): The chat actor.
+        timeout (float): How long to wait for the verdict.
+            Defaults to None, it is already resolved.
+
+    Returns:
+        Clean (bool): The verdict."""
+
+        clean = future.result(timeout = timeout)
+
+        # Fallback verdicts say nothing about the user
+        if self.reputation is not None and not getattr(future, "fallback", False):
+            self.reputation.record(message.user.username, clean)
+
+        return self.__apply_verdict(clean, message, actor)
+
+    def report_metrics(self, metrics):
+        """Report the statistics of our tiers as gauges
+
+    Args:
+        metrics (metrics.Metrics): The metrics registry to report to."""
+
+        if self.prefilter:
+            metrics.set_gauge("moderation_escalation_rate", lambda: self.prefilter.escalation_rate)
+
+        if self.cache is not None:
+            metrics.set_gauge("moderation_cache_hit_rate", lambda: self.cache.hit_rate)
+            metrics.set_gauge("moderation_cache_size", lambda: len(self.cache))
+            metrics.set_gauge("moderation_cache_bytes", lambda: self.cache.memory_usage)
+
+        if self.classifier:
+            metrics.set_gauge("moderation_classifier_escalation_rate", lambda: self.classifier.escalation_rate)
+
+        if self.reputation is not None:
+            metrics.set_gauge("moderation_trusted_skip_rate", lambda: self.reputation.skip_rate)
+            metrics.set_gauge("moderation_reputation_users", lambda: len(self.reputation))
+
+        metrics.set_gauge("moderation_backlog", lambda: self.backlog)
+        metrics.set_gauge("moderation_llm_batches", lambda: self.batch_count)
+        metrics.set_gauge("moderation_fallbacks", lambda: self.fallback_count)
+
+    @staticmethod
+    def __apply_verdict(clean: bool, message, actor):
+        """Delete a message if it was verdicted as dirty
+
+    Args:
+        clean (bool): The verdict.
+        message (cocorum.chatapi.Message): The chat message.
+        actor (RumbleChatActor): The chat actor.
+
+    Returns:
+        Clean (bool): The verdict."""
+
+        if clean:
+            return True
+
+        print("LLM verdicted as dirty: " + message.text)
+        actor.delete_message(message)
+        return False
+
+
+# Moderator shared by ollama_message_moderate(), created on first use
+_default_batch_moderator = None
+_default_lock = threading.Lock()
+
+
+def default_batch_moderator():
+    """Get the shared BatchModerator with the default settings
+
+    Returns:
+        Moderator (BatchModerator): The shared moderator."""
+
+    global _default_batch_moderator
+    with _default_lock:
+        if not _default_batch_moderator:
+            _default_batch_moderator = BatchModerator()
+        return _default_batch_moderator
+
+
+def main(argv=None):
+    """Train and evaluate a distilled moderation classifier from the command line
+
+    Args:
+        argv (list): Command line arguments.
+            Defaults to None, use sys.argv
+
+    Returns:
+        Exit code (int): 0 on success."""
+
+    parser = argparse.ArgumentParser(prog="python -m rumchat_actor.moderation", description="Train and evaluate a distilled moderation classifier from logged LLM verdicts")
+    subparsers = parser.add_subparsers(dest="operation", required=True)
+
+    train_parser = subparsers.add_parser("train", help="Train a classifier, holding out some verdicts to evaluate it")
+    train_parser.add_argument("verdict_log", help="JSON lines verdict log, as written by VerdictLog")
+    train_parser.add_argument("model", help="The .npz model file to write")
+    train_parser.add_argument("--holdout", type=float, default=static.AutoModerator.classifier_holdout, help="Fraction of verdicts to hold out for evaluation")
+    train_parser.add_argument("--epochs", type=int, default=static.AutoModerator.classifier_epochs, help="Training passes over the data")
+    train_parser.add_argument("--dims", type=int, default=static.AutoModerator.classifier_dims, help="Number of hashed features")
+    train_parser.add_argument("--seed", type=int, default=0, help="Random seed for the holdout split")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Evaluate a classifier against logged verdicts")
+    evaluate_parser.add_argument("verdict_log", help="JSON lines verdict log, as written by VerdictLog")
+    evaluate_parser.add_argument("model", help="The .npz model file to evaluate")
+
+    for subparser in (train_parser, evaluate_parser):
+        subparser.add_argument("--confidence", type=float, default=static.AutoModerator.classifier_confidence, help="Probability needed to decide a message without the LLM")
+
+    args = parser.parse_args(argv)
+    texts, verdicts = VerdictLog.load(args.verdict_log)
+
+    if args.operation == "train":
+        # Shuffle, then split off the held out verdicts
+        pairs = list(zip(texts, verdicts))
+        random.Random(args.seed).shuffle(pairs)
+        held_out = int(len(pairs) * args.holdout)
+        test, train = pairs[:held_out], pairs[held_out:]
+
+        classifier = DistilledClassifier(args.dims, args.confidence)
+        start = time.time()
+        classifier.train([text for text, _ in train], [verdict for _, verdict in train], epochs=args.epochs)
+        print(f"Trained on {len(train)} verdicts in {time.time() - start:.1f} s")
+        classifier.save(args.model)
+        texts, verdicts = [text for text, _ in test], [verdict for _, verdict in test]
+
+    else:
+        classifier = DistilledClassifier.load(args.model, args.confidence)
+
+    if not texts:
+        print("No verdicts to evaluate against.")
+        return 0
+
+    results = classifier.evaluate(texts, verdicts)
+    print(f"Evaluated on {results['count']} verdicts:")
+    print(f"Accuracy: {results['accuracy']:.1%}, dirty precision: {results['dirty_precision']:.1%}, dirty recall: {results['dirty_recall']:.1%}")
+    print(f"Decided without the LLM: {results['coverage']:.1%}, with accuracy {results['confident_accuracy']:.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
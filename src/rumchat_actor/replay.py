@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""Offline chat replay
+
+Stand-ins for the Cocorum chat API and ServicePHP that replay recorded or synthetic
+chat, so an actor can be load-tested without a live Rumble stream.
+S.D.G."""
+
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+from . import static
+
+
+class ReplayBadge(str):
+    """A user badge, which compares equal to its slug like Cocorum's badges do"""
+
+    @property
+    def slug(self):
+        """The slug of the badge"""
+        return str(self)
+
+
+class ReplayUser:
+    """A chat user in a replayed chat"""
+
+    def __init__(self, username: str, badges=()):
+        """A chat user in a replayed chat
+
+    Args:
+        username (str): The username.
+        badges (list): Badge slugs of the user.
+            Defaults to no badges."""
+
+        self.username = username
+        self.badges = [ReplayBadge(badge) for badge in badges]
+
+    def __str__(self):
+        """The user in string form"""
+        return self.username
+
+
+class ReplayGift:
+    """A subscription gift notification in a replayed chat"""
+
+    def __init__(self, purchased_by: str, total_gifts: int = 1, gift_type: str = "channel"):
+        """A subscription gift notification in a replayed chat
+
+    Args:
+        purchased_by (str): Username of the gifter.
+        total_gifts (int): How many subscriptions were gifted.
+            Defaults to 1.
+        gift_type (str): The type of subscription gifted.
+            Defaults to "channel"."""
+
+        self.purchased_by = purchased_by
+        self.total_gifts = total_gifts
+        self.gift_type = gift_type
+
+
+class ReplayMessage:
+    """A chat message in a replayed chat, with the attributes of a Cocorum chat message that the actor uses"""
+
+    def __init__(self, message_id: int, text: str, user: ReplayUser, send_time: float, **kwargs):
+        """A chat message in a replayed chat
+
+    Args:
+        message_id (int): The unique ID of the message.
+        text (str): The message text.
+        user (ReplayUser): The user who sent the message.
+        send_time (float): When the message was sent, in seconds since the Epoch.
+        rant_cents (int): The rant price of the message.
+            Defaults to 0, not a rant.
+        raid (bool): Is the message a raid notification?
+            Defaults to False.
+        gift (ReplayGift): Gift purchase notification data.
+            Defaults to None, not a gift."""
+
+        self.message_id = message_id
+        self.text = text
+        self.user = user
+        self.time = send_time
+        self.rant_price_cents = kwargs.get("rant_cents", 0)
+        self.raid_notification = kwargs.get("raid", False)
+        self.gift_purchase_notification = kwargs.get("gift") or False
+        self.deleted = False
+
+    def __int__(self):
+        """The chat message in integer (ID) form"""
+        return self.message_id
+
+    def __str__(self):
+        """The chat message in string form"""
+        return self.text
+
+    @property
+    def is_rant(self):
+        """Is this message a rant?"""
+        return self.rant_price_cents > 0
+
+
+class ReplayServicePHP:
+    """Stand-in for a logged in cocorum.servicephp.ServicePHP, doing nothing"""
+
+    def __init__(self, username: str = static.Replay.username):
+        """Stand-in for a logged in cocorum.servicephp.ServicePHP, doing nothing
+
+    Args:
+        username (str): The username we are "logged in" as.
+            Defaults to static.Replay.username"""
+
+        self.username = username
+        self.session_cookie = {}
+
+    def login_basic(self, password):
+        """Pretend to log in
+
+    Args:
+        password (str): Ignored.
+
+    Returns:
+        TwoFA (None): No second factor is needed."""
+
+        return None
+
+    def chat_pin(self, stream_id, message, unpin = False):
+        """Pretend to pin or unpin a chat message
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+    def mute_user(self, username, **kwargs):
+        """Pretend to mute a user
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+    def unmute_user(self, record_id):
+        """Pretend to unmute a user
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+
+class ReplayChatAPI:
+    """Stand-in for cocorum.chatapi.ChatAPI that replays chat records in real time, or faster"""
+
+    def __init__(self, records, speed: float = static.Replay.speed, **kwargs):
+        """Stand-in for cocorum.chatapi.ChatAPI that replays chat records in real time, or faster.
+    Pass an instance to RumbleChatActor() as the chat argument, along with a ReplayServicePHP.
+    Messages the actor sends come back through the chat like they would live.
+
+    Args:
+        records (iterable): Chat records as dicts, ordered by time, see load_recording() for the format.
+        speed (float): How many times faster than recorded to replay the chat.
+            Defaults to static.Replay.speed
+        username (str): The username of the actor, for its echoed messages.
+            Defaults to static.Replay.username
+        send_latency (float): Simulated network time of sending a message, in seconds.
+            Defaults to 0.
+        moderation_latency (float): Simulated network time of deleting a message or muting a user, in seconds.
+            Defaults to 0."""
+
+        assert speed > 0, "Replay speed must be greater than zero"
+        self.speed = speed
+        self.username = kwargs.get("username", static.Replay.username)
+        self.send_latency = kwargs.get("send_latency", 0)
+        self.moderation_latency = kwargs.get("moderation_latency", 0)
+
+        self.__records = iter(records)
+        self.__next_ids = itertools.count(1)
+
+        # Wall clock time and record time that the replay started at, set on the first message
+        self.__start_wall_time = None
+        self.__start_record_time = None
+
+        # The next record, read ahead so we know when it is due
+        self.__pending_record = None
+
+        # Our own sent messages, waiting to come back through the chat
+        self.__echoes = queue.Queue()
+
+        # The last message we delivered that was not an echo, and when
+        self.__last_message = None
+
+        self.chat_running = True
+        self.__lock = threading.Lock()
+
+        # Statistics for load testing
+        self.delivered_count = 0
+        self.lags = []  # How late each message was delivered, in seconds
+        self.latencies = []  # How long after it was sent each message was done processing, in seconds
+        self.sent_messages = []  # (time, text) of messages the actor sent
+        self.deleted_messages = []
+        self.muted_users = []
+
+    def clear_mailbox(self):
+        """Nothing is waiting before the replay starts"""
+
+    def __record_time(self, record):
+        """When a record is due, in wall clock time
+
+    Args:
+        record (dict): The chat record.
+
+    Returns:
+        Time (float): When the record should be delivered, in seconds since the Epoch."""
+
+        if self.__start_wall_time is None:
+            self.__start_wall_time = time.time()
+            self.__start_record_time = record["time"]
+
+        return self.__start_wall_time + (record["time"] - self.__start_record_time) / self.speed
+
+    def __make_message(self, record, send_time):
+        """Make a message from a chat record
+
+    Args:
+        record (dict): The chat record.
+        send_time (float): When the message was sent in the replay.
+
+    Returns:
+        Message (ReplayMessage): The message."""
+
+        gift = record.get("gift")
+        return ReplayMessage(
+            next(self.__next_ids),
+            record["text"],
+            ReplayUser(record["username"], record.get("badges", ())),
+            send_time,
+            rant_cents=record.get("rant_cents", 0),
+            raid=record.get("raid", False),
+            gift=ReplayGift(**gift) if gift else None,
+            )
+
+    def get_message(self):
+        """Return the next chat message, waiting until it is due
+
+    Returns:
+        Message (ReplayMessage | None): The message, or None if the replay is over or chat was closed."""
+
+        now = time.time()
+
+        # The actor asks for the next message once it is done with the last one
+        if self.__last_message:
+            self.latencies.append(now - self.__last_message.time)
+            self.__last_message = None
+
+        while self.chat_running:
+            if self.__pending_record is None:
+                self.__pending_record = next(self.__records, None)
+
+            # The replay is over
+            if self.__pending_record is None:
+                self.chat_running = False
+                break
+
+            due = self.__record_time(self.__pending_record)
+
+            # Deliver our own echoed messages while waiting for the next record
+            try:
+                echo = self.__echoes.get(timeout=max(due - time.time(), 0))
+                if echo:
+                    return echo
+                continue  # Woken up to close
+            except queue.Empty:
+                pass
+
+            message = self.__make_message(self.__pending_record, due)
+            self.__pending_record = None
+            self.delivered_count += 1
+            self.lags.append(time.time() - due)
+            self.__last_message = message
+            return message
+
+        print("Chat has closed.")
+        return None
+
+    def send_message(self, text: str, channel_id: int = None):
+        """Send a message in the replayed chat, which will echo back
+
+    Args:
+        text (str): The message text.
+        channel_id (int): Ignored.
+
+    Returns:
+        ID (int): The ID of the sent message.
+        User (ReplayUser): Our chat user information."""
+
+        assert len(text) <= static.Message.max_len, "Message is too long"
+        time.sleep(self.send_latency)
+        user = ReplayUser(self.username, static.Moderation.staff_badges)
+        message = ReplayMessage(next(self.__next_ids), text, user, time.time())
+        with self.__lock:
+            self.sent_messages.append((message.time, text))
+        self.__echoes.put(message)
+        return message.message_id, user
+
+    def delete_message(self, message):
+        """Delete a message in the replayed chat
+
+    Args:
+        message (ReplayMessage): The message to delete.
+
+    Returns:
+        Result (bool): Always True."""
+
+        time.sleep(self.moderation_latency)
+        if hasattr(message, "deleted"):
+            message.deleted = True
+        with self.__lock:
+            self.deleted_messages.append(message)
+        return True
+
+    def mute_user(self, user, duration: int = None, total: bool = False):
+        """Mute a user in the replayed chat
+
+    Args:
+        user (str): Username to mute.
+        duration (int): How long to mute the user in seconds.
+            Defaults to infinite.
+        total (bool): Wether or not they are muted across all videos.
+            Defaults to False, just this video.
+
+    Returns:
+        Result (bool): Always True."""
+
+        time.sleep(self.moderation_latency)
+        with self.__lock:
+            self.muted_users.append((str(user), duration, total))
+        return True
+
+    def unmute_user(self, user):
+        """Unmute a user in the replayed chat
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+    def pin_message(self, message):
+        """Pin a message in the replayed chat
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+    def unpin_message(self, message = None):
+        """Unpin the pinned message in the replayed chat
+
+    Returns:
+        Result (bool): Always True."""
+
+        return True
+
+    def close(self):
+        """End the replay"""
+        self.chat_running = False
+        self.__echoes.put(None)
+
+
+class ChatRecorder:
+    """Record chat messages to a file, for replaying later"""
+
+    # Recording does not affect other actions or commands
+    gating = False
+
+    def __init__(self, filename: str):
+        """Record chat messages to a file, for replaying later.
+    Instance this object, then pass it to RumbleChatActor().register_message_action()
+
+    Args:
+        filename (str): The JSON lines file to append records to."""
+
+        self.filename = filename
+        self.__lock = threading.Lock()
+
+    def action(self, message, act_props, actor):
+        """Record a chat message
+
+    Args:
+        message (cocorum.chatapi.Message): The chat message to run this action on.
+        act_props (dict): Action properties, aka metadata about what other things did with this message
+        actor (RumbleChatActor): The chat actor.
+
+    Returns:
+        act_props (dict): Dictionary of additional recorded properties from running this action."""
+
+        record = {
+            "time": message.time,
+            "username": message.user.username,
+            "text": message.text,
+            "badges": [getattr(badge, "slug", str(badge)) for badge in message.user.badges],
+            }
+
+        if message.is_rant:
+            record["rant_cents"] = message.rant_price_cents
+
+        if (gift := message.gift_purchase_notification):
+            record["gift"] = {
+                "purchased_by": gift.purchased_by,
+                "total_gifts": gift.total_gifts,
+                "gift_type": gift.gift_type,
+                }
+
+        with self.__lock:
+            with open(self.filename, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        return {}
+
+
+def load_recording(filename: str):
+    """Load chat records from a JSON lines file
+
+    Each line is a JSON object with the keys:
+        - time (float): When the message was sent, in seconds.
+        - username (str): Who sent it.
+        - text (str): The message text.
+        - badges (list, optional): Badge slugs of the user.
+        - rant_cents (int, optional): The rant price.
+        - raid (bool, optional): Is this a raid notification?
+        - gift (dict, optional): purchased_by, total_gifts and gift_type of a subscription gift.
+
+    Args:
+        filename (str): The file to load.
+
+    Returns:
+        Records (list): The chat records, ordered by time."""
+
+    with open(filename, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    records.sort(key=lambda record: record["time"])
+    return records
+
+
+def save_recording(records, filename: str):
+    """Save chat records to a JSON lines file
+
+    Args:
+        records (iterable): The chat records, see load_recording() for the format.
+        filename (str): The file to save to."""
+
+    with open(filename, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def generate_traffic(duration: float = 60, rate: float = 5, **kwargs):
+    """Generate synthetic chat records
+
+    Args:
+        duration (float): How long the chat should last, in seconds.
+            Defaults to 60.
+        rate (float): Average number of normal chat messages per second.
+            Defaults to 5.
+        raids (int): How many raids to include. A raid is a raid notification followed by a burst of new chatters.
+            Defaults to 0.
+        rant_bursts (int): How many bursts of rants to include.
+            Defaults to 0.
+        spam_floods (int): How many floods of one user repeating a message to include.
+            Defaults to 0.
+        gifts (int): How many subscription gift notifications to include.
+            Defaults to 0.
+        chatters (int): How many regular chatters there are.
+            Defaults to static.Replay.chatters
+        seed (int): Random seed, for repeatable traffic.
+            Defaults to None, random.
+
+    Returns:
+        Records (list): The chat records, ordered by time, see load_recording() for the format."""
+
+    rng = random.Random(kwargs.get("seed"))
+    chatters = [f"chatter{i}" for i in range(kwargs.get("chatters", static.Replay.chatters))]
+    words = static.Replay.vocabulary
+
+    def chatter_text():
+        """Some random chatter"""
+        return " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+
+    records = []
+
+    # Normal chat, with exponential gaps between messages
+    t = rng.expovariate(rate) if rate > 0 else duration
+    while t < duration:
+        records.append({"time": t, "username": rng.choice(chatters), "text": chatter_text()})
+        t += rng.expovariate(rate)
+
+    # Raids: a notification, then a burst of new chatters saying hello
+    for i in range(kwargs.get("raids", 0)):
+        start = rng.uniform(0, duration)
+        raider = f"raider{i}"
+        size = rng.randint(*static.Replay.raid_size)
+        records.append({"time": start, "username": raider, "text": f"{raider} raided the stream with {size} viewers!", "raid": True})
+        for j in range(size):
+            records.append({
+                "time": start + rng.uniform(0, static.Replay.burst_duration),
+                "username": f"raider{i}_viewer{j}",
+                "text": rng.choice(("hello", "raid!", "hi everyone", "we're here", "o/")),
+                })
+
+    # Rant bursts: several paid messages close together
+    for _ in range(kwargs.get("rant_bursts", 0)):
+        start = rng.uniform(0, duration)
+        for _ in range(rng.randint(*static.Replay.rant_burst_size)):
+            records.append({
+                "time": start + rng.uniform(0, static.Replay.burst_duration),
+                "username": rng.choice(chatters),
+                "text": chatter_text(),
+                "rant_cents": rng.choice((100, 200, 500, 1000, 5000)),
+                })
+
+    # Spam floods: one user posting the same thing over and over
+    for i in range(kwargs.get("spam_floods", 0)):
+        start = rng.uniform(0, duration)
+        text = chatter_text().upper() + "!!!"
+        for _ in range(rng.randint(*static.Replay.spam_flood_size)):
+            records.append({
+                "time": start + rng.uniform(0, static.Replay.burst_duration),
+                "username": f"spammer{i}",
+                "text": text,
+                })
+
+    # Subscription gifts
+    for _ in range(kwargs.get("gifts", 0)):
+        gifter = rng.choice(chatters)
+        total = rng.choice((1, 5, 10, 25))
+        records.append({
+            "time": rng.uniform(0, duration),
+            "username": gifter,
+            "text": f"{gifter} gifted {total} subs!",
+            "gift": {"purchased_by": gifter, "total_gifts": total, "gift_type": "channel"},
+            })
+
+    records.sort(key=lambda record: record["time"])
+    return records
+
+
+def percentile(values, fraction: float):
+    """Get a percentile of some values
+
+    Args:
+        values (list): The values.
+        fraction (float): Which percentile, from 0 to 1.
+
+    Returns:
+        Value (float): The percentile value, or 0 if there were no values."""
+
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_load_test(records, setup: callable = None, speed: float = static.Replay.speed, actor_class = None, **kwargs):
+    """Drive an actor end to end with replayed chat, and report how it kept up
+
+    Args:
+        records (iterable): The chat records to replay, see load_recording() for the format.
+        setup (callable): Called with the actor before it starts, to register actions and commands.
+            Defaults to None, a bare actor.
+        drain (callable): Called with the actor after the chat ends and before it quits,
+            to let background work like pending verdicts finish.
+            Defaults to None, do not wait.
+        speed (float): How many times faster than recorded to replay the chat.
+            Defaults to static.Replay.speed
+        actor_class (type): The actor class to test.
+            Defaults to RumbleChatActor.
+        send_latency (float): Simulated network time of sending a message, in seconds.
+            Defaults to 0.
+        moderation_latency (float): Simulated network time of deleting a message or muting a user, in seconds.
+            Defaults to 0.
+        All other keyword arguments are passed to the actor.
+
+    Returns:
+        Report (dict): Load test results."""
+
+    # Imported here since the package init imports the lazy submodules
+    from . import RumbleChatActor
+
+    chat = ReplayChatAPI(
+        records,
+        speed=speed,
+        send_latency=kwargs.pop("send_latency", 0),
+        moderation_latency=kwargs.pop("moderation_latency", 0),
+        )
+    drain = kwargs.pop("drain", None)
+
+    actor = (actor_class or RumbleChatActor)(
+        stream_id=static.Replay.stream_id,
+        servicephp=ReplayServicePHP(),
+        chat=chat,
+        **kwargs,
+        )
+
+    if setup:
+        setup(actor)
+
+    start = time.time()
+    actor.mainloop()
+    elapsed = time.time() - start
+    if drain:
+        drain(actor)
+    actor.moderation_queue.join()
+    actor.quit()
+
+    shed = actor.metrics.snapshot()["counters"].get("shed", {})
+
+    return {
+        "messages": chat.delivered_count,
+        "elapsed": elapsed,
+        "throughput": chat.delivered_count / elapsed if elapsed else 0,
+        "dropped_by_age": shed.pop("message", 0),
+        "shed_actions": sum(shed.values()),
+        "inbox_lag": actor.inbox_lag,
+        "outbox_sent": len(chat.sent_messages),
+        "outbox_evicted": actor.outbox.evicted_count,
+        "outbox_expired": actor.outbox.expired_count,
+        "outbox_average_wait": actor.outbox.average_wait,
+        "deleted": len(chat.deleted_messages),
+        "muted": len(chat.muted_users),
+        "latency_p50": percentile(chat.latencies, 0.5),
+        "latency_p99": percentile(chat.latencies, 0.99),
+        "latency_max": max(chat.latencies, default=0),
+        }
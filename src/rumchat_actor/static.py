@@ -5,6 +5,7 @@ Absolute variable definitions not uinque to scripts.
 S.D.G.
 """
 
+import os
 from cocorum import static as cstatic
 
 REQUEST_TIMEOUT = cstatic.Delays.request_timeout
@@ -43,6 +44,12 @@ class Message:
     # Default maximum age of messages waiting to be processed
     max_inbox_age = 60
 
+    # Default number of worker threads for fire-and-forget message actions
+    action_workers = 4
+
+    # Default maximum number of fire-and-forget message actions waiting or running
+    max_pending_actions = 64
+
     # Prefix to all actor messages
     bot_prefix = "🤖: "
 
@@ -61,6 +68,49 @@ class Message:
     # Effective max length of a message
     effective_max_len = max_len - len(bot_prefix)
 
+    # How long to remember a sent message while waiting for it to come back through chat, in seconds
+    echo_ttl = 600
+
+    # Maximum number of sent messages to remember while waiting for them to come back through chat
+    echo_max_tracked = 1000
+
+    # How long low priority notices, like a command being on cooldown, may wait to send before they are dropped
+    notice_ttl = 10
+
+    # How far behind the actor can fall before it skips cosmetic message actions, in seconds
+    cosmetic_lag = 5
+
+    # How far behind the actor can fall before it also skips expensive message actions, in seconds
+    expensive_lag = 15
+
+    # Weight of the newest message in the smoothed inbox lag, from 0 to 1
+    lag_smoothing = 0.2
+
+    class Shedding:
+        """Classes of message actions, for skipping them when the actor falls behind chat.
+    Paid rants, gifts, raid alerts and staff messages always get every action."""
+
+        # Always run, like moderation that must not be skipped
+        essential = "essential"
+
+        # Nice to have, like sound blips and user announcements, skipped first
+        cosmetic = "cosmetic"
+
+        # Slow, like LLM moderation, skipped when far behind
+        expensive = "expensive"
+
+    class Priority:
+        """Priority classes of messages in the outbox, higher ones are sent first"""
+
+        # Notices that do not matter much if they never send, and timed messages
+        low = 0
+
+        # Normal replies
+        normal = 1
+
+        # Moderation notices and thanks for paid things
+        high = 2
+
 
 class URI:
     """Uniform Resource Identifiers"""
@@ -94,9 +144,46 @@ class Moderation:
         "forever" : "cmi js-btn-mute-for-account",
         }
 
+    # Arguments to RumbleChatActor().mute_user() for each of the mute levels
+    mute_level_args = {
+        "5" : {"duration" : 5 * 60},
+        "stream" : {},
+        "forever" : {"total" : True},
+        }
+
     # Badges of staff chatters
     staff_badges = ["admin", "moderator"]
 
+    # Default number of worker threads making moderation calls to Rumble
+    workers = 4
+
+    # Most calls per second to each moderation endpoint, and how many calls may burst at once
+    rate_limits = {
+        "delete" : (5, 10),
+        "mute" : (2, 5),
+        "unmute" : (2, 5),
+        "pin" : (1, 2),
+        "unpin" : (1, 2),
+        }
+
+    # Order to make waiting moderation calls in, lower first. Muting stops a spammer at the source, so it goes first
+    endpoint_priorities = {
+        "mute" : 0,
+        "delete" : 1,
+        "unmute" : 2,
+        "pin" : 2,
+        "unpin" : 2,
+        }
+
+    # How many times to retry a failed moderation call, and the base of the doubling delay between tries, in seconds
+    retries = 3
+    retry_backoff = 0.5
+
+    # How many deletes of one user's messages may wait before the user is also muted, and at what mute level.
+    # None does not mute
+    coalesce_deletes = 5
+    coalesce_mute_level = "5"
+
 
 class Clip:
     """For clipping"""
@@ -120,6 +207,15 @@ class Clip:
         # to be usable in a cache. Cannot be less than 1
         speed_factor_req = 2
 
+        # Save clips by remuxing the TS chunks with stream copy, only re-encoding if that fails
+        stream_copy = True
+
+        # FFMPEG arguments between the input and the output file for the stream copy remux
+        remux_args = ("-map", "0:v?", "-map", "0:a?", "-c", "copy", "-bsf:a", "aac_adtstoasc", "-movflags", "+faststart")
+
+        # How long a stream copy remux may take before falling back to re-encoding, in seconds
+        remux_timeout = 60
+
     class Upload:
         """For uploading clips"""
 
@@ -161,6 +257,29 @@ class Clip:
         size_check_delay = 0.3
 
 
+class HLS:
+    """For fetching livestream HLS playlists and chunks"""
+
+    # How many downloads may run at once, which is also how many connections to keep open per host
+    fetch_workers = 6
+
+    # How many hosts to keep pooled connections to
+    pool_hosts = 4
+
+    # How many times to retry a failed download, and the base of the doubling delay between tries, in seconds
+    retries = 3
+    retry_backoff = 0.5
+
+    # Most bytes of TS chunks to keep in memory for live clipping
+    segment_budget = 128 * 1024 ** 2
+
+    # How many chunks the playlist media sequence must go back by to count as a stream restart, even to seen chunks
+    restart_gap = 30
+
+    # How many recent chunk names to remember, to follow playlists with no media sequence and spot restarts
+    remembered_segments = 1000
+
+
 class AutoModerator:
     """For automatic moderation"""
 
@@ -170,6 +289,145 @@ class AutoModerator:
     # OLLaMa model to use for auto-modetation
     llm_model = "llama3.2"
 
+    # LLM system message to moderate a batch of numbered messages with
+    llm_batch_sys_prompt = "Analyze the following numbered chat messages for appropriate-ness, one message per line. For each message, respond with a line of its number, a colon, and either a 0 or a 1: If a message is appropriate for PG-13 SFW and not spam, or you are not sure, use a 1. If it is not appropriate for PG-13 or is NSFW or is spam, use a 0. Respond with exactly one line per message. Do not respond with commentary."
+
+    # How long to collect messages into one batch before sending it to the LLM, in seconds
+    batch_window = 0.3
+
+    # Most messages to send to the LLM in one batch
+    max_batch = 20
+
+    # How long to wait for a verdict before using the fallback verdict, in seconds
+    deadline = 5
+
+    # Verdict to use when the LLM does not give one in time, True lets the message through
+    fallback_verdict = True
+
+    # Most verdicts to remember in the verdict cache
+    cache_size = 10000
+
+    # How long to remember a verdict, in seconds
+    cache_ttl = 3600
+
+    # Most differing SimHash bits for a message to count as a near-duplicate of a cached one
+    near_duplicate_distance = 6
+
+    # How many bands to split the SimHash into for the near-duplicate index. Must be more than near_duplicate_distance
+    simhash_bands = 8
+
+    # Words and emotes that make a message clean without asking the LLM, if the message has nothing else.
+    # No function words or letters, since an insult can be made of those and one offensive word
+    allowlist = (
+        "lol", "lmao", "rofl", "gg", "ggs", "hi", "hey", "hello", "yo", "bye", "gn", "nice", "wow", "ok", "okay",
+        "yes", "yeah", "yep", "nope", "thanks", "ty", "thx", "np", "welcome", "back", "wb",
+        "good", "great", "cool", "awesome", "love", "haha", "hahaha", "xd", "o7",
+        )
+
+    # Words and phrases that make a message dirty without asking the LLM
+    blocklist = ()
+
+    # Number of hashed n-gram features of the distilled classifier
+    classifier_dims = 2 ** 18
+
+    # Probability of being clean that the distilled classifier must reach to decide a message as clean,
+    # and one minus it to decide a message as dirty. Messages in between go to the LLM
+    classifier_confidence = 0.95
+
+    # Training passes, step size and L2 regularization of the distilled classifier
+    classifier_epochs = 200
+    classifier_learning_rate = 0.5
+    classifier_l2 = 1e-6
+
+    # Fraction of logged verdicts held out to evaluate the distilled classifier
+    classifier_holdout = 0.2
+
+    # SQLite database file to keep user reputations in across streams
+    reputation_filename = "reputation.sqlite3"
+
+    # Clean messages a user needs, and the largest share of dirty messages they may have, to be trusted
+    trust_clean_count = 200
+    trust_max_dirty_ratio = 0.01
+
+    # Fraction of trusted users' messages to still moderate
+    trusted_sample_rate = 0.05
+
+    # How often to write reputation changes to the database, in seconds, and how many changed users to write early at
+    reputation_flush_interval = 5
+    reputation_flush_size = 500
+
+
+class FloodGuard:
+    """For the flood and spam detector"""
+
+    # Most messages a user may send within the window, and the window in seconds
+    max_messages = 8
+    window = 10
+
+    # Most times a user may send the same message in a row within the duplicate window, and the window in seconds
+    max_duplicates = 3
+    duplicate_window = 60
+
+    # Mute level for each offense in a row, see Moderation.mute_levels. None only deletes the message.
+    # Offenses past the end use the last level
+    escalation = (None, "5", "stream", "forever")
+
+    # How long an offense counts towards escalation, in seconds
+    offense_memory = 60 * 60
+
+    # Most users to track, the least recently active are forgotten first
+    max_users = 20000
+
+
+class Audio:
+    """For the audio bus"""
+
+    # How many mixer channels to play sounds on
+    channels = 8
+
+    # Volume factor of other sounds while speech plays
+    duck_volume = 0.3
+
+    # How long to coalesce chat blips into one, in seconds
+    blip_window = 0.25
+
+    class Priority:
+        """Priorities of sounds on the audio bus, higher ones take the channels of lower ones"""
+
+        # Chat activity blips
+        blip = 0
+
+        # Sound effects
+        effect = 1
+
+        # Speech, which ducks lower priorities
+        speech = 2
+
+
+class TTS:
+    """For text-to-speech"""
+
+    # Most speeches that can be waiting to be spoken
+    max_queue = 20
+
+    # Most estimated speaking time that can be waiting, in seconds
+    time_budget = 120
+
+    # Longest estimated time to speak one text for, in seconds
+    max_speech_duration = 30
+
+    # Speaking rate to estimate speech duration with, in words per second
+    words_per_second = 2.5
+
+    # Where to cache rendered speech, None to not cache it
+    cache_directory = os.path.join(os.path.expanduser("~"), ".cache", "rumchat_actor", "tts")
+
+    # Size budget of the rendered speech cache on disk, in bytes
+    cache_max_bytes = 200 * 1024 * 1024
+
+    # How many cached sounds to keep loaded in the mixer
+    loaded_sounds = 32
+
 
 class Thank:
     """For saying thank-you in chat"""
@@ -180,3 +438,90 @@ class Thank:
         follower = "Thank you @{follower.username} for the follow!"
         subscriber = "Thank you @{subscriber.username} for the ${subscriber.amount_cents / 100 : .2f} subscription!"
         gifted_subs = "Thank you @{gift.purchased_by} for the {gift.total_gifts} gifted {gift.gift_type} sub{'s' if gift.total_gifts != 1 else ''}!"
+
+
+class Benchmark:
+    """For performance benchmarks"""
+
+    # Maximum acceptable time to import the package, in seconds
+    import_time_budget = 1.0
+
+    # How many fresh interpreters to time the import in
+    import_runs = 3
+
+    # Optional dependencies that must not be imported just by importing the package
+    heavy_modules = ("moviepy", "pygame", "talkey", "obsws_python", "tkinter", "ollama", "numpy")
+
+    # Chat rates to benchmark moderation at, in messages per second
+    moderation_rates = (5, 50, 500)
+
+    # How long to run synthetic chat at each rate, in seconds
+    moderation_duration = 20
+
+    # Latency distribution of the fake Ollama server, "fixed", "uniform" or "lognormal", its mean in seconds,
+    # and the spread of the lognormal distribution
+    llm_latency_distribution = "lognormal"
+    llm_latency = 0.5
+    llm_latency_sigma = 0.5
+
+    # Extra latency of the fake Ollama server per message in a batch, in seconds
+    llm_latency_per_message = 0.01
+
+    # Fraction of messages the fake Ollama server says are dirty
+    dirty_ratio = 0.05
+
+    # Fraction of messages the fake Ollama server leaves out of its answer, to exercise the fallback verdict
+    malformed_ratio = 0.0
+
+    # How often to sample the moderation backlog during a benchmark, in seconds
+    backlog_sample_interval = 0.1
+
+
+class Metrics:
+    """For latency instrumentation"""
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    # How often to write the Prometheus text file, in seconds
+    prometheus_interval = 15
+
+    # Prefix of Prometheus metric names
+    prometheus_prefix = "rumchat_actor"
+
+    # How many of the slowest things to list in a metrics summary
+    summary_length = 3
+
+
+class Replay:
+    """For offline chat replay and load testing"""
+
+    # Username the actor is "logged in" as during a replay
+    username = "replay_actor"
+
+    # Stream ID used for replayed chats
+    stream_id = "replay"
+
+    # Number of regular chatters in synthetic traffic
+    chatters = 50
+
+    # Words that synthetic chatter is made of
+    vocabulary = (
+        "hello", "lol", "nice", "gg", "what", "is", "this", "game", "stream", "love",
+        "the", "chat", "that", "was", "awesome", "no", "way", "yes", "wow", "ok",
+        )
+
+    # How long raid, rant and spam bursts last in synthetic traffic, in seconds
+    burst_duration = 10
+
+    # Minimum and maximum number of viewers in a synthetic raid
+    raid_size = (20, 80)
+
+    # Minimum and maximum number of rants in a synthetic rant burst
+    rant_burst_size = (3, 10)
+
+    # Minimum and maximum number of repeats in a synthetic spam flood
+    spam_flood_size = (15, 40)
+
+    # Default replay speed factor for load tests
+    speed = 1.0
@@ -4,12 +4,79 @@
 Various utility functions
 S.D.G."""
 
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import importlib
+import itertools
 import os
+import queue
+import random
+import threading
+import time
 from typing import Sequence
 from cocorum.utils import *
 from . import static
 
 
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is first used"""
+
+    def __init__(self, name: str, extra: str = None):
+        """Stand-in for a module that is only imported when one of its attributes is first used
+
+    Args:
+        name (str): The full name of the module.
+        extra (str): The rumchat_actor optional dependency group that provides the module, for the error message.
+            Defaults to None, no group."""
+
+        self.__name = name
+        self.__extra = extra
+        self.__module = None
+
+    def __load(self):
+        """Import the real module if we have not yet
+
+    Returns:
+        Module (module): The real module."""
+
+        if self.__module is None:
+            try:
+                self.__module = importlib.import_module(self.__name)
+            except ModuleNotFoundError as e:
+                if not self.__extra:
+                    raise
+                raise ModuleNotFoundError(
+                    f"{self.__name} is needed for this feature. Install it with: pip install rumchat_actor[{self.__extra}]"
+                    ) from e
+
+        return self.__module
+
+    def __getattr__(self, attr):
+        """Get an attribute of the real module, importing it if needed"""
+        return getattr(self.__load(), attr)
+
+    def __repr__(self):
+        """The lazy module in string form"""
+        loaded = " (loaded)" if self.__module else ""
+        return f"<lazy module '{self.__name}'{loaded}>"
+
+
+def lazy_import(name: str, extra: str = None):
+    """Get a module that will only actually be imported when it is first used
+
+Args:
+    name (str): The full name of the module.
+    extra (str): The rumchat_actor optional dependency group that provides the module, for the error message.
+        Defaults to None, no group.
+
+Returns:
+    Module (LazyModule): The stand-in for the module."""
+
+    return LazyModule(name, extra)
+
+
 def is_staff(user):
     """Check if a user is channel staff
 
@@ -97,3 +164,668 @@ def multiple_choice(title: str, options: Sequence[str]) -> str:
         # Something was typed but it was invalid
         if entry:
             print("Invalid entry. Please type a number or the option itself.")
+
+
+class Outbox:
+    """Thread-safe priority queue of messages waiting to send, which sleeps until a message is ready"""
+
+    def __init__(self, maxsize: int = 0):
+        """Thread-safe priority queue of messages waiting to send, which sleeps until a message is ready.
+    Higher priority messages are sent first, and evict lower priority ones when the outbox is full.
+    Messages may expire unsent, and a message identical to one already waiting is not queued twice.
+
+    Args:
+        maxsize (int): How many messages can be waiting before we start dropping them.
+            Defaults to 0, no limit."""
+
+        self.maxsize = maxsize
+
+        # Waiting messages by priority, each a deque of [text, time queued, expiry time or None, priority]
+        self.__queues = {}
+
+        # Waiting messages by text, for deduplication
+        self.__pending = {}
+
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+        # How long the last sent message waited in the queue
+        self.last_wait = 0
+
+        # Total time in queue and count of messages that have left the queue, for the average
+        self.__total_wait = 0
+        self.__got_count = 0
+
+        # How many messages were dropped for each reason
+        self.expired_count = 0
+        self.evicted_count = 0
+        self.deduplicated_count = 0
+
+    def __len__(self):
+        """How many messages are waiting"""
+        return len(self.__pending)
+
+    def qsize(self):
+        """How many messages are waiting (queue.Queue compatibility)"""
+        return len(self)
+
+    def empty(self):
+        """Is the outbox empty?"""
+        return not self.__pending
+
+    @property
+    def depth(self):
+        """How many messages are waiting"""
+        return len(self)
+
+    @property
+    def oldest_wait(self):
+        """How long the oldest waiting message has been in the queue, in seconds"""
+        with self.__condition:
+            if not self.__pending:
+                return 0
+            return time.time() - min(entry[1] for entry in self.__pending.values())
+
+    @property
+    def average_wait(self):
+        """The average time sent messages spent in the queue, in seconds"""
+        if not self.__got_count:
+            return 0
+        return self.__total_wait / self.__got_count
+
+    def __remove(self, entry):
+        """Take a specific entry out of the queues. Must hold the condition.
+
+    Args:
+        entry (list): The entry to remove."""
+
+        self.__queues[entry[3]].remove(entry)
+        del self.__pending[entry[0]]
+
+    def __purge_expired(self, now):
+        """Drop all expired messages. Must hold the condition.
+
+    Args:
+        now (float): The current time."""
+
+        for entry in [e for e in self.__pending.values() if e[2] is not None and e[2] <= now]:
+            self.__remove(entry)
+            self.expired_count += 1
+            print("Outbox message expired unsent:\n\t", entry[0])
+
+    def put(self, text: str, priority: int = static.Message.Priority.normal, ttl: float = None):
+        """Add a message to the outbox
+
+    Args:
+        text (str): The message to send.
+        priority (int): The priority class of the message, higher is sent first.
+            Defaults to static.Message.Priority.normal
+        ttl (float): How long the message may wait before it is dropped unsent, in seconds.
+            Defaults to None, never expire.
+
+    Returns:
+        Dropped (str | None): A message that was dropped for lack of room,
+            either an evicted lower priority one or this one."""
+
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self.__condition:
+            # This message is already waiting, just upgrade it
+            if (entry := self.__pending.get(text)):
+                self.deduplicated_count += 1
+                if entry[2] is not None:
+                    entry[2] = None if expires is None else max(entry[2], expires)
+                if priority > entry[3]:
+                    self.__queues[entry[3]].remove(entry)
+                    entry[3] = priority
+                    self.__queues.setdefault(priority, collections.deque()).append(entry)
+                return None
+
+            dropped = None
+            if self.maxsize and len(self.__pending) >= self.maxsize:
+                self.__purge_expired(now)
+
+            # Still full, evict the oldest message of the lowest priority if it is below ours
+            if self.maxsize and len(self.__pending) >= self.maxsize:
+                lowest = min(p for p, q in self.__queues.items() if q)
+                if lowest > priority:
+                    self.evicted_count += 1
+                    return text
+
+                evicted = self.__queues[lowest][0]
+                self.__remove(evicted)
+                self.evicted_count += 1
+                dropped = evicted[0]
+
+            entry = [text, now, expires, priority]
+            self.__queues.setdefault(priority, collections.deque()).append(entry)
+            self.__pending[text] = entry
+            self.__condition.notify()
+
+        return dropped
+
+    def __pop(self, now):
+        """Take the oldest unexpired message of the highest priority and record how long it waited.
+    Must hold the condition.
+
+    Args:
+        now (float): The current time.
+
+    Returns:
+        Text (str | None): The message, or None if all waiting messages had expired."""
+
+        self.__purge_expired(now)
+        if not self.__pending:
+            return None
+
+        entry = self.__queues[max(p for p, q in self.__queues.items() if q)][0]
+        self.__remove(entry)
+        self.last_wait = now - entry[1]
+        self.__total_wait += self.last_wait
+        self.__got_count += 1
+        return entry[0]
+
+    def get_nowait(self):
+        """Take the next message without waiting
+
+    Returns:
+        Text (str): The message.
+
+    Raises:
+        queue.Empty: There are no messages waiting."""
+
+        with self.__condition:
+            text = self.__pop(time.time())
+            if text is None:
+                raise queue.Empty
+            return text
+
+    def get(self, ready_time: callable = None, timeout: float = None):
+        """Sleep until there is a message and it is time to send it, then take it
+
+    Args:
+        ready_time (callable): Returns the epoch time before which nothing may be sent.
+            It is checked again whenever we wake, so it may change while we wait.
+            Defaults to None, send as soon as there is a message.
+        timeout (float): How long to wait at most, in seconds.
+            Defaults to None, wait forever.
+
+    Returns:
+        Text (str | None): The message, or None if we timed out or the outbox was closed."""
+
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.__condition:
+            while not self.__closed:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    return None
+
+                # Wait for a message to arrive
+                if not self.__pending:
+                    self.__condition.wait(deadline - now if deadline is not None else None)
+                    continue
+
+                # Wait for the send time to come
+                wait = ready_time() - now if ready_time else 0
+                if wait > 0:
+                    self.__condition.wait(min(wait, deadline - now) if deadline is not None else wait)
+                    continue
+
+                text = self.__pop(now)
+                if text is not None:
+                    return text
+
+        return None
+
+    def close(self):
+        """Wake up and turn away everyone waiting on the outbox, for shutdown"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+class RateLimiter:
+    """Thread-safe token bucket rate limiter"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """Thread-safe token bucket rate limiter
+
+    Args:
+        rate (float): How many calls are allowed per second on average.
+        burst (int): How many calls may be made at once after a quiet period.
+            Defaults to 1."""
+
+        assert rate > 0, "Rate must be positive"
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, going into debt if there are none
+
+    Returns:
+        Delay (float): How long to wait before making the call, in seconds."""
+
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate) - 1
+            self.__updated = now
+            return max(-self.__tokens / self.rate, 0)
+
+    def acquire(self):
+        """Wait until a call is allowed"""
+        time.sleep(self.reserve())
+
+
+class ModerationQueue:
+    """Queue of moderation calls to Rumble, made in the background by a pool of workers"""
+
+    # ChatAPI method for each moderation endpoint
+    endpoint_methods = {
+        "delete" : "delete_message",
+        "mute" : "mute_user",
+        "unmute" : "unmute_user",
+        "pin" : "pin_message",
+        "unpin" : "unpin_message",
+        }
+
+    def __init__(self, chat, **kwargs):
+        """Queue of moderation calls to Rumble, made in the background by a pool of workers.
+    Each endpoint is rate limited, failed calls are retried with backoff,
+    identical waiting calls are made once, and a pile of deletes of one user's messages also mutes them.
+    Every call returns a concurrent.futures.Future of the ChatAPI method's result.
+
+    Args:
+        chat (cocorum.chatapi.ChatAPI): The chat to moderate.
+        workers (int): How many calls may be in progress at once.
+            Defaults to static.Moderation.workers
+        rate_limits (dict): Calls per second and burst size for each endpoint.
+            Defaults to static.Moderation.rate_limits
+        retries (int): How many times to retry a failed call.
+            Defaults to static.Moderation.retries
+        retry_backoff (float): Delay before the first retry, doubling after that, in seconds.
+            Defaults to static.Moderation.retry_backoff
+        coalesce_deletes (int): How many deletes of one user's messages may wait before the user is also muted.
+            Defaults to static.Moderation.coalesce_deletes
+        coalesce_mute_level (str): Mute level for that, see static.Moderation.mute_levels. None does not mute.
+            Defaults to static.Moderation.coalesce_mute_level
+        metrics (metrics.Metrics): Metrics registry to record call latencies and retries in.
+            Defaults to None, do not record."""
+
+        self.chat = chat
+        self.retries = kwargs.get("retries", static.Moderation.retries)
+        self.retry_backoff = kwargs.get("retry_backoff", static.Moderation.retry_backoff)
+        self.coalesce_deletes = kwargs.get("coalesce_deletes", static.Moderation.coalesce_deletes)
+        self.coalesce_mute_level = kwargs.get("coalesce_mute_level", static.Moderation.coalesce_mute_level)
+        self.metrics = kwargs.get("metrics")
+        self.limiters = {
+            endpoint: RateLimiter(*limit)
+            for endpoint, limit in kwargs.get("rate_limits", static.Moderation.rate_limits).items()
+            }
+
+        # Waiting calls as a heap of (priority, sequence number, call), with each call being
+        # [endpoint, args, kwargs, future, key, time queued, username of a message to delete]
+        self.__heap = []
+        self.__sequence = itertools.count()
+
+        # Futures of waiting or running calls by key, for deduplication
+        self.__pending = {}
+
+        # How many deletes of each user's messages are waiting or running, and users we have muted for it
+        self.__user_deletes = collections.Counter()
+        self.__coalesced_users = set()
+
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+        # Statistics
+        self.deduplicated_count = 0
+        self.coalesced_count = 0
+        self.failed_count = 0
+
+        self.__workers = [
+            threading.Thread(target = self.__worker_loop, daemon = True)
+            for _ in range(kwargs.get("workers", static.Moderation.workers))
+            ]
+        for worker in self.__workers:
+            worker.start()
+
+    def __len__(self):
+        """How many calls are waiting or running"""
+        return len(self.__pending)
+
+    @property
+    def depth(self):
+        """How many calls are waiting or running"""
+        return len(self)
+
+    def submit(self, endpoint: str, args: tuple = (), kwargs: dict = None, key = None, username: str = None):
+        """Queue a moderation call
+
+    Args:
+        endpoint (str): The endpoint to call, see ModerationQueue.endpoint_methods.
+        args (tuple): Positional arguments of the ChatAPI method.
+        kwargs (dict): Keyword arguments of the ChatAPI method.
+            Defaults to None, no keyword arguments.
+        key (hashable): Identity of the call. A call with the same key as a waiting one is not queued again.
+            Defaults to None, never deduplicate.
+        username (str): For deletes, the username of the message's author, to coalesce deletes into a mute.
+            Defaults to None, do not coalesce.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the ChatAPI method."""
+
+        assert endpoint in self.endpoint_methods, f"Unknown moderation endpoint {endpoint}"
+        with self.__condition:
+            # Verdicts and the like may still come in while shutting down
+            if self.__closed:
+                print(f"Moderation queue is closed, dropping {endpoint} call.")
+                future = concurrent.futures.Future()
+                future.cancel()
+                return future
+
+            future = self.__push(endpoint, args, kwargs or {}, key, username)
+
+            # Too many of this user's messages are waiting to be deleted, stop them at the source
+            if username and self.coalesce_mute_level and username not in self.__coalesced_users \
+                    and self.__user_deletes[username] >= self.coalesce_deletes:
+                print(f"Muting {username} for {self.__user_deletes[username]} messages waiting to be deleted")
+                self.__coalesced_users.add(username)
+                self.coalesced_count += 1
+                kwargs, key = self.__mute_call(username, **static.Moderation.mute_level_args[self.coalesce_mute_level])
+                self.__push("mute", (username,), kwargs, key, None)
+
+        return future
+
+    @staticmethod
+    def __mute_call(user: str, duration: int = None, total: bool = False):
+        """Build the arguments and deduplication key of a mute, so identical mutes are always merged
+
+    Returns:
+        Kwargs (dict): The keyword arguments of the mute call.
+        Key (tuple): The deduplication key of the mute."""
+
+        return {"duration": duration, "total": total}, ("mute", str(user), duration, total)
+
+    def __push(self, endpoint, args, kwargs, key, username):
+        """Queue a call unless an identical one is waiting. Must hold the condition.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the call, or of the identical one."""
+
+        if key is not None and (future := self.__pending.get(key)):
+            self.deduplicated_count += 1
+            return future
+
+        future = concurrent.futures.Future()
+        if key is None:
+            key = ("unique", next(self.__sequence))
+        self.__pending[key] = future
+        if endpoint == "delete" and username:
+            self.__user_deletes[username] += 1
+
+        call = [endpoint, args, kwargs, future, key, time.time(), username if endpoint == "delete" else None]
+        heapq.heappush(self.__heap, (static.Moderation.endpoint_priorities.get(endpoint, 0), next(self.__sequence), call))
+        self.__condition.notify()
+        return future
+
+    def delete_message(self, message):
+        """Delete a message in the chat
+
+    Args:
+        message (cocorum.chatapi.Message): The message to delete.
+
+    Returns:
+        Result (concurrent.futures.Future): Resolves to True if the message was deleted."""
+
+        user = getattr(message, "user", None)
+        return self.submit("delete", (message,), key = ("delete", int(message)), username = getattr(user, "username", None))
+
+    def mute_user(self, user: str, duration: int = None, total: bool = False):
+        """Mute a user in the chat
+
+    Args:
+        user (str): Username to mute.
+        duration (int): How long to mute the user in seconds.
+            Defaults to infinite.
+        total (bool): Wether or not they are muted across all videos.
+            Defaults to False, just this video.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the mute."""
+
+        kwargs, key = self.__mute_call(user, duration, total)
+        return self.submit("mute", (str(user),), kwargs, key = key)
+
+    def unmute_user(self, user):
+        """Unmute a user in the chat
+
+    Args:
+        user (str | cocorum.chatapi.User): Username or user object to unmute.
+            User objects are passed on as is, since they turn into their ID, not their username, as str.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the unmute."""
+
+        return self.submit("unmute", (user,), key = ("unmute", getattr(user, "username", user)))
+
+    def pin_message(self, message):
+        """Pin a message in the chat
+
+    Args:
+        message (cocorum.chatapi.Message): The message to pin.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the pin."""
+
+        return self.submit("pin", (message,), key = ("pin", int(message)))
+
+    def unpin_message(self, message = None):
+        """Unpin a message in the chat
+
+    Args:
+        message (cocorum.chatapi.Message): Message to unpin.
+            Defaults to None, unpin the known pinned message.
+
+    Returns:
+        Result (concurrent.futures.Future): The result of the unpin."""
+
+        return self.submit("unpin", (message,) if message else (), key = ("unpin", int(message) if message else None))
+
+    def __call(self, endpoint, args, kwargs):
+        """Make a call, retrying with backoff if it fails
+
+    Returns:
+        Result (Any): What the ChatAPI method returned, False if it kept failing.
+
+    Raises:
+        Exception: The last error, if the call kept raising."""
+
+        method = getattr(self.chat, self.endpoint_methods[endpoint])
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                if self.metrics:
+                    self.metrics.count("moderation_retry", endpoint)
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            if endpoint in self.limiters:
+                self.limiters[endpoint].acquire()
+
+            try:
+                with self.metrics.timer("moderation", endpoint) if self.metrics else contextlib.nullcontext():
+                    result = method(*args, **kwargs)
+
+            # Cocorum asserts on calls that can never succeed, like deleting a deleted message
+            except AssertionError:
+                raise
+
+            except Exception as e:
+                error = e
+                continue
+
+            # Deletes return False when Rumble refuses them
+            if result is not False:
+                return result
+
+        if error:
+            raise error
+        return False
+
+    def __worker_loop(self):
+        """Make waiting calls until closed and drained"""
+        while True:
+            with self.__condition:
+                while not self.__heap and not self.__closed:
+                    self.__condition.wait()
+                if not self.__heap:
+                    return
+                _, _, (endpoint, args, kwargs, future, key, queued, username) = heapq.heappop(self.__heap)
+
+            if self.metrics:
+                self.metrics.observe("moderation", "wait", time.time() - queued)
+
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.__call(endpoint, args, kwargs))
+                    except Exception as e:
+                        print(f"Error: Moderation call {endpoint} failed:", repr(e))
+                        self.failed_count += 1
+                        future.set_exception(e)
+
+            finally:
+                with self.__condition:
+                    self.__pending.pop(key, None)
+                    if username:
+                        self.__user_deletes[username] -= 1
+                        if self.__user_deletes[username] <= 0:
+                            del self.__user_deletes[username]
+                            self.__coalesced_users.discard(username)
+                    self.__condition.notify_all()
+
+    def join(self, timeout: float = None):
+        """Wait until no calls are waiting or running
+
+    Args:
+        timeout (float): Most time to wait, in seconds.
+            Defaults to None, no limit.
+
+    Returns:
+        Done (bool): Did the queue empty in time?"""
+
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__pending, timeout)
+
+    def close(self):
+        """Stop accepting calls, letting the workers finish the waiting ones"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+class EchoTracker:
+    """Bounded record of messages we sent, to recognize them when they come back through chat"""
+
+    def __init__(self, ttl: float = static.Message.echo_ttl, maxsize: int = static.Message.echo_max_tracked):
+        """Bounded record of messages we sent, to recognize them when they come back through chat.
+    Matches on the server message ID where we have it, otherwise on the text.
+
+    Args:
+        ttl (float): How long to remember a sent message, in seconds.
+            Defaults to static.Message.echo_ttl
+        maxsize (int): How many sent texts and IDs to remember at most, each.
+            Defaults to static.Message.echo_max_tracked"""
+
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        # Sent texts, to [count waiting to come back, expiry time], oldest first
+        self.__texts = collections.OrderedDict()
+
+        # Sent message IDs, to expiry time, oldest first
+        self.__ids = collections.OrderedDict()
+
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """How many distinct sent texts we are waiting on"""
+        with self.__lock:
+            self.__trim()
+            return len(self.__texts)
+
+    def __contains__(self, text):
+        """Are we waiting on a sent message with this text?"""
+        with self.__lock:
+            self.__trim()
+            return text in self.__texts
+
+    def __trim(self):
+        """Forget expired and excess records. Must hold the lock."""
+        now = time.time()
+        while self.__texts and (len(self.__texts) > self.maxsize or next(iter(self.__texts.values()))[1] <= now):
+            self.__texts.popitem(last = False)
+        while self.__ids and (len(self.__ids) > self.maxsize or next(iter(self.__ids.values())) <= now):
+            self.__ids.popitem(last = False)
+
+    def add_text(self, text: str):
+        """Record that we sent a message
+
+    Args:
+        text (str): The text of the message."""
+
+        with self.__lock:
+            record = self.__texts.pop(text, [0, 0])
+            record[0] += 1
+            record[1] = time.time() + self.ttl
+            self.__texts[text] = record
+            self.__trim()
+
+    def add_id(self, message_id: int):
+        """Record the server ID of a message we sent
+
+    Args:
+        message_id (int): The message ID returned by the chat API."""
+
+        with self.__lock:
+            self.__ids[int(message_id)] = time.time() + self.ttl
+            self.__trim()
+
+    def __consume_text(self, text):
+        """Count one echo of a text as having come back. Must hold the lock.
+
+    Args:
+        text (str): The text of the message.
+
+    Returns:
+        Result (bool): Were we waiting on this text?"""
+
+        record = self.__texts.get(text)
+        if not record:
+            return False
+
+        record[0] -= 1
+        if record[0] <= 0:
+            del self.__texts[text]
+        return True
+
+    def consume(self, message):
+        """Check if a chat message is one we sent, and stop waiting on it if so
+
+    Args:
+        message (cocorum.chatapi.Message): The chat message.
+
+    Returns:
+        Result (bool): Is this a message we sent?"""
+
+        with self.__lock:
+            self.__trim()
+            message_id = getattr(message, "message_id", None)
+            if message_id is not None and message_id in self.__ids:
+                del self.__ids[message_id]
+                self.__consume_text(message.text)
+                return True
+
+            return self.__consume_text(message.text)